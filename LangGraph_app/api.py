@@ -1,50 +1,76 @@
 import os
+import json
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
 from langgraph.graph import StateGraph, END
 import uvicorn
-# from langgraph.checkpoint.sqlite import SqliteSaver
 from langchain_core.messages import HumanMessage
 
 from graph_state import GraphState
 from langGraph_agent import (
+    embed_message_node,
     store_message_node,
     retrieve_memories_node,
     generate_response_node,
+    summarize_history_node,
+    cap_state_node,
     should_retrieve_router,
+    memory_router,
+    close_clients,
 )
-from langgraph.checkpoint.memory import MemorySaver
-
-memory = MemorySaver()
+from checkpointer import open_checkpointer, CheckpointPruner
 
 load_dotenv()
 
-# For the tutorial, we'll use an in-memory checkpointer.
-# For production, you would use a persistent checkpointer like SqliteSaver.
-# memory = MemorySaver()
-# memory = SqliteSaver.from_conn_string("memory.db")
-
 # --- Build the Graph ---
-workflow = StateGraph(GraphState)
-workflow.add_node("store_message", store_message_node)
-workflow.add_node("retrieve", retrieve_memories_node)
-workflow.add_node("generate", generate_response_node)
-workflow.set_entry_point("store_message")
-workflow.add_edge("retrieve", "generate")
-workflow.add_conditional_edges(
-    "store_message",
-    should_retrieve_router,
-    {"retrieve": "retrieve", "generate": "generate"},
-)
-workflow.add_edge("generate", END)
+def build_workflow():
+    """
+    embed_message fans out to three branches that run in parallel:
+    - store_message (Pinecone upsert), which nothing downstream reads
+    - summarize_history, which folds old messages into the running summary
+    - the router, then retrieve (optional) and generate
+    cap_state joins them, so generation never waits for the upsert or the summarizer.
+    """
+    workflow = StateGraph(GraphState)
+    workflow.add_node("embed_message", embed_message_node)
+    workflow.add_node("store_message", store_message_node)
+    workflow.add_node("retrieve", retrieve_memories_node)
+    workflow.add_node("generate", generate_response_node)
+    workflow.add_node("summarize_history", summarize_history_node)
+    workflow.add_node("cap_state", cap_state_node)
+    workflow.set_entry_point("embed_message")
+    workflow.add_edge("embed_message", "store_message")
+    workflow.add_edge("embed_message", "summarize_history")
+    workflow.add_conditional_edges(
+        "embed_message",
+        should_retrieve_router,
+        {"retrieve": "retrieve", "generate": "generate"},
+    )
+    workflow.add_edge("retrieve", "generate")
+    workflow.add_edge(["store_message", "summarize_history", "generate"], "cap_state")
+    workflow.add_edge("cap_state", END)
+    return workflow
+
+workflow = build_workflow()
+
 
-# COMPILE THE GRAPH WITH THE CHECKPOINTER
-app_graph = workflow.compile(checkpointer=memory)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # COMPILE THE GRAPH WITH A PERSISTENT CHECKPOINTER (SQLite by default, see CHECKPOINT_URL)
+    async with open_checkpointer() as checkpointer:
+        app.state.graph = workflow.compile(checkpointer=checkpointer)
+        app.state.pruner = CheckpointPruner(checkpointer)
+        app.state.pruner.start()
+        yield
+        await app.state.pruner.stop()
+    await close_clients()
 
 
 # --- FastAPI App ---
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # The request no longer needs to include the chat history
 class ChatRequest(BaseModel):
@@ -63,7 +89,8 @@ async def chat(request: ChatRequest):
     }
     
     # Use 'ainvoke' to run the graph with the input and config
-    final_state = await app_graph.ainvoke(input_data, config)
+    final_state = await app.state.graph.ainvoke(input_data, config)
+    app.state.pruner.mark(request.user_id)
     
     # The final response is the last message in the state
     response_message = final_state["messages"][-1].content
@@ -71,5 +98,57 @@ async def chat(request: ChatRequest):
     return {"response": response_message}
 
 
+# Nodes reported as progress events on /chat/stream
+STREAMED_NODES = {"embed_message", "store_message", "summarize_history", "retrieve", "generate"}
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def _stream_turn(request: ChatRequest):
+    config = {"configurable": {"thread_id": request.user_id}}
+    input_data = {
+        "messages": [HumanMessage(content=request.message)],
+        "user_id": request.user_id
+    }
+    tokens = []
+    try:
+        async for event in app.state.graph.astream_events(input_data, config, version="v2"):
+            kind, name = event["event"], event["name"]
+            node = event.get("metadata", {}).get("langgraph_node")
+            if kind == "on_chat_model_stream" and node == "generate":
+                content = event["data"]["chunk"].content
+                if content:
+                    tokens.append(content)
+                    yield _sse("token", {"content": content})
+            elif kind in ("on_chain_start", "on_chain_end") and name in STREAMED_NODES and name == node:
+                yield _sse("node", {"node": name, "status": "start" if kind == "on_chain_start" else "end"})
+            elif kind == "on_chain_end" and name == "should_retrieve_router":
+                yield _sse("route", {"decision": event["data"]["output"]})
+    except Exception as e:
+        yield _sse("error", {"detail": str(e)})
+        return
+    finally:
+        app.state.pruner.mark(request.user_id)
+    yield _sse("done", {"response": "".join(tokens)})
+
+
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest):
+    # Server-sent events: node progress (node, route), then the generated tokens, then done
+    return StreamingResponse(
+        _stream_turn(request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/router/stats")
+async def router_stats():
+    # Routing decisions by reason (keyword, prototype, llm) and how often the LLM was needed
+    return memory_router.snapshot()
+
+
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Per-turn latency of the LangGraph workflow against local OpenAI/Pinecone
+stand-ins (OpenAI_Agent/backend/benchmarks/standins.py), no keys or network.
+
+Runs the same conversations through:
+- sequential: embed -> store -> router -> retrieve -> generate (the old topology)
+- parallel:   the workflow from api.build_workflow()
+and reports p50/p95 per turn and the latency saved.
+
+Usage:
+    python benchmarks/graph_benchmark.py --users 5 --turns 6 --upsert-latency 120:0.3:0
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STANDINS_DIR = os.path.join(os.path.dirname(APP_DIR), "OpenAI_Agent", "backend", "benchmarks")
+sys.path.insert(0, APP_DIR)
+sys.path.insert(0, STANDINS_DIR)
+
+from standins import LatencyProfile, StandInConfig, StandInServer
+
+MESSAGES = [
+    "Hi! My name is Sam and I live in Lisbon.",
+    "My favorite food is grilled sardines.",
+    "Can you explain how tides work?",
+    "What's my favorite food?",
+    "Write a haiku about the ocean.",
+    "Do you remember where I live?",
+]
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1)]
+
+
+def build_sequential_workflow():
+    """The pre-fan-out topology: every stage waits for the previous one."""
+    from langgraph.graph import StateGraph, END
+    from graph_state import GraphState
+    from langGraph_agent import (
+        embed_message_node, store_message_node, retrieve_memories_node,
+        generate_response_node, cap_state_node, should_retrieve_router,
+    )
+    workflow = StateGraph(GraphState)
+    workflow.add_node("embed_message", embed_message_node)
+    workflow.add_node("store_message", store_message_node)
+    workflow.add_node("retrieve", retrieve_memories_node)
+    workflow.add_node("generate", generate_response_node)
+    workflow.add_node("cap_state", cap_state_node)
+    workflow.set_entry_point("embed_message")
+    workflow.add_edge("embed_message", "store_message")
+    workflow.add_conditional_edges(
+        "store_message", should_retrieve_router, {"retrieve": "retrieve", "generate": "generate"},
+    )
+    workflow.add_edge("retrieve", "generate")
+    workflow.add_edge("generate", "cap_state")
+    workflow.add_edge("cap_state", END)
+    return workflow
+
+
+async def run_variant(graph, label: str, users: int, turns: int):
+    from langchain_core.messages import HumanMessage
+    durations = []
+    for user in range(users):
+        config = {"configurable": {"thread_id": f"{label}-user-{user}"}}
+        for turn in range(turns):
+            message = MESSAGES[turn % len(MESSAGES)]
+            start = time.perf_counter()
+            await graph.ainvoke({"messages": [HumanMessage(content=message)], "user_id": f"{label}-user-{user}"}, config)
+            durations.append((time.perf_counter() - start) * 1000)
+    return durations
+
+
+async def run_all(variants, users: int, turns: int, standins):
+    """
+    Run every variant in one event loop (the shared HTTP clients are bound to it).
+    Returns {label: (durations, embedding calls per turn)}.
+    """
+    from langGraph_agent import memory_router, close_clients
+    try:
+        # Embed the router prototypes up front so they are not charged to the first variant
+        await memory_router._prototype_embeddings()
+        results = {}
+        for label, graph in variants.items():
+            before = standins.snapshot()["calls"].get("embeddings", 0)
+            durations = await run_variant(graph, label, users, turns)
+            embeddings = standins.snapshot()["calls"].get("embeddings", 0) - before
+            results[label] = (durations, embeddings / len(durations))
+        return results
+    finally:
+        await close_clients()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sequential vs parallel LangGraph workflow latency")
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--turns", type=int, default=6)
+    parser.add_argument("--embed-latency", default="40:0.3:0", help="median_ms:sigma:error_rate")
+    parser.add_argument("--chat-latency", default="400:0.3:0", help="median_ms:sigma:error_rate")
+    parser.add_argument("--upsert-latency", default="120:0.3:0", help="median_ms:sigma:error_rate")
+    parser.add_argument("--query-latency", default="40:0.3:0", help="median_ms:sigma:error_rate")
+    args = parser.parse_args()
+
+    config = StandInConfig(
+        embeddings=LatencyProfile.parse(args.embed_latency),
+        chat=LatencyProfile.parse(args.chat_latency),
+        upsert=LatencyProfile.parse(args.upsert_latency),
+        query=LatencyProfile.parse(args.query_latency),
+    )
+    with StandInServer(config) as standins:
+        os.environ.update({
+            "OPENAI_API_KEY": "offline",
+            "PINECONE_API_KEY": "offline",
+            "OPENAI_BASE_URL": f"{standins.url}/v1",
+            "PINECONE_INDEX_HOST": standins.url,
+        })
+        from langgraph.checkpoint.memory import MemorySaver
+        import langGraph_agent
+        from api import build_workflow
+
+        # The stand-in embeds raw text; skip client-side tokenization (which downloads encodings)
+        langGraph_agent.pinecone_service.embeddings.check_embedding_ctx_length = False
+
+        variants = {
+            "sequential": build_sequential_workflow().compile(checkpointer=MemorySaver()),
+            "parallel": build_workflow().compile(checkpointer=MemorySaver()),
+        }
+        results = asyncio.run(run_all(variants, args.users, args.turns, standins))
+
+    print(f"\n{'variant':<12}{'turns':>7}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'embeds/turn':>13}")
+    for label, (durations, embeddings_per_turn) in results.items():
+        print(f"{label:<12}{len(durations):>7}{statistics.mean(durations):>10.1f}"
+              f"{percentile(durations, 50):>10.1f}{percentile(durations, 95):>10.1f}{embeddings_per_turn:>13.2f}")
+    saved = statistics.mean(results["sequential"][0]) - statistics.mean(results["parallel"][0])
+    print(f"\nSaved per turn: {saved:.1f} ms on average")
+
+
+if __name__ == "__main__":
+    main()
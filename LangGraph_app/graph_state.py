@@ -10,7 +10,9 @@ class GraphState(TypedDict):
     Attributes:
         messages: The list of messages that make up the conversation.
         user_id: The unique identifier for the user.
-        retrieved_memories: A list of relevant memories retrieved from Pinecone.
+        retrieved_memories: Relevant memories retrieved from Pinecone for the current turn (cleared by cap_state).
+        message_embedding: Embedding of the latest user message, computed once per turn (cleared by cap_state).
+        summary: Running summary of the messages already removed from 'messages'.
     """
     # The 'add_messages' function is a helper utility provided by LangGraph.
     # It ensures that new messages are always added to the existing list
@@ -18,4 +20,6 @@ class GraphState(TypedDict):
     messages: Annotated[list, add_messages]
     
     user_id: str
-    retrieved_memories: List[str]
\ No newline at end of file
+    retrieved_memories: List[str]
+    message_embedding: List[float]
+    summary: str
@@ -1,9 +1,12 @@
 import os
-from langchain.prompts import ChatPromptTemplate
-from langchain_core.messages import AIMessage, HumanMessage
+import hashlib
+import httpx
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.messages import AIMessage, HumanMessage, RemoveMessage
 from langchain_openai import ChatOpenAI
 # from pinecone_service import PineconeService
 from graph_state import GraphState
+from memory_router import MemoryRouter, ROUTER_LLM_MODEL
 
 from pinecone import Pinecone, ServerlessSpec
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
@@ -12,12 +15,26 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+# Size of the HTTP connection pool shared by all OpenAI clients in this process
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+
+# One keep-alive pool for the chat, router and embedding clients, shared across requests
+shared_http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS, max_keepalive_connections=OPENAI_MAX_CONNECTIONS),
+    timeout=httpx.Timeout(60.0, connect=5.0),
+)
+
 def initialize_pinecone_index():
+    """Make sure the index exists and return (client, data-plane host)."""
     PINECONE_API_KEY = os.environ["PINECONE_API_KEY"]
     INDEX_NAME = "chatbot-memory"
     VECTOR_DIM = 1536
     
     pc = Pinecone(api_key=PINECONE_API_KEY)
+
+    # A known data-plane host skips the control-plane lookups (also used by the benchmarks)
+    if os.getenv("PINECONE_INDEX_HOST"):
+        return pc, os.environ["PINECONE_INDEX_HOST"]
     
     if INDEX_NAME not in pc.list_indexes().names():
         pc.create_index(
@@ -31,70 +48,153 @@ def initialize_pinecone_index():
         )
         print(f"Connected to Pinecone index: {INDEX_NAME}")
     
-    return pc.Index(INDEX_NAME)
+    return pc, pc.describe_index(INDEX_NAME).host
+
+def vector_id(user_id: str, message: str) -> str:
+    """
+    Fixed-size (32 hex chars) id for a user's message. Deterministic, so
+    re-sending the same message overwrites its vector instead of duplicating it.
+    """
+    return hashlib.sha256(f"{user_id}\x00{message}".encode()).hexdigest()[:32]
 
 class PineconeService:
     def __init__(self):
-        self.embeddings = OpenAIEmbeddings(openai_api_key=os.environ["OPENAI_API_KEY"])
-        self.index = initialize_pinecone_index()
+        self.embeddings = OpenAIEmbeddings(
+            openai_api_key=os.environ["OPENAI_API_KEY"],
+            http_async_client=shared_http_client,
+        )
+        self.pc, self.index_host = initialize_pinecone_index()
+        self._index = None
 
-    def store_message(self, user_id: str, message: str):
-        embedding = self.embeddings.embed_query(message)
-        self.index.upsert(vectors=[{"id": f"{user_id}-{message}", "values": embedding, "metadata": {"user_id": user_id, "message": message}}])
+    @property
+    def index(self):
+        """Async data-plane client; created on first use and shared by all requests."""
+        if self._index is None:
+            self._index = self.pc.IndexAsyncio(host=self.index_host)
+        return self._index
 
-    def retrieve_memories(self, user_id: str, query: str, top_k: int = 5):
-        query_embedding = self.embeddings.embed_query(query)
-        results = self.index.query(vector=query_embedding, top_k=top_k, filter={"user_id": user_id}, include_metadata=True)
+    async def store_message(self, user_id: str, message: str, embedding=None):
+        if embedding is None:
+            embedding = await self.embeddings.aembed_query(message)
+        await self.index.upsert(vectors=[{"id": vector_id(user_id, message), "values": embedding, "metadata": {"user_id": user_id, "message": message}}])
+        return embedding
+
+    async def retrieve_memories(self, user_id: str, query: str, top_k: int = 5, embedding=None):
+        query_embedding = embedding if embedding is not None else await self.embeddings.aembed_query(query)
+        results = await self.index.query(vector=query_embedding, top_k=top_k, filter={"user_id": user_id}, include_metadata=True)
         return [match.metadata['message'] for match in results.matches if hasattr(match, 'metadata') and match.metadata]
 
+    async def aclose(self):
+        if self._index is not None:
+            await self._index.close()
+            self._index = None
+
+# Hard cap on messages kept in the checkpointed state of one thread;
+# older turns stay searchable in Pinecone
+MAX_STATE_MESSAGES = int(os.getenv("MAX_STATE_MESSAGES", "50"))
+# Recent messages always sent to the model verbatim
+SUMMARY_KEEP_MESSAGES = int(os.getenv("SUMMARY_KEEP_MESSAGES", "12"))
+# Older messages are folded into the summary once this many have piled up,
+# so the summarizer runs every few turns rather than every turn
+SUMMARY_BATCH_MESSAGES = int(os.getenv("SUMMARY_BATCH_MESSAGES", "8"))
+SUMMARY_MAX_WORDS = int(os.getenv("SUMMARY_MAX_WORDS", "250"))
+SUMMARY_LLM_MODEL = os.getenv("SUMMARY_LLM_MODEL", "gpt-4o-mini")
+
 # Initialize services and models
 pinecone_service = PineconeService()
-llm = ChatOpenAI(temperature=0.1, model="gpt-4o-mini", openai_api_key=os.environ["OPENAI_API_KEY"])
+llm = ChatOpenAI(
+    temperature=0.1, model="gpt-4o-mini", openai_api_key=os.environ["OPENAI_API_KEY"],
+    http_async_client=shared_http_client,
+)
+summary_llm = ChatOpenAI(
+    temperature=0, model=SUMMARY_LLM_MODEL, openai_api_key=os.environ["OPENAI_API_KEY"],
+    http_async_client=shared_http_client,
+)
+memory_router = MemoryRouter(
+    embeddings=pinecone_service.embeddings,
+    llm_factory=lambda: ChatOpenAI(
+        temperature=0, model=ROUTER_LLM_MODEL, openai_api_key=os.environ["OPENAI_API_KEY"],
+        http_async_client=shared_http_client,
+    ),
+)
+
+# Built once and shared by /chat and /chat/stream
+GENERATION_PROMPT = """You are a helpful chatbot with memory. Your user ID is {user_id}.
+
+Summary of the earlier conversation:
+<summary>
+{summary}
+</summary>
+
+Use the following retrieved memories to enhance your response if they are relevant:
+<memories>
+{memories}
+</memories>
+
+Respond to the last user message in the conversation below.
+
+{messages}
+"""
+generation_chain = ChatPromptTemplate.from_template(GENERATION_PROMPT) | llm
+
+async def close_clients():
+    """Close the shared connection pools (called on application shutdown)."""
+    await pinecone_service.aclose()
+    await shared_http_client.aclose()
 
 # --- Graph Nodes ---
-def store_message_node(state: GraphState):
+async def embed_message_node(state: GraphState):
+    """
+    Embeds the user's message once. Storage and routing both read the
+    embedding from the state, so they can run in parallel.
+    """
+    print("---NODE: EMBEDDING MESSAGE---")
+    last_message = state["messages"][-1]
+    if isinstance(last_message, HumanMessage):
+        return {"message_embedding": await pinecone_service.embeddings.aembed_query(last_message.content)}
+    return {"message_embedding": []}
+
+async def store_message_node(state: GraphState):
     """
     Stores the user's message in Pinecone.
     The user's message is the last one in the 'messages' list.
+    Runs alongside routing/retrieval/generation; nothing downstream reads it.
     """
     print("---NODE: STORING MESSAGE---")
     last_message = state["messages"][-1]
     if isinstance(last_message, HumanMessage):
-        pinecone_service.store_message(user_id=state["user_id"], message=last_message.content)
+        await pinecone_service.store_message(
+            user_id=state["user_id"],
+            message=last_message.content,
+            embedding=state.get("message_embedding") or None,
+        )
     return {}
 
-def retrieve_memories_node(state: GraphState):
+async def retrieve_memories_node(state: GraphState):
     """
-    Retrieves memories from Pinecone based on the latest user message.
+    Retrieves memories from Pinecone based on the latest user message,
+    querying with the embedding computed by embed_message.
     """
     print("---NODE: RETRIEVING MEMORIES---")
     last_message = state["messages"][-1]
-    memories = pinecone_service.retrieve_memories(user_id=state["user_id"], query=last_message.content)
+    memories = await pinecone_service.retrieve_memories(
+        user_id=state["user_id"],
+        query=last_message.content,
+        embedding=state.get("message_embedding") or None,
+    )
     return {"retrieved_memories": memories}
 
-def generate_response_node(state: GraphState):
+async def generate_response_node(state: GraphState):
     """
     Generates a response using the LLM, potentially with retrieved memories as context.
     The response is returned as an AIMessage to be added to the state.
     """
     print("---NODE: GENERATING RESPONSE---")
-    prompt_template = """You are a helpful chatbot with memory. Your user ID is {user_id}.
-
-Use the following retrieved memories to enhance your response if they are relevant:
-<memories>
-{memories}
-</memories>
-
-Respond to the last user message in the conversation below.
-
-{messages}
-"""
-    prompt = ChatPromptTemplate.from_template(prompt_template)
-    chain = prompt | llm
-
-    # The entire message history is now passed to the LLM
-    response = chain.invoke({
+    # Older turns live in the summary; the state only holds the unsummarized tail
+    # (at most SUMMARY_KEEP_MESSAGES + SUMMARY_BATCH_MESSAGES + the new message)
+    response = await generation_chain.ainvoke({
         "user_id": state["user_id"],
+        "summary": state.get("summary", ""),
         "memories": "\n".join(state.get("retrieved_memories", [])), # <-- THE FIX
         "messages": state["messages"]
     })
@@ -103,29 +203,73 @@ Respond to the last user message in the conversation below.
     return {"messages": [AIMessage(content=response.content)]}
 
 
+def _format_transcript(messages) -> str:
+    return "\n".join(
+        f"{'User' if isinstance(message, HumanMessage) else 'Assistant'}: {message.content}"
+        for message in messages
+    )
+
+async def summarize_history_node(state: GraphState):
+    """
+    Folds the messages older than the last SUMMARY_KEEP_MESSAGES into the
+    running summary and removes them from the state. Only the new messages
+    are sent with the previous summary, so the summary is extended rather
+    than rebuilt. Runs in parallel with generation, which reads the summary
+    and messages as they were at the start of the turn.
+    """
+    overflow = len(state["messages"]) - SUMMARY_KEEP_MESSAGES
+    if overflow < SUMMARY_BATCH_MESSAGES:
+        return {}
+    print(f"---NODE: SUMMARIZING HISTORY (folding {overflow} messages)---")
+    folded = state["messages"][:overflow]
+    prompt = f"""Update the summary of a conversation between a user and an assistant.
+
+Current summary:
+{state.get("summary") or "(empty)"}
+
+New messages to add:
+{_format_transcript(folded)}
+
+Keep facts about the user (names, preferences, plans) and open questions. Reply with the updated summary only, at most {SUMMARY_MAX_WORDS} words."""
+    try:
+        response = await summary_llm.ainvoke(prompt)
+    except Exception as e:
+        # Keep the messages; the next turn tries again and cap_state still bounds the state
+        print(f"---SUMMARY FAILED: {str(e)}---")
+        return {}
+    return {
+        "summary": response.content.strip(),
+        "messages": [RemoveMessage(id=message.id) for message in folded],
+    }
+
+
+async def cap_state_node(state: GraphState):
+    """
+    Bounds what the checkpoint keeps after each turn: the per-turn fields
+    (the message embedding and the retrieved memories) are cleared, and the
+    oldest messages are removed once the thread holds more than
+    MAX_STATE_MESSAGES, so the stored state does not grow without bound.
+    Clearing retrieved_memories also keeps a turn that skips retrieval from
+    seeing the previous turn's memories.
+    """
+    update = {"message_embedding": [], "retrieved_memories": []}
+    overflow = len(state["messages"]) - MAX_STATE_MESSAGES
+    if overflow > 0:
+        print(f"---NODE: CAPPING STATE (dropping {overflow} messages)---")
+        update["messages"] = [RemoveMessage(id=message.id) for message in state["messages"][:overflow]]
+    return update
+
+
 # --- Conditional Router ---
 
-def should_retrieve_router(state: GraphState):
+async def should_retrieve_router(state: GraphState):
     """
     A router that decides whether to retrieve memories or go straight to generation.
+    Uses the local classifier in memory_router and only calls an LLM for ambiguous messages.
     """
     print("---ROUTER: SHOULD RETRIEVE?---")
     if len(state["messages"]) <= 1: # If it's the first message, no need to retrieve
-        print("---DECISION: NO (first message)---")
-        return "generate"
+        return memory_router.record_first_message()
     
     last_message = state["messages"][-1]
-    prompt = f"""Given the conversation history and the user's latest message, should I retrieve past memories to answer the user's question?
-The user's latest message is: '{last_message.content}'
-
-Answer with only 'yes' or 'no'."""
-    
-    router_llm = ChatOpenAI(temperature=0, model="gpt-3.5-turbo", openai_api_key=os.environ["OPENAI_API_KEY"])
-    response = router_llm.invoke(prompt)
-    
-    if "yes" in response.content.lower():
-        print("---DECISION: YES---")
-        return "retrieve"
-    else:
-        print("---DECISION: NO---")
-        return "generate"
\ No newline at end of file
+    return await memory_router.route(last_message.content, state.get("message_embedding"))
@@ -0,0 +1,160 @@
+import os
+import re
+import math
+import asyncio
+import threading
+from collections import Counter, OrderedDict
+from typing import List, Optional, Tuple
+
+# Minimum gap between the best "retrieve" and best "generate" prototype similarity
+# before the local decision is trusted; smaller gaps go to the LLM
+ROUTER_CONFIDENCE_MARGIN = float(os.getenv("ROUTER_CONFIDENCE_MARGIN", "0.05"))
+ROUTER_LLM_MODEL = os.getenv("ROUTER_LLM_MODEL", "gpt-3.5-turbo")
+ROUTER_CACHE_SIZE = int(os.getenv("ROUTER_CACHE_SIZE", "1024"))
+
+# Phrases that always need past context
+RETRIEVE_KEYWORDS = re.compile(
+    r"\b(remember|recall|remind me|mentioned|discussed|we talked|last time|"
+    r"my favou?rite|what do i|what did i|what's my|what is my|do you know my|tell me about me|about myself)\b",
+    re.IGNORECASE,
+)
+# Short messages that never need past context
+SMALL_TALK = re.compile(
+    r"^\s*(hi|hello|hey|thanks|thank you|thx|ok|okay|cool|great|nice|bye|goodbye|good (morning|night))[\s!.?]*$",
+    re.IGNORECASE,
+)
+
+RETRIEVE_PROTOTYPES = [
+    "What did I tell you about my family?",
+    "Do you remember what we talked about yesterday?",
+    "What's my favorite food?",
+    "Remind me what I said my plans were.",
+    "Based on what you know about me, what should I do?",
+    "Can you recall the name of my pet?",
+]
+GENERATE_PROTOTYPES = [
+    "Explain how photosynthesis works.",
+    "Write a short poem about the ocean.",
+    "What is the capital of France?",
+    "Translate this sentence into Spanish.",
+    "Give me a recipe for pancakes.",
+    "How do I reverse a list in Python?",
+]
+
+
+def _cosine(a: List[float], b: List[float]) -> float:
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return sum(x * y for x, y in zip(a, b)) / norm if norm else 0.0
+
+
+class MemoryRouter:
+    """
+    Decides whether a message needs memory retrieval without a network call
+    in the common case:
+
+    1. keyword rules (memory phrases -> retrieve, small talk -> generate)
+    2. nearest prototype by cosine similarity, reusing the message embedding
+       already computed when the message was stored
+    3. only when the prototype margin is below the confidence threshold, one
+       shared LLM router, with its answers cached per normalized message
+
+    Decision counts are kept in `stats` for monitoring.
+    """
+
+    def __init__(self, embeddings, llm_factory, margin: float = ROUTER_CONFIDENCE_MARGIN,
+                 cache_size: int = ROUTER_CACHE_SIZE):
+        self.embeddings = embeddings
+        self.llm_factory = llm_factory
+        self.margin = margin
+        self.cache_size = cache_size
+        self.stats = Counter()
+        self._llm = None
+        self._prototypes: Optional[Tuple[List[List[float]], List[List[float]]]] = None
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._prototype_lock: Optional[asyncio.Lock] = None
+
+    @property
+    def llm(self):
+        """The fallback LLM, created once and shared by all requests."""
+        if self._llm is None:
+            with self._lock:
+                if self._llm is None:
+                    self._llm = self.llm_factory()
+        return self._llm
+
+    async def _prototype_embeddings(self):
+        if self._prototypes is None:
+            if self._prototype_lock is None:
+                self._prototype_lock = asyncio.Lock()
+            async with self._prototype_lock:
+                if self._prototypes is None:
+                    vectors = await self.embeddings.aembed_documents(RETRIEVE_PROTOTYPES + GENERATE_PROTOTYPES)
+                    split = len(RETRIEVE_PROTOTYPES)
+                    self._prototypes = (vectors[:split], vectors[split:])
+        return self._prototypes
+
+    def _record(self, reason: str, decision: str) -> str:
+        with self._lock:
+            self.stats[f"{reason}_{decision}"] += 1
+            self.stats[decision] += 1
+            self.stats["total"] += 1
+        print(f"---DECISION: {decision.upper()} ({reason})---")
+        return decision
+
+    async def classify_locally(self, message: str, embedding: Optional[List[float]]) -> Tuple[Optional[str], str]:
+        """Return (decision or None when ambiguous, reason)."""
+        if RETRIEVE_KEYWORDS.search(message):
+            return "retrieve", "keyword"
+        if SMALL_TALK.match(message):
+            return "generate", "keyword"
+        if not embedding:
+            return None, "no_embedding"
+        retrieve_protos, generate_protos = await self._prototype_embeddings()
+        retrieve_score = max(_cosine(embedding, proto) for proto in retrieve_protos)
+        generate_score = max(_cosine(embedding, proto) for proto in generate_protos)
+        if abs(retrieve_score - generate_score) < self.margin:
+            return None, "ambiguous"
+        return ("retrieve" if retrieve_score > generate_score else "generate"), "prototype"
+
+    async def _ask_llm(self, message: str) -> str:
+        key = " ".join(message.lower().split())
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.stats["llm_cache_hits"] += 1
+                return self._cache[key]
+
+        prompt = f"""Given the conversation history and the user's latest message, should I retrieve past memories to answer the user's question?
+The user's latest message is: '{message}'
+
+Answer with only 'yes' or 'no'."""
+        response = await self.llm.ainvoke(prompt)
+        decision = "retrieve" if "yes" in response.content.lower() else "generate"
+
+        with self._lock:
+            self._cache[key] = decision
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return decision
+
+    def record_first_message(self) -> str:
+        """A conversation's first message has nothing to retrieve; counted like any other decision."""
+        return self._record("first_message", "generate")
+
+    async def route(self, message: str, embedding: Optional[List[float]] = None) -> str:
+        decision, reason = await self.classify_locally(message, embedding)
+        if decision is not None:
+            return self._record(reason, decision)
+        return self._record("llm", await self._ask_llm(message))
+
+    def snapshot(self) -> dict:
+        """Counters plus the share of decisions that needed the LLM."""
+        with self._lock:
+            stats = dict(self.stats)
+        total = stats.get("total", 0)
+        fallbacks = stats.get("llm_retrieve", 0) + stats.get("llm_generate", 0)
+        return {
+            "decisions": stats,
+            "llm_fallback_rate": round(fallbacks / total, 4) if total else 0.0,
+        }
@@ -0,0 +1 @@
+# Tests package for the LangGraph memory chatbot
@@ -0,0 +1,68 @@
+"""
+Tests for checkpoint pruning
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+from typing import TypedDict
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langgraph.checkpoint.memory import InMemorySaver
+from langgraph.graph import END, StateGraph
+
+from checkpointer import CheckpointPruner, open_checkpointer
+
+
+class CounterState(TypedDict):
+    count: int
+
+
+def build_counter_graph():
+    """One node per turn, so every invoke writes a few checkpoints"""
+    workflow = StateGraph(CounterState)
+    workflow.add_node("increment", lambda state: {"count": state["count"] + 1})
+    workflow.set_entry_point("increment")
+    workflow.add_edge("increment", END)
+    return workflow
+
+
+async def count_checkpoints(saver, thread_id: str) -> int:
+    return len([checkpoint async for checkpoint in saver.alist({"configurable": {"thread_id": thread_id}})])
+
+
+def test_sqlite_pruner_keeps_last_checkpoints():
+    """Test pruning a marked thread leaves exactly keep_last checkpoints and its latest state"""
+    async def run_turns(path):
+        async with open_checkpointer(f"sqlite:///{path}") as saver:
+            graph = build_counter_graph().compile(checkpointer=saver)
+            pruner = CheckpointPruner(saver, keep_last=2)
+            for thread_id in ("pruned", "untouched"):
+                for count in range(4):
+                    await graph.ainvoke({"count": count * 10}, {"configurable": {"thread_id": thread_id}})
+            assert await count_checkpoints(saver, "pruned") > 2
+            
+            pruner.mark("pruned")
+            await pruner.run_once()
+            
+            state = await graph.aget_state({"configurable": {"thread_id": "pruned"}})
+            return (await count_checkpoints(saver, "pruned"), await count_checkpoints(saver, "untouched"),
+                    state.values["count"])
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        pruned, untouched, count = asyncio.run(run_turns(os.path.join(temp_dir, "checkpoints.db")))
+    
+    assert pruned == 2
+    assert untouched > 2
+    assert count == 31
+
+
+def test_pruner_refuses_keep_last_it_cannot_honor():
+    """Test savers without keep-last-N pruning fail at startup instead of keeping only one checkpoint"""
+    with pytest.raises(ValueError, match="CHECKPOINT_KEEP_LAST=3"):
+        CheckpointPruner(InMemorySaver(), keep_last=3)
+    assert CheckpointPruner(InMemorySaver(), keep_last=1).keep_last == 1
@@ -0,0 +1,154 @@
+"""
+Tests for the memory router: keyword rules, prototype similarity and the
+cached LLM fallback
+"""
+
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# langGraph_agent builds its clients at import; a known index host keeps that offline
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("PINECONE_API_KEY", "test")
+os.environ.setdefault("PINECONE_INDEX_HOST", "http://127.0.0.1:9")
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+import langGraph_agent
+from memory_router import GENERATE_PROTOTYPES, RETRIEVE_PROTOTYPES, MemoryRouter
+
+RETRIEVE_DIRECTION = [1.0, 0.0]
+GENERATE_DIRECTION = [0.0, 1.0]
+
+
+class FakeEmbeddings:
+    """Retrieve prototypes point one way, generate prototypes the other"""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def aembed_documents(self, texts):
+        self.calls += 1
+        return [RETRIEVE_DIRECTION] * len(RETRIEVE_PROTOTYPES) + [GENERATE_DIRECTION] * len(GENERATE_PROTOTYPES)
+
+
+class FakeLLM:
+    def __init__(self, answer: str = "Yes"):
+        self.answer = answer
+        self.prompts = []
+
+    async def ainvoke(self, prompt):
+        self.prompts.append(prompt)
+        return SimpleNamespace(content=self.answer)
+
+
+@pytest.fixture
+def llm():
+    return FakeLLM()
+
+
+@pytest.fixture
+def router(llm):
+    """Router whose LLM factory hands out the one fake LLM and counts calls"""
+    embeddings = FakeEmbeddings()
+    factory_calls = []
+
+    def factory():
+        factory_calls.append(1)
+        return llm
+
+    router = MemoryRouter(embeddings, factory, margin=0.05, cache_size=2)
+    router.factory_calls = factory_calls
+    return router
+
+
+def test_keyword_rules_decide_without_embedding_or_llm(router, llm):
+    """Test memory phrases retrieve and small talk generates with no network work"""
+    assert asyncio.run(router.route("Do you remember my dog's name?")) == "retrieve"
+    assert asyncio.run(router.route("Thanks!")) == "generate"
+    
+    assert router.embeddings.calls == 0
+    assert llm.prompts == []
+    assert router.snapshot()["decisions"] == {
+        "keyword_retrieve": 1, "retrieve": 1, "keyword_generate": 1, "generate": 1, "total": 2,
+    }
+
+
+def test_prototype_similarity_decides_clear_cases(router, llm):
+    """Test the message embedding is compared with the prototypes, embedded once"""
+    assert asyncio.run(router.route("Where was I born again?", [0.9, 0.1])) == "retrieve"
+    assert asyncio.run(router.route("Summarize the French revolution", [0.2, 0.8])) == "generate"
+    
+    assert router.embeddings.calls == 1
+    assert llm.prompts == []
+    assert router.stats["prototype_retrieve"] == 1
+    assert router.stats["prototype_generate"] == 1
+
+
+def test_ambiguous_messages_use_cached_llm(router, llm):
+    """Test ambiguous or unembedded messages go to one shared LLM whose answers are cached"""
+    assert asyncio.run(router.route("Tell me something", [0.5, 0.5])) == "retrieve"
+    # Same message after normalization: answered from the cache
+    assert asyncio.run(router.route("  tell ME   something ", [0.5, 0.5])) == "retrieve"
+    llm.answer = "No"
+    assert asyncio.run(router.route("Anything new?")) == "generate"
+    
+    assert len(llm.prompts) == 2
+    assert len(router.factory_calls) == 1
+    assert router.stats["llm_cache_hits"] == 1
+    snapshot = router.snapshot()
+    assert snapshot["decisions"]["llm_retrieve"] == 2
+    assert snapshot["decisions"]["llm_generate"] == 1
+    assert snapshot["llm_fallback_rate"] == 1.0
+
+
+def test_llm_cache_evicts_least_recently_used(router, llm):
+    """Test the cache keeps cache_size entries, evicting the least recently used"""
+    for message in ["first question", "second question", "first question", "third question"]:
+        asyncio.run(router.route(message))
+    assert len(llm.prompts) == 3
+    
+    asyncio.run(router.route("first question"))
+    assert len(llm.prompts) == 3
+    asyncio.run(router.route("second question"))
+    assert len(llm.prompts) == 4
+
+
+def test_first_message_counts_as_decision(router):
+    """Test the first message of a thread goes to generation and counts toward the rates"""
+    assert router.record_first_message() == "generate"
+    asyncio.run(router.route("Something ambiguous"))
+    
+    snapshot = router.snapshot()
+    assert snapshot["decisions"]["first_message_generate"] == 1
+    assert snapshot["decisions"]["total"] == 2
+    assert snapshot["llm_fallback_rate"] == 0.5
+
+
+def test_graph_router_uses_memory_router(router, monkeypatch):
+    """Test should_retrieve_router records the first message through the router and routes later ones"""
+    monkeypatch.setattr(langGraph_agent, "memory_router", router)
+    first = {"messages": [HumanMessage(content="What's my name?")], "user_id": "u"}
+    later = {"messages": [HumanMessage(content="Hi"), AIMessage(content="Hello"), HumanMessage(content="What's my name?")],
+             "user_id": "u", "message_embedding": []}
+    
+    assert asyncio.run(langGraph_agent.should_retrieve_router(first)) == "generate"
+    assert asyncio.run(langGraph_agent.should_retrieve_router(later)) == "retrieve"
+    assert router.snapshot()["decisions"]["total"] == 2
+
+
+def test_cap_state_clears_turn_fields_and_caps_messages(monkeypatch):
+    """Test cap_state empties the per-turn fields and drops the oldest messages over the cap"""
+    monkeypatch.setattr(langGraph_agent, "MAX_STATE_MESSAGES", 3)
+    messages = [HumanMessage(content=f"Message {i}", id=str(i)) for i in range(5)]
+    update = asyncio.run(langGraph_agent.cap_state_node({
+        "messages": messages, "message_embedding": [0.1], "retrieved_memories": ["old memory"],
+    }))
+    
+    assert update["message_embedding"] == []
+    assert update["retrieved_memories"] == []
+    assert [message.id for message in update["messages"]] == ["0", "1"]
@@ -2,22 +2,34 @@
 Minimal production-ready chatbot API with memory using Pinecone.
 """
 import os
+import hmac
+import uuid
 import json
 import time
+import hashlib
+import tempfile
+import weakref
 import uvicorn
 import asyncio
-from datetime import datetime
-from typing import List, Dict, Any, Optional, Tuple
-from pydantic import BaseModel, Field, field_validator
-from fastapi import FastAPI, HTTPException, Depends
+from collections import Counter, deque
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Deque, Iterator, List, Dict, Any, Literal, Optional, Tuple
+from pydantic import BaseModel, Field, ValidationError, field_validator
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, Float
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, Float, UniqueConstraint, func, insert, text
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
 from dotenv import load_dotenv
 
 # Import the Memory Agent functionality
-from my_agent import process_query_with_memory, memory_service
+from my_agent import (AGENT_HISTORY_MESSAGES, MEMORY_SCORE_THRESHOLD, MemoryStats, UserMemoryStats,
+                      process_query_with_memory, stream_query_with_memory, memory_service)
+from model_router import tier_stats
+from latency_budget import LatencyBudget
 
 # -----------------------------------
 # Environment and Configuration Setup
@@ -48,8 +60,108 @@ class ChatMessage(Base):
     message = Column(Text, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
 
-# Create tables
-Base.metadata.create_all(bind=engine)
+class ChatRevision(Base):
+    """
+    Per-chat counter bumped by every change to its messages (saves, imports,
+    clears, purges). It is never reset, so history ETags do not repeat after
+    deletes, even when SQLite reuses message ids.
+    """
+    __tablename__ = "chat_revisions"
+
+    chat_id = Column(String, primary_key=True)
+    revision = Column(Integer, nullable=False)
+
+class IdempotencyRecord(Base):
+    """A /chat request identified by its Idempotency-Key, pending or with its stored response"""
+    __tablename__ = "idempotency_records"
+    __table_args__ = (UniqueConstraint("user_id", "key", name="uq_idempotency_user_key"),)
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(String, nullable=False)
+    key = Column(String, nullable=False)
+    fingerprint = Column(String, nullable=False)
+    status = Column(String, nullable=False)  # "pending" or "completed"
+    response = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    heartbeat_at = Column(DateTime, default=datetime.utcnow)  # renewed by the worker running a pending request
+
+class PurgeJob(Base):
+    """A background purge of users' history and memories, polled via GET /admin/purge/{job_id}"""
+    __tablename__ = "purge_jobs"
+
+    id = Column(String, primary_key=True)
+    status = Column(String, nullable=False)  # "running" or "completed"
+    users_total = Column(Integer, nullable=False)
+    users_done = Column(Integer, nullable=False, default=0)
+    users_failed = Column(Integer, nullable=False, default=0)
+    rows_deleted = Column(Integer, nullable=False, default=0)
+    vectors_deleted = Column(Integer, nullable=False, default=0)
+    errors = Column(Text, nullable=True)  # JSON {user_id: error}
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+class UserLeaseRecord(Base):
+    """
+    The per-user turn lease. The row is kept after release so the fencing
+    token keeps increasing for the user.
+    """
+    __tablename__ = "user_leases"
+
+    user_id = Column(String, primary_key=True)
+    holder = Column(String, nullable=True)  # random id of the current acquisition
+    token = Column(Integer, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+class MemoryVectorRecord(Base):
+    """One vector in Pinecone memory, keyed by its vector id, so per-user memory stats need no index scan"""
+    __tablename__ = "memory_vectors"
+
+    id = Column(String, primary_key=True)
+    user_id = Column(String, index=True, nullable=False)
+    message_type = Column(String, nullable=False)
+    timestamp = Column(Integer, nullable=False)
+    bytes = Column(Integer, nullable=False)
+
+class MemoryRetrievalStats(Base):
+    """Per-user retrieval counters"""
+    __tablename__ = "memory_retrieval_stats"
+
+    user_id = Column(String, primary_key=True)
+    retrievals = Column(Integer, nullable=False, default=0)
+    retrieval_hits = Column(Integer, nullable=False, default=0)
+    cache_hits = Column(Integer, nullable=False, default=0)
+    score_sum = Column(Float, nullable=False, default=0.0)
+    scores = Column(Integer, nullable=False, default=0)
+
+# Workers of one host starting together take this file lock so that one
+# creates the schema and the others find it in place
+SCHEMA_LOCK_PATH = os.path.join(
+    tempfile.gettempdir(), f"chat-schema-{hashlib.sha256(DATABASE_URL.encode()).hexdigest()[:16]}.lock")
+SCHEMA_CREATE_ATTEMPTS = 3
+
+def init_db() -> None:
+    """
+    Create tables if they do not exist yet (run from the startup hook of
+    every worker). Workers on this host serialize on SCHEMA_LOCK_PATH; a
+    table another host created between the existence check and the CREATE
+    ("already exists") counts as created, and the remaining tables are
+    created on the next attempt.
+    """
+    try:
+        import fcntl
+    except ImportError:  # no flock (Windows): rely on the "already exists" retry
+        fcntl = None
+    with open(SCHEMA_LOCK_PATH, "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)  # released when the file closes
+        for attempt in range(1, SCHEMA_CREATE_ATTEMPTS + 1):
+            try:
+                Base.metadata.create_all(bind=engine)
+                return
+            except OperationalError as e:
+                if "already exists" not in str(e) or attempt == SCHEMA_CREATE_ATTEMPTS:
+                    raise
+                print(f"Schema created concurrently, checking again: {str(e.orig)}")
 
 # Dependency to get DB session
 def get_db():
@@ -65,11 +177,222 @@ def load_conversation_history(chat_id: str, db: Session) -> List[Tuple[str, str]
     messages = db.query(ChatMessage).filter(ChatMessage.chat_id == chat_id).order_by(ChatMessage.created_at).all()
     return [(msg.speaker, msg.message) for msg in messages]
 
-def save_message(chat_id: str, speaker: str, message: str, db: Session) -> None:
-    """Save a chat message to the database."""
-    new_msg = ChatMessage(chat_id=chat_id, speaker=speaker, message=message)
-    db.add(new_msg)
-    db.commit()
+def load_history_page(chat_id: str, db: Session, limit: int,
+                      before_id: Optional[int] = None) -> Tuple[List[ChatMessage], bool]:
+    """
+    The newest `limit` messages with id below before_id, oldest first, and
+    whether older messages exist. Ids increase with insertion, so they double
+    as a stable cursor.
+    """
+    query = db.query(ChatMessage).filter(ChatMessage.chat_id == chat_id)
+    if before_id is not None:
+        query = query.filter(ChatMessage.id < before_id)
+    rows = query.order_by(ChatMessage.id.desc()).limit(limit + 1).all()
+    return list(reversed(rows[:limit])), len(rows) > limit
+
+def load_recent_history(chat_id: str, db: Session, limit: int = AGENT_HISTORY_MESSAGES) -> List[Tuple[str, str]]:
+    """The last `limit` messages of a chat, oldest first; what the agent sees each turn."""
+    rows, _ = load_history_page(chat_id, db, limit)
+    return [(row.speaker, row.message) for row in rows]
+
+def load_history_since(chat_id: str, db: Session, since_id: int,
+                       limit: Optional[int] = None) -> Tuple[List[ChatMessage], bool]:
+    """Messages with id above since_id, oldest first (at most `limit`), and whether more follow."""
+    query = db.query(ChatMessage).filter(ChatMessage.chat_id == chat_id, ChatMessage.id > since_id).order_by(ChatMessage.id)
+    if limit is None:
+        return query.all(), False
+    rows = query.limit(limit + 1).all()
+    return rows[:limit], len(rows) > limit
+
+def history_version(chat_id: str, db: Session) -> Tuple[Optional[int], int]:
+    """(newest message id, message count) of a chat, read from the chat_id index."""
+    newest, count = db.query(func.max(ChatMessage.id), func.count(ChatMessage.id)).filter(ChatMessage.chat_id == chat_id).one()
+    return newest, count
+
+def chat_revision(chat_id: str, db: Session) -> int:
+    """The chat's revision (0 before its first change)."""
+    return db.query(ChatRevision.revision).filter(ChatRevision.chat_id == chat_id).scalar() or 0
+
+def bump_revision(chat_id: str, db: Session, changes: int = 1) -> None:
+    """Advance the chat's revision in the caller's transaction; the caller commits."""
+    if not db.query(ChatRevision).filter(ChatRevision.chat_id == chat_id).update(
+            {"revision": ChatRevision.revision + changes}, synchronize_session=False):
+        db.add(ChatRevision(chat_id=chat_id, revision=changes))
+
+def recent_user_queries(db: Session, users: int, per_user: int, scan_limit: int = 50000) -> Dict[str, List[str]]:
+    """
+    The latest User messages of the most recently active users, newest
+    first, from a bounded scan of the newest rows.
+    """
+    queries: Dict[str, List[str]] = {}
+    rows = db.query(ChatMessage.chat_id, ChatMessage.message).filter(ChatMessage.speaker == "User") \
+        .order_by(ChatMessage.id.desc()).limit(scan_limit).yield_per(1000)
+    for chat_id, message in rows:
+        if chat_id not in queries and len(queries) >= users:
+            continue
+        user_queries = queries.setdefault(chat_id, [])
+        if len(user_queries) < per_user:
+            user_queries.append(message)
+        if len(queries) >= users and all(len(found) >= per_user for found in queries.values()):
+            break
+    return queries
+
+def save_message(chat_id: str, speaker: str, message: str, db: Session,
+                 lease: Optional["UserLease"] = None) -> int:
+    """
+    Save a chat message to the database; returns its id. With a lease the
+    insert commits only while the lease is still held (see UserLease.fence).
+    """
+    for attempt in range(2):
+        if lease is not None:
+            lease.fence(db)
+        new_msg = ChatMessage(chat_id=chat_id, speaker=speaker, message=message)
+        db.add(new_msg)
+        bump_revision(chat_id, db)
+        try:
+            db.flush()
+            message_id = new_msg.id
+            db.commit()
+            return message_id
+        except IntegrityError:
+            # The chat's revision row was created concurrently; the retry updates it
+            db.rollback()
+            if attempt:
+                raise
+
+# -----------------------------------
+# Memory Statistics
+# -----------------------------------
+
+class DatabaseMemoryStats(MemoryStats):
+    """
+    Memory stats kept in the chat database, so they survive restarts and are
+    the same on every worker. Stored vectors are recorded by id, which makes
+    re-stores and backfill re-runs overwrite instead of double counting;
+    counts come from aggregating the user's rows. Recording never fails a
+    memory write: database errors are logged.
+    """
+
+    def __init__(self, session_factory):
+        self._sessions = session_factory
+
+    def record_stores(self, records: List[dict]) -> None:
+        rows = {}
+        for record in records:
+            metadata = record["metadata"]
+            rows[record["id"]] = dict(
+                id=record["id"], user_id=metadata["user_id"], message_type=metadata["message_type"],
+                timestamp=int(metadata["timestamp"]), bytes=len(metadata["message"].encode())
+            )
+        try:
+            with self._sessions() as db:
+                existing = {vector_id for vector_id, in db.query(MemoryVectorRecord.id).filter(MemoryVectorRecord.id.in_(rows))}
+                db.add_all(MemoryVectorRecord(**row) for vector_id, row in rows.items() if vector_id not in existing)
+                try:
+                    db.commit()
+                except IntegrityError:
+                    # Another worker recorded some of them first
+                    db.rollback()
+                    for row in rows.values():
+                        db.merge(MemoryVectorRecord(**row))
+                    db.commit()
+        except Exception as e:
+            print(f"Recording memory stores failed: {str(e)}")
+
+    def record_retrieval(self, user_id: str, scores: List[float], hits: int, cached: bool = False) -> None:
+        increments = {
+            "retrievals": MemoryRetrievalStats.retrievals + 1,
+            "retrieval_hits": MemoryRetrievalStats.retrieval_hits + (1 if hits else 0),
+            "cache_hits": MemoryRetrievalStats.cache_hits + (1 if cached else 0),
+            "score_sum": MemoryRetrievalStats.score_sum + sum(scores),
+            "scores": MemoryRetrievalStats.scores + len(scores),
+        }
+        try:
+            with self._sessions() as db:
+                for _ in range(2):
+                    if db.query(MemoryRetrievalStats).filter(MemoryRetrievalStats.user_id == user_id).update(
+                            increments, synchronize_session=False):
+                        db.commit()
+                        return
+                    db.add(MemoryRetrievalStats(user_id=user_id, retrievals=1, retrieval_hits=1 if hits else 0,
+                                                cache_hits=1 if cached else 0, score_sum=sum(scores), scores=len(scores)))
+                    try:
+                        db.commit()
+                        return
+                    except IntegrityError:
+                        # Created concurrently; increment it instead
+                        db.rollback()
+        except Exception as e:
+            print(f"Recording memory retrieval failed: {str(e)}")
+
+    def forget(self, user_id: str) -> None:
+        with self._sessions() as db:
+            db.query(MemoryVectorRecord).filter(MemoryVectorRecord.user_id == user_id).delete(synchronize_session=False)
+            db.query(MemoryRetrievalStats).filter(MemoryRetrievalStats.user_id == user_id).delete(synchronize_session=False)
+            db.commit()
+
+    def snapshot(self, user_id: str) -> dict:
+        stats = UserMemoryStats()
+        with self._sessions() as db:
+            for message_type, count, size, first, last in db.query(
+                MemoryVectorRecord.message_type, func.count(), func.sum(MemoryVectorRecord.bytes),
+                func.min(MemoryVectorRecord.timestamp), func.max(MemoryVectorRecord.timestamp)
+            ).filter(MemoryVectorRecord.user_id == user_id).group_by(MemoryVectorRecord.message_type):
+                stats.counts[message_type] = count
+                stats.bytes += size or 0
+                stats.first_timestamp = first if stats.first_timestamp is None else min(stats.first_timestamp, first)
+                stats.last_timestamp = last if stats.last_timestamp is None else max(stats.last_timestamp, last)
+            retrieval = db.get(MemoryRetrievalStats, user_id)
+            if retrieval is not None:
+                stats.retrievals, stats.retrieval_hits, stats.cache_hits = retrieval.retrievals, retrieval.retrieval_hits, retrieval.cache_hits
+                stats.score_sum, stats.scores = retrieval.score_sum, retrieval.scores
+        return stats.summary()
+
+memory_service.stats = DatabaseMemoryStats(SessionLocal)
+
+# -----------------------------------
+# Turn Orchestration
+# -----------------------------------
+
+class TurnTimeline:
+    """
+    Records when each stage of a chat turn starts and finishes, relative to
+    the start of the turn, so overlapping stages are visible in the logs.
+    """
+
+    def __init__(self, label: str):
+        self.label = label
+        self.origin = time.perf_counter()
+        self.stages: Dict[str, Tuple[float, float]] = {}
+
+    async def run(self, name: str, awaitable):
+        """Await a stage and record its [start, end] offsets in milliseconds."""
+        start = (time.perf_counter() - self.origin) * 1000
+        try:
+            return await awaitable
+        finally:
+            self.stages[name] = (start, (time.perf_counter() - self.origin) * 1000)
+
+    def call(self, name: str, func, *args, **kwargs):
+        """Run a blocking call inline and record it as a stage."""
+        start = (time.perf_counter() - self.origin) * 1000
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.stages[name] = (start, (time.perf_counter() - self.origin) * 1000)
+
+    def total_ms(self) -> float:
+        return (time.perf_counter() - self.origin) * 1000
+
+    def server_timing(self) -> str:
+        """Stage durations formatted for a Server-Timing response header."""
+        durations = [f"{name};dur={end - start:.1f}" for name, (start, end) in self.stages.items()]
+        return ", ".join(durations + [f"total;dur={self.total_ms():.1f}"])
+
+    def summary(self) -> str:
+        ordered = sorted(self.stages.items(), key=lambda item: item[1][0])
+        parts = [f"{name}=[{start:.0f}-{end:.0f}ms]" for name, (start, end) in ordered]
+        return f"{self.label} total={self.total_ms():.0f}ms " + " ".join(parts)
 
 # -----------------------------------
 # Request and Response Models
@@ -97,23 +420,993 @@ class ChatResponse(BaseModel):
     user_id: str
     message: str
     response: str
-    conversation_history: List[Tuple[str, str]]
+    new_messages: List[Tuple[str, str]] = Field(default_factory=list, description="The turn just added to the history")
+    history_version: Optional[int] = Field(default=None, description="Id of the newest history message; pass as since= to GET /chat/history")
+    skipped_stages: List[str] = Field(default_factory=list, description="Optional stages dropped to meet the latency budget")
+    deferred_stages: List[str] = Field(default_factory=list, description="Memory writes finishing in the background after the response")
     memory_retrieved: bool = Field(default=False, description="Whether memories were retrieved for this response")
     memory_count: int = Field(default=0, description="Number of memories retrieved")
 
+class HistoryResponse(BaseModel):
+    user_id: str
+    conversation_history: List[Tuple[str, str]]
+    message_count: int
+    has_more: bool
+    next_before_id: Optional[int] = None
+    next_since_id: Optional[int] = None
+    history_version: Optional[int] = None
+
+class ChatSocketMessage(BaseModel):
+    """A client message on the chat WebSocket"""
+    message: str
+    latency_budget_ms: Optional[int] = Field(default=None, ge=1, le=600000)
+
+class MemoryStoreRequest(BaseModel):
+    user_id: str = Field(..., min_length=1, description="Unique identifier for the user")
+    message: str = Field(..., min_length=1, description="Text to store as a memory")
+    message_type: Literal["user", "assistant"] = Field(default="user", description="Who said it")
+
+class PurgeRequest(BaseModel):
+    user_ids: List[str] = Field(..., min_length=1, max_length=10000, description="Users to purge")
+
 class HealthResponse(BaseModel):
     status: str
     message: str
     timestamp: str
 
+class ReadinessResponse(BaseModel):
+    status: str
+    database: bool
+    memory_index: bool
+    timestamp: str
+
+# -----------------------------------
+# Per-User Ordering
+# -----------------------------------
+
+# How same-user turns are serialized across processes: "database" (a lease
+# row in the chat database, works across hosts), "file" (flock on a file in
+# USER_LOCK_DIR, single host) or "local" (this process only)
+USER_LOCK_BACKEND = os.getenv("USER_LOCK_BACKEND", "database")
+USER_LOCK_DIR = os.getenv("USER_LOCK_DIR", os.path.join(tempfile.gettempdir(), "chat-user-locks"))
+# A database lease not renewed for this long (crashed or stalled worker) can be taken over;
+# the holder renews it every third of this while the turn runs
+USER_LEASE_TTL_SECONDS = float(os.getenv("USER_LEASE_TTL_SECONDS", "30"))
+# How long a turn waits for the previous turn of the same user before giving up with 409
+USER_LEASE_WAIT_SECONDS = float(os.getenv("USER_LEASE_WAIT_SECONDS", "60"))
+USER_LEASE_POLL_SECONDS = 0.1
+
+# One lock per user with turns running or waiting in this process, so only one
+# of them at a time competes for the cross-process lease
+_user_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+class UserLease:
+    """
+    Permission to run a turn for one user, held from before the history read
+    until the assistant message is saved. Same-user turns queue for it in
+    arrival order within a process and by polling across processes; turns of
+    different users never wait for each other.
+
+    A database lease carries a fencing token. If the holder stalls past the
+    TTL and another worker takes the lease over, the token changes and the
+    stale holder's next save_message fails instead of interleaving.
+    """
+
+    def __init__(self, user_id: str, lock: asyncio.Lock):
+        self.user_id = user_id
+        self._lock = lock
+        self._holds_lock = False
+        self.holder = uuid.uuid4().hex
+        self.token: Optional[int] = None
+        self.lost = False
+        self._bind = None
+        self._lock_file = None
+        self._heartbeat: Optional[asyncio.Task] = None
+
+    def _try_acquire_row(self, db: Session) -> bool:
+        expires_at = datetime.utcnow() + timedelta(seconds=USER_LEASE_TTL_SECONDS)
+        db.add(UserLeaseRecord(user_id=self.user_id, holder=self.holder, token=1, expires_at=expires_at))
+        try:
+            db.commit()
+            self.token = 1
+            return True
+        except IntegrityError:
+            db.rollback()
+        taken = db.query(UserLeaseRecord).filter(
+            UserLeaseRecord.user_id == self.user_id, UserLeaseRecord.expires_at < datetime.utcnow()
+        ).update({
+            "holder": self.holder, "token": UserLeaseRecord.token + 1, "expires_at": expires_at
+        }, synchronize_session=False)
+        if not taken:
+            db.rollback()
+            return False
+        self.token = db.query(UserLeaseRecord.token).filter(UserLeaseRecord.user_id == self.user_id).scalar()
+        db.commit()
+        return True
+
+    def _try_acquire_file(self) -> bool:
+        import fcntl
+        if self._lock_file is None:
+            os.makedirs(USER_LOCK_DIR, exist_ok=True)
+            name = hashlib.sha256(self.user_id.encode()).hexdigest()[:32]
+            self._lock_file = open(os.path.join(USER_LOCK_DIR, f"{name}.lock"), "w")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    async def acquire(self, db: Session) -> None:
+        deadline = time.monotonic() + USER_LEASE_WAIT_SECONDS
+        try:
+            await asyncio.wait_for(self._lock.acquire(), timeout=USER_LEASE_WAIT_SECONDS)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=409, detail="Another turn for this user is still running")
+        self._holds_lock = True
+        try:
+            if USER_LOCK_BACKEND == "database":
+                self._bind = db.get_bind()
+                with Session(bind=self._bind) as lease_db:
+                    while not self._try_acquire_row(lease_db):
+                        if time.monotonic() > deadline:
+                            raise HTTPException(status_code=409, detail="Another turn for this user is still running")
+                        await asyncio.sleep(USER_LEASE_POLL_SECONDS)
+                self._heartbeat = asyncio.create_task(self._renew())
+            elif USER_LOCK_BACKEND == "file":
+                while not self._try_acquire_file():
+                    if time.monotonic() > deadline:
+                        raise HTTPException(status_code=409, detail="Another turn for this user is still running")
+                    await asyncio.sleep(USER_LEASE_POLL_SECONDS)
+        except BaseException:
+            self.release()
+            raise
+
+    async def _renew(self) -> None:
+        """Extend the lease while the turn runs; a failed renewal means it was taken over."""
+        while True:
+            await asyncio.sleep(USER_LEASE_TTL_SECONDS / 3)
+            with Session(bind=self._bind) as lease_db:
+                renewed = lease_db.query(UserLeaseRecord).filter(
+                    UserLeaseRecord.user_id == self.user_id, UserLeaseRecord.token == self.token
+                ).update({"expires_at": datetime.utcnow() + timedelta(seconds=USER_LEASE_TTL_SECONDS)},
+                         synchronize_session=False)
+                lease_db.commit()
+            if not renewed:
+                self.lost = True
+                return
+
+    def fence(self, db: Session) -> None:
+        """
+        Check, in db's current transaction, that the lease is still ours. The
+        UPDATE keeps the lease row locked until the caller commits, so a
+        takeover cannot slip in between this check and the caller's write.
+        """
+        if self.token is None:
+            return
+        if not self.lost:
+            self.lost = not db.query(UserLeaseRecord).filter(
+                UserLeaseRecord.user_id == self.user_id, UserLeaseRecord.token == self.token
+            ).update({"holder": self.holder}, synchronize_session=False)
+        if self.lost:
+            db.rollback()
+            raise HTTPException(status_code=409, detail="The turn lease for this user was taken over by another worker")
+
+    def release(self) -> None:
+        """
+        Give the lease up. The local locks are always released; if the
+        database write fails the lease row simply expires after its TTL.
+        """
+        try:
+            if self._heartbeat is not None:
+                self._heartbeat.cancel()
+                self._heartbeat = None
+            if self.token is not None:
+                with Session(bind=self._bind) as lease_db:
+                    lease_db.query(UserLeaseRecord).filter(
+                        UserLeaseRecord.user_id == self.user_id, UserLeaseRecord.token == self.token
+                    ).update({"holder": None, "expires_at": datetime.utcnow()}, synchronize_session=False)
+                    lease_db.commit()
+        except Exception as e:
+            print(f"Releasing the lease of user {self.user_id} failed, it expires in {USER_LEASE_TTL_SECONDS:.0f}s: {str(e)}")
+        finally:
+            self.token = None
+            if self._lock_file is not None:
+                self._lock_file.close()  # closing the file drops the flock
+                self._lock_file = None
+            if self._holds_lock:
+                self._holds_lock = False
+                self._lock.release()
+
+async def acquire_user_lease(user_id: str, db: Session) -> UserLease:
+    """Wait for this user's previous turns to finish, here or on other workers."""
+    lock = _user_locks.get(user_id)
+    if lock is None:
+        lock = _user_locks[user_id] = asyncio.Lock()
+    lease = UserLease(user_id, lock)
+    await lease.acquire(db)
+    return lease
+
+# -----------------------------------
+# Chat Turn
+# -----------------------------------
+
+# Optional turn stages still running after their response was sent; holding a
+# reference keeps them from being garbage collected
+_deferred_stages: set = set()
+
+async def finish_optional_stages(stages: Dict[str, asyncio.Task], budget: LatencyBudget) -> None:
+    """
+    Wait for optional stages until the budget runs out. Stages still running
+    keep going in the background and are reported as deferred (memory
+    writes) or skipped (anything whose result the response needed).
+    """
+    _, pending = await asyncio.wait(stages.values(), timeout=budget.timeout())
+    for name, task in stages.items():
+        if task in pending:
+            if name.startswith("store_"):
+                budget.defer(name)
+            else:
+                budget.skip(name)
+            _deferred_stages.add(task)
+            task.add_done_callback(_deferred_stages.discard)
+            task.add_done_callback(_log_stage_error)
+        elif not task.cancelled() and task.exception() is not None:
+            # The turn is already persisted; a failed optional stage only degrades it
+            print(f"Optional stage {name} failed: {task.exception()}")
+            budget.skip(name)
+
+def _log_stage_error(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Deferred stage failed: {task.exception()}")
+
+async def cancel_stages(stages: Dict[str, asyncio.Task]) -> None:
+    """
+    Cancel the stages of a turn that failed and wait for them, so none keeps
+    running without an owner or leaves its exception unretrieved.
+    """
+    for task in stages.values():
+        task.cancel()
+    await asyncio.gather(*stages.values(), return_exceptions=True)
+
+async def run_chat_turn(request: ChatRequest, db: Session, http_response: Response,
+                        budget: Optional[LatencyBudget] = None) -> ChatResponse:
+    """
+    Run one chat turn as a small dependency graph: once the user message is
+    saved it is embedded and upserted while the agent runs. Only the new
+    turn and the history version are returned, so the response size does
+    not grow with the conversation; clients fetch anything they missed with
+    GET /chat/history?since=. Per-stage durations are returned in the
+    Server-Timing header.
+
+    With a latency budget, the memory stages are optional: they are skipped
+    or deferred to the background when they do not fit, and the response
+    lists which ones were. Turns of the same user run one at a time, across
+    workers too, under a UserLease. If the turn fails, its stages still
+    running are cancelled.
+    """
+    timeline = TurnTimeline(f"chat user={request.user_id}")
+    budget = budget or LatencyBudget()
+    lease = await timeline.run("user_lease", acquire_user_lease(request.user_id, db))
+    stages: Dict[str, asyncio.Task] = {}
+    finished = False
+    try:
+        # History must be read before the user message is inserted so the
+        # agent does not see the current message twice
+        conversation_history = timeline.call("load_history", load_recent_history, request.user_id, db)
+        user_message_id = timeline.call("save_user_message", save_message, request.user_id, "User", request.message, db, lease)
+
+        # The memory write only starts once the message is persisted, so a
+        # rejected turn does not leave it in vector memory, and is keyed by
+        # the row id so a backfill of the same row overwrites it
+        stages["store_user_memory"] = store_user_task = asyncio.create_task(timeline.run(
+            "store_user_memory",
+            asyncio.to_thread(memory_service.store_message, request.user_id, request.message, "user", budget, user_message_id)
+        ))
+
+        stages["agent"] = agent_task = asyncio.create_task(timeline.run(
+            "agent",
+            process_query_with_memory(
+                user_id=request.user_id,
+                message=request.message,
+                conversation_history=conversation_history,
+                store_in_memory=False,
+                budget=budget
+            )
+        ))
+
+        # Memory metadata only needs the user message to be in the index
+        async def count_memories() -> int:
+            await store_user_task
+            memories = await asyncio.to_thread(
+                memory_service.retrieve_memories, request.user_id, request.message, 3, budget, 0.0, "memory_count", False
+            )
+            return len(memories)
+
+        stages["memory_count"] = count_task = asyncio.create_task(timeline.run("count_memories", count_memories()))
+
+        response = await agent_task
+
+        version = timeline.call("save_assistant_message", save_message, request.user_id, "Assistant", response, db, lease)
+        stages["store_assistant_memory"] = store_assistant_task = asyncio.create_task(timeline.run(
+            "store_assistant_memory",
+            asyncio.to_thread(memory_service.store_message, request.user_id, response, "assistant", budget, version)
+        ))
+
+        finished = True
+        await finish_optional_stages({
+            "store_user_memory": store_user_task,
+            "store_assistant_memory": store_assistant_task,
+            "memory_count": count_task,
+        }, budget)
+    finally:
+        if not finished:
+            await cancel_stages(stages)
+        lease.release()
+
+    memory_count = count_task.result() if count_task.done() and "memory_count" not in budget.skipped else 0
+    would_retrieve = memory_count > 0
+
+    print(f"Turn timeline: {timeline.summary()}")
+    http_response.headers["Server-Timing"] = timeline.server_timing()
+
+    return ChatResponse(
+        user_id=request.user_id,
+        message=request.message,
+        response=response,
+        new_messages=[("User", request.message), ("Assistant", response)],
+        history_version=version,
+        memory_retrieved=would_retrieve,
+        memory_count=memory_count,
+        skipped_stages=budget.skipped,
+        deferred_stages=budget.deferred
+    )
+
+def _sse(event: str, data: dict) -> str:
+    """Format one server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def chat_turn_events(request: ChatRequest, db: Session, budget: Optional[LatencyBudget] = None,
+                           conversation_history: Optional[List[Tuple[str, str]]] = None,
+                           label: str = "chat-stream",
+                           lease: Optional[UserLease] = None) -> AsyncIterator[Tuple[str, dict]]:
+    """
+    A chat turn as a stream of (event, data) pairs, shared by /chat/stream
+    and the WebSocket sessions. The stages are those of run_chat_turn, but
+    the agent's text is emitted as `token` events while it is being
+    generated. After the last token the response is persisted, and a `done`
+    event carries the full response and stage timings. Failures end the
+    stream with an `error` event. Callers that already hold the recent
+    history window pass it as conversation_history to skip the read, and
+    the user's lease it was read under; otherwise the lease is taken here.
+    """
+    timeline = TurnTimeline(f"{label} user={request.user_id}")
+    budget = budget or LatencyBudget()
+    own_lease = lease is None
+    stages: Dict[str, asyncio.Task] = {}
+    finished = False
+    try:
+        if own_lease:
+            lease = await timeline.run("user_lease", acquire_user_lease(request.user_id, db))
+        if conversation_history is None:
+            conversation_history = timeline.call("load_history", load_recent_history, request.user_id, db)
+        user_message_id = timeline.call("save_user_message", save_message, request.user_id, "User", request.message, db, lease)
+        stages["store_user_memory"] = asyncio.create_task(timeline.run(
+            "store_user_memory",
+            asyncio.to_thread(memory_service.store_message, request.user_id, request.message, "user", budget, user_message_id)
+        ))
+
+        chunks: List[str] = []
+        agent_start = timeline.total_ms()
+        async for delta in stream_query_with_memory(request.user_id, request.message, conversation_history, budget=budget):
+            if not chunks:
+                timeline.stages["first_token"] = (agent_start, timeline.total_ms())
+            chunks.append(delta)
+            yield "token", {"content": delta}
+        timeline.stages["agent"] = (agent_start, timeline.total_ms())
+        response = "".join(chunks)
+
+        version = timeline.call("save_assistant_message", save_message, request.user_id, "Assistant", response, db, lease)
+        stages["store_assistant_memory"] = asyncio.create_task(timeline.run(
+            "store_assistant_memory",
+            asyncio.to_thread(memory_service.store_message, request.user_id, response, "assistant", budget, version)
+        ))
+        finished = True
+        await finish_optional_stages(stages, budget)
+
+        print(f"Turn timeline: {timeline.summary()}")
+        yield "done", {
+            "user_id": request.user_id,
+            "message": request.message,
+            "response": response,
+            "history_version": version,
+            "skipped_stages": budget.skipped,
+            "deferred_stages": budget.deferred,
+            "server_timing": timeline.server_timing(),
+        }
+    except HTTPException as e:
+        yield "error", {"detail": e.detail}
+    except Exception as e:
+        print(f"Error in chat stream: {str(e)}")
+        yield "error", {"detail": str(e)}
+    finally:
+        if not finished:
+            await cancel_stages(stages)
+        if own_lease and lease is not None:
+            lease.release()
+
+async def stream_chat_turn(request: ChatRequest, db: Session, budget: Optional[LatencyBudget] = None) -> AsyncIterator[str]:
+    """Streaming variant of run_chat_turn for /chat/stream, as server-sent events"""
+    async for event, data in chat_turn_events(request, db, budget):
+        yield _sse(event, data)
+
+
+# -----------------------------------
+# Idempotency
+# -----------------------------------
+
+# How long a completed response is replayed for retries with the same key
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+# How long a retry waits for an in-flight attempt on another worker before giving up with 409
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "120"))
+IDEMPOTENCY_POLL_SECONDS = 0.25
+# The worker running a request renews its pending record this often; a pending
+# record whose heartbeat is three intervals old (crashed worker) can be taken over
+IDEMPOTENCY_HEARTBEAT_SECONDS = float(os.getenv("IDEMPOTENCY_HEARTBEAT_SECONDS", "10"))
+
+# Turns running in this process, keyed by (user_id, key): (request fingerprint, future).
+# The future resolves to the ChatResponse, or None when the attempt failed.
+_inflight_turns: Dict[Tuple[str, str], Tuple[str, asyncio.Future]] = {}
+# Responses of saved turns whose completion is still being retried (see complete_idempotency_key_later)
+_pending_completions: set = set()
+_last_idempotency_prune = 0.0
+
+def _request_fingerprint(request: ChatRequest) -> str:
+    return hashlib.sha256(f"{request.user_id}\0{request.message}".encode()).hexdigest()
+
+def claim_idempotency_key(user_id: str, key: str, fingerprint: str, db: Session) -> Optional[IdempotencyRecord]:
+    """Insert a pending record for the key. Returns None if claimed, else the existing record."""
+    db.add(IdempotencyRecord(user_id=user_id, key=key, fingerprint=fingerprint, status="pending"))
+    try:
+        db.commit()
+        return None
+    except IntegrityError:
+        db.rollback()
+        return db.query(IdempotencyRecord).filter(
+            IdempotencyRecord.user_id == user_id, IdempotencyRecord.key == key
+        ).one_or_none()
+
+def complete_idempotency_key(user_id: str, key: str, response: ChatResponse, db: Session) -> None:
+    db.query(IdempotencyRecord).filter(
+        IdempotencyRecord.user_id == user_id, IdempotencyRecord.key == key
+    ).update({"status": "completed", "response": response.model_dump_json(), "created_at": datetime.utcnow()})
+    db.commit()
+
+def take_over_idempotency_key(record: IdempotencyRecord, db: Session) -> bool:
+    """
+    Claim a pending record whose worker stopped renewing its heartbeat;
+    returns whether this request now owns it. Conditional on the heartbeat,
+    so only one retry wins and a live owner is never displaced.
+    """
+    stale = datetime.utcnow() - timedelta(seconds=3 * IDEMPOTENCY_HEARTBEAT_SECONDS)
+    taken = db.query(IdempotencyRecord).filter(
+        IdempotencyRecord.id == record.id, IdempotencyRecord.status == "pending",
+        func.coalesce(IdempotencyRecord.heartbeat_at, IdempotencyRecord.created_at) < stale
+    ).update({"heartbeat_at": datetime.utcnow()}, synchronize_session=False)
+    db.commit()
+    return bool(taken)
+
+async def renew_idempotency_key(user_id: str, key: str, bind) -> None:
+    """Keep a pending record's heartbeat fresh while its request runs."""
+    while True:
+        await asyncio.sleep(IDEMPOTENCY_HEARTBEAT_SECONDS)
+        try:
+            with Session(bind=bind) as heartbeat_db:
+                heartbeat_db.query(IdempotencyRecord).filter(
+                    IdempotencyRecord.user_id == user_id, IdempotencyRecord.key == key,
+                    IdempotencyRecord.status == "pending"
+                ).update({"heartbeat_at": datetime.utcnow()}, synchronize_session=False)
+                heartbeat_db.commit()
+        except Exception as e:
+            print(f"Renewing Idempotency-Key {key} of user {user_id} failed: {str(e)}")
+
+async def complete_idempotency_key_later(user_id: str, key: str, response: ChatResponse, bind,
+                                         heartbeat: asyncio.Task) -> None:
+    """
+    Store a saved turn's response after the first attempt failed, retrying
+    with capped backoff. The heartbeat keeps running meanwhile, so no retry
+    takes the key over and saves the turn a second time.
+    """
+    delay = IDEMPOTENCY_POLL_SECONDS
+    try:
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                with Session(bind=bind) as completion_db:
+                    complete_idempotency_key(user_id, key, response, completion_db)
+                return
+            except Exception as e:
+                print(f"Storing the response for Idempotency-Key {key} of user {user_id} failed again: {str(e)}")
+                delay = min(delay * 2, IDEMPOTENCY_HEARTBEAT_SECONDS)
+    finally:
+        heartbeat.cancel()
+
+def release_idempotency_key(user_id: str, key: str, db: Session) -> None:
+    """Drop a record so the key can be claimed again (failed attempt or expired response)."""
+    db.rollback()
+    db.query(IdempotencyRecord).filter(
+        IdempotencyRecord.user_id == user_id, IdempotencyRecord.key == key
+    ).delete()
+    db.commit()
+
+def prune_idempotency_records(db: Session) -> None:
+    """Delete expired records, at most once a minute per process."""
+    global _last_idempotency_prune
+    if time.monotonic() - _last_idempotency_prune < 60:
+        return
+    _last_idempotency_prune = time.monotonic()
+    cutoff = datetime.utcnow() - timedelta(seconds=max(IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_WAIT_SECONDS))
+    db.query(IdempotencyRecord).filter(IdempotencyRecord.created_at < cutoff).delete()
+    db.commit()
+
+async def run_idempotent_chat_turn(request: ChatRequest, key: str, db: Session, http_response: Response,
+                                   budget: Optional[LatencyBudget] = None) -> ChatResponse:
+    """
+    Run a chat turn at most once per (user_id, Idempotency-Key).
+
+    Retries arriving while the first attempt runs in this process await the
+    same future; retries on other workers poll the pending database record.
+    Completed responses are replayed for IDEMPOTENCY_TTL_SECONDS. A failed
+    turn releases the key so the next retry runs it again; once the turn is
+    saved the key is never released, and a failed completion is retried in
+    the background. A pending key is taken over only when its worker stopped
+    renewing the heartbeat.
+    """
+    scope = (request.user_id, key)
+    fingerprint = _request_fingerprint(request)
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    prune_idempotency_records(db)
+
+    while True:
+        inflight = _inflight_turns.get(scope)
+        if inflight is not None:
+            if inflight[0] != fingerprint:
+                raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+            result = await asyncio.shield(inflight[1])
+            if result is not None:
+                http_response.headers["Idempotent-Replayed"] = "true"
+                return result
+            continue
+
+        existing = claim_idempotency_key(request.user_id, key, fingerprint, db)
+        if existing is None:
+            break
+        if existing.fingerprint != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+
+        age = (datetime.utcnow() - existing.created_at).total_seconds()
+        if existing.status == "completed":
+            if age <= IDEMPOTENCY_TTL_SECONDS:
+                http_response.headers["Idempotent-Replayed"] = "true"
+                return ChatResponse.model_validate_json(existing.response)
+            release_idempotency_key(request.user_id, key, db)
+            continue
+
+        # Pending on another worker: wait for it, or take over if that worker is gone
+        if take_over_idempotency_key(existing, db):
+            break
+        if time.monotonic() > deadline:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+        await asyncio.sleep(IDEMPOTENCY_POLL_SECONDS)
+        db.expire_all()
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight_turns[scope] = (fingerprint, future)
+    heartbeat = asyncio.create_task(renew_idempotency_key(request.user_id, key, db.get_bind()))
+    try:
+        try:
+            chat_response = await run_chat_turn(request, db, http_response, budget)
+        except BaseException:
+            heartbeat.cancel()
+            future.set_result(None)
+            release_idempotency_key(request.user_id, key, db)
+            raise
+        future.set_result(chat_response)
+        # The turn is saved: the key must stay claimed, or a retry would save it again
+        try:
+            complete_idempotency_key(request.user_id, key, chat_response, db)
+            heartbeat.cancel()
+        except Exception as e:
+            print(f"Storing the response for Idempotency-Key {key} of user {request.user_id} failed, retrying: {str(e)}")
+            db.rollback()
+            completion = asyncio.create_task(complete_idempotency_key_later(
+                request.user_id, key, chat_response, db.get_bind(), heartbeat))
+            _pending_completions.add(completion)
+            completion.add_done_callback(_pending_completions.discard)
+    finally:
+        _inflight_turns.pop(scope, None)
+    return chat_response
+
+# -----------------------------------
+# Bulk History Transfer
+# -----------------------------------
+
+# When set, the /admin endpoints require a matching X-Admin-Token header
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+# Rows fetched per round trip of the export cursor, and sent per chunk of the response
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+# Rows per INSERT statement (and commit) on import
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "1000"))
+
+def require_admin(x_admin_token: Optional[str] = Header(None, alias="X-Admin-Token")) -> None:
+    if ADMIN_TOKEN and not hmac.compare_digest(x_admin_token or "", ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid or missing X-Admin-Token")
+
+def iter_history_ndjson(db: Session, user_id: Optional[str] = None, since: Optional[datetime] = None,
+                        until: Optional[datetime] = None) -> Iterator[str]:
+    """
+    Yield chat_messages rows as NDJSON in id order. Rows are streamed from a
+    server-side cursor EXPORT_BATCH_SIZE at a time, so memory use does not
+    depend on the table size.
+    """
+    query = db.query(ChatMessage)
+    if user_id is not None:
+        query = query.filter(ChatMessage.chat_id == user_id)
+    if since is not None:
+        query = query.filter(ChatMessage.created_at >= since)
+    if until is not None:
+        query = query.filter(ChatMessage.created_at < until)
+
+    lines = []
+    for row in query.order_by(ChatMessage.id).yield_per(EXPORT_BATCH_SIZE):
+        lines.append(json.dumps({
+            "id": row.id,
+            "chat_id": row.chat_id,
+            "speaker": row.speaker,
+            "message": row.message,
+            "created_at": row.created_at.isoformat() if row.created_at else None,
+        }) + "\n")
+        if len(lines) >= EXPORT_BATCH_SIZE:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
+
+def parse_history_record(line: str, number: int) -> Dict[str, Any]:
+    """Validate one NDJSON line of an import. Exported ids are dropped; the target assigns its own."""
+    try:
+        record = json.loads(line)
+        values = {
+            "chat_id": str(record["chat_id"]),
+            "speaker": str(record["speaker"]),
+            "message": str(record["message"]),
+            "created_at": datetime.fromisoformat(record["created_at"]) if record.get("created_at") else datetime.utcnow(),
+        }
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"line {number}: invalid record ({e.__class__.__name__}: {e})")
+    if not values["chat_id"] or not values["message"]:
+        raise ValueError(f"line {number}: chat_id and message must not be empty")
+    return values
+
+def insert_history_batch(rows: List[Dict[str, Any]], db: Session) -> None:
+    db.execute(insert(ChatMessage), rows)
+    for chat_id, changes in Counter(row["chat_id"] for row in rows).items():
+        bump_revision(chat_id, db, changes)
+    db.commit()
+
+async def _iter_body_lines(request: Request) -> AsyncIterator[str]:
+    """Split a streamed request body into lines without reading it all first"""
+    pending = b""
+    async for chunk in request.stream():
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8")
+    if pending:
+        yield pending.decode("utf-8")
+
+async def import_history_ndjson(request: Request, db: Session) -> Dict[str, int]:
+    """
+    Insert NDJSON records from the request body in batches of
+    IMPORT_BATCH_SIZE. Each batch is committed on its own, so an invalid line
+    stops the import after the batches before it; the error reports how many
+    rows were imported.
+    """
+    imported = batches = 0
+    batch: List[Dict[str, Any]] = []
+    number = 0
+    try:
+        async for line in _iter_body_lines(request):
+            number += 1
+            if not line.strip():
+                continue
+            batch.append(parse_history_record(line, number))
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                await asyncio.to_thread(insert_history_batch, batch, db)
+                imported, batches, batch = imported + len(batch), batches + 1, []
+        if batch:
+            await asyncio.to_thread(insert_history_batch, batch, db)
+            imported, batches = imported + len(batch), batches + 1
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"{e}; {imported} rows imported before it")
+    return {"imported": imported, "batches": batches}
+
+
+# -----------------------------------
+# User Purge
+# -----------------------------------
+
+# Users purged in parallel by one job
+PURGE_CONCURRENCY = int(os.getenv("PURGE_CONCURRENCY", "8"))
+# SQL rows per DELETE and vector ids per Pinecone delete request
+PURGE_BATCH_SIZE = int(os.getenv("PURGE_BATCH_SIZE", "1000"))
+# Minimum seconds between progress writes of a running job
+PURGE_PROGRESS_INTERVAL = 0.5
+
+# Running purge tasks; holding a reference keeps them from being garbage collected
+_purge_tasks: set = set()
+
+def purge_user_history(user_id: str) -> int:
+    """Delete a user's chat messages (in batches) and idempotency records; returns messages deleted."""
+    db = SessionLocal()
+    try:
+        deleted = 0
+        while True:
+            ids = [row.id for row in db.query(ChatMessage.id).filter(ChatMessage.chat_id == user_id).limit(PURGE_BATCH_SIZE)]
+            if not ids:
+                break
+            db.query(ChatMessage).filter(ChatMessage.id.in_(ids)).delete(synchronize_session=False)
+            bump_revision(user_id, db)
+            db.commit()
+            deleted += len(ids)
+        db.query(IdempotencyRecord).filter(IdempotencyRecord.user_id == user_id).delete(synchronize_session=False)
+        db.commit()
+        return deleted
+    finally:
+        db.close()
+
+def save_purge_progress(job_id: str, progress: Dict[str, Any], finished: bool = False) -> None:
+    db = SessionLocal()
+    try:
+        values = {
+            PurgeJob.users_done: progress["users_done"],
+            PurgeJob.users_failed: progress["users_failed"],
+            PurgeJob.rows_deleted: progress["rows_deleted"],
+            PurgeJob.vectors_deleted: progress["vectors_deleted"],
+            PurgeJob.errors: json.dumps(progress["errors"]) if progress["errors"] else None,
+        }
+        if finished:
+            values.update({PurgeJob.status: "completed", PurgeJob.finished_at: datetime.utcnow()})
+        db.query(PurgeJob).filter(PurgeJob.id == job_id).update(values, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+async def run_purge_job(job_id: str, user_ids: List[str]) -> None:
+    """
+    Purge users PURGE_CONCURRENCY at a time: SQL rows first, then vectors.
+    A failing user is recorded in the job's errors and does not stop the
+    others. Progress is written to the job row while it runs.
+    """
+    semaphore = asyncio.Semaphore(PURGE_CONCURRENCY)
+    progress = {"users_done": 0, "users_failed": 0, "rows_deleted": 0, "vectors_deleted": 0, "errors": {}}
+    # Serializes progress writes so an older snapshot never overwrites a newer one
+    save_lock = asyncio.Lock()
+    last_save = 0.0
+
+    async def purge_one(user_id: str) -> None:
+        nonlocal last_save
+        async with semaphore:
+            lease = None
+            lease_db = SessionLocal()
+            try:
+                # Holding the user's lease keeps turns from running during the
+                # purge; delete_user_memories also waits for this worker's
+                # in-flight memory writes, so none re-adds a vector afterwards
+                lease = await acquire_user_lease(user_id, lease_db)
+                # Await before touching the counters; `x += await ...` would read x before the await
+                rows = await asyncio.to_thread(purge_user_history, user_id)
+                progress["rows_deleted"] += rows
+                vectors = await asyncio.to_thread(memory_service.delete_user_memories, user_id, PURGE_BATCH_SIZE)
+                progress["vectors_deleted"] += vectors
+            except HTTPException as e:
+                progress["users_failed"] += 1
+                progress["errors"][user_id] = e.detail
+            except Exception as e:
+                print(f"Error purging user {user_id}: {str(e)}")
+                progress["users_failed"] += 1
+                progress["errors"][user_id] = str(e)
+            finally:
+                if lease is not None:
+                    lease.release()
+                lease_db.close()
+            progress["users_done"] += 1
+        if time.monotonic() - last_save >= PURGE_PROGRESS_INTERVAL:
+            async with save_lock:
+                last_save = time.monotonic()
+                await asyncio.to_thread(save_purge_progress, job_id, dict(progress, errors=dict(progress["errors"])))
+
+    await asyncio.gather(*(purge_one(user_id) for user_id in user_ids))
+    async with save_lock:
+        await asyncio.to_thread(save_purge_progress, job_id, progress, True)
+
+def start_purge_job(user_ids: List[str], db: Session) -> PurgeJob:
+    """Record a new job and run it in the background of this process."""
+    user_ids = list(dict.fromkeys(user_ids))
+    job = PurgeJob(id=uuid.uuid4().hex, status="running", users_total=len(user_ids))
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    task = asyncio.create_task(run_purge_job(job.id, user_ids))
+    _purge_tasks.add(task)
+    task.add_done_callback(_purge_tasks.discard)
+    return job
+
+def describe_purge_job(job: PurgeJob) -> Dict[str, Any]:
+    """Job status with throughput so far"""
+    elapsed = ((job.finished_at or datetime.utcnow()) - job.created_at).total_seconds()
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "users_total": job.users_total,
+        "users_done": job.users_done,
+        "users_failed": job.users_failed,
+        "rows_deleted": job.rows_deleted,
+        "vectors_deleted": job.vectors_deleted,
+        "errors": json.loads(job.errors) if job.errors else {},
+        "elapsed_s": round(elapsed, 2),
+        "users_per_second": round(job.users_done / elapsed, 2) if elapsed > 0 else 0.0,
+        "vectors_per_second": round(job.vectors_deleted / elapsed, 1) if elapsed > 0 else 0.0,
+        "created_at": job.created_at.isoformat(),
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None
+    }
+
+
+# -----------------------------------
+# WebSocket Sessions
+# -----------------------------------
+
+# Idle WebSocket sessions are closed after this long without a message
+WS_IDLE_TIMEOUT_SECONDS = float(os.getenv("WS_IDLE_TIMEOUT_SECONDS", "600"))
+# Approximate memory all sessions of this process may hold; beyond it the
+# least recently active idle sessions are closed
+WS_SESSION_MEMORY_BYTES = int(os.getenv("WS_SESSION_MEMORY_BYTES", str(64 * 1024 * 1024)))
+# Close code for evicted sessions ("try again later"); clients reconnect
+WS_EVICTED_CLOSE_CODE = 1013
+
+class ChatSession:
+    """
+    State kept for one WebSocket connection between turns: the recent
+    history window the agent sees and the chat revision it was read at.
+    Memories come from the process-wide retrieval cache, which outlives
+    the connection.
+    """
+
+    def __init__(self, user_id: str, websocket: WebSocket):
+        self.user_id = user_id
+        self.websocket = websocket
+        self.recent: Deque[Tuple[str, str]] = deque(maxlen=AGENT_HISTORY_MESSAGES)
+        self.history_version: Optional[int] = None
+        self.revision = 0
+        self.turns = 0
+        self.busy = False
+        self.last_active = time.monotonic()
+
+    def load(self, db: Session) -> None:
+        self.revision = chat_revision(self.user_id, db)
+        self.history_version, _ = history_version(self.user_id, db)
+        self.recent.clear()
+        self.recent.extend(load_recent_history(self.user_id, db))
+
+    def sync(self, db: Session) -> None:
+        """Reload the window only if something else (another tab, worker or /chat) changed the history"""
+        if chat_revision(self.user_id, db) != self.revision:
+            self.load(db)
+
+    def record_turn(self, message: str, response: str, version: int) -> None:
+        """Write-through: the turn is already in the database, mirror it in the window"""
+        self.recent.extend([("User", message), ("Assistant", response)])
+        self.history_version = version
+        self.revision += 2
+        self.turns += 1
+
+    def size(self) -> int:
+        return 1024 + sum(64 + len(speaker) + len(message) for speaker, message in self.recent)
+
+class SessionRegistry:
+    """The open WebSocket sessions of this process, kept under a memory cap"""
+
+    def __init__(self, max_bytes: int = WS_SESSION_MEMORY_BYTES):
+        self.max_bytes = max_bytes
+        self._sessions: set = set()
+        # Close tasks of evicted sessions; holding a reference keeps them from being garbage collected
+        self._closing: set = set()
+
+    def add(self, session: ChatSession) -> None:
+        self._sessions.add(session)
+        self.enforce_cap()
+
+    def remove(self, session: ChatSession) -> None:
+        self._sessions.discard(session)
+
+    def enforce_cap(self) -> None:
+        """Close the least recently active idle sessions until the rest fit in max_bytes"""
+        total = sum(session.size() for session in self._sessions)
+        if total <= self.max_bytes:
+            return
+        for session in sorted((s for s in self._sessions if not s.busy), key=lambda s: s.last_active):
+            if total <= self.max_bytes:
+                break
+            total -= session.size()
+            self.remove(session)
+            task = asyncio.create_task(session.websocket.close(code=WS_EVICTED_CLOSE_CODE, reason="session evicted"))
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+
+    def snapshot(self) -> Dict[str, int]:
+        return {"sessions": len(self._sessions), "bytes": sum(session.size() for session in self._sessions)}
+
+chat_sessions = SessionRegistry()
+
+
 # -----------------------------------
 # FastAPI Application
 # -----------------------------------
 
+# Recently active users whose retrieval results are preloaded at startup (0 disables it)
+RETRIEVAL_CACHE_WARM_USERS = int(os.getenv("RETRIEVAL_CACHE_WARM_USERS", "0"))
+# Latest messages per user used as warm-up queries
+RETRIEVAL_CACHE_WARM_QUERIES = int(os.getenv("RETRIEVAL_CACHE_WARM_QUERIES", "3"))
+# Backoff between memory index warm-up attempts: doubles from the first delay up to the cap
+WARM_UP_RETRY_SECONDS = float(os.getenv("WARM_UP_RETRY_SECONDS", "1"))
+WARM_UP_RETRY_MAX_SECONDS = float(os.getenv("WARM_UP_RETRY_MAX_SECONDS", "60"))
+
+async def warm_up() -> None:
+    """
+    Initialize the memory index, retrying with capped exponential backoff
+    until it succeeds (so a Pinecone outage at boot does not leave /ready at
+    503 until a restart), then optionally preload the retrieval cache for
+    recently active users.
+    """
+    delay = WARM_UP_RETRY_SECONDS
+    while not await asyncio.to_thread(memory_service.warm_up):
+        print(f"Memory index not ready, retrying warm-up in {delay:.0f}s")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, WARM_UP_RETRY_MAX_SECONDS)
+    if RETRIEVAL_CACHE_WARM_USERS <= 0:
+        return
+    def load_queries() -> Dict[str, List[str]]:
+        db = SessionLocal()
+        try:
+            return recent_user_queries(db, RETRIEVAL_CACHE_WARM_USERS, RETRIEVAL_CACHE_WARM_QUERIES)
+        finally:
+            db.close()
+
+    try:
+        user_queries = await asyncio.to_thread(load_queries)
+        cached = await asyncio.to_thread(memory_service.warm_retrieval_cache, user_queries)
+        print(f"Retrieval cache warmed with {cached} queries for {len(user_queries)} users")
+    except Exception as e:
+        print(f"Retrieval cache warm-up failed: {str(e)}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Startup/shutdown hook. Tables are created before serving; the Pinecone
+    index (and optionally the retrieval cache) is warmed up in the background,
+    retrying until it succeeds, so a slow or unreachable Pinecone does not
+    block the container from accepting requests.
+    """
+    init_db()
+    warm_up_task = asyncio.create_task(warm_up())
+    yield
+    if not warm_up_task.done():
+        warm_up_task.cancel()
+
 app = FastAPI(
     title="Memory Chatbot API",
     description="Production-ready chatbot with memory using Pinecone vector database",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Configure CORS
@@ -140,13 +1433,38 @@ async def root():
 
 @app.get("/health", response_model=HealthResponse)
 async def health_check():
-    """Health check endpoint"""
+    """Liveness check endpoint; does not touch the database or external services"""
     return HealthResponse(
         status="healthy",
         message="API is operational",
         timestamp=datetime.now().isoformat()
     )
 
+@app.get("/ready", response_model=ReadinessResponse)
+async def readiness_check(db: Session = Depends(get_db)):
+    """
+    Readiness probe: reports 503 until the database answers and the memory
+    index has been initialized. Use /health for liveness.
+    """
+    try:
+        db.execute(text("SELECT 1"))
+        database_ready = True
+    except Exception as e:
+        print(f"Readiness database check failed: {str(e)}")
+        database_ready = False
+
+    memory_ready = memory_service.is_ready()
+    ready = database_ready and memory_ready
+    body = ReadinessResponse(
+        status="ready" if ready else "starting",
+        database=database_ready,
+        memory_index=memory_ready,
+        timestamp=datetime.now().isoformat()
+    )
+    if not ready:
+        return JSONResponse(status_code=503, content=body.model_dump())
+    return body
+
 @app.get("/info")
 async def api_info():
     """
@@ -164,11 +1482,19 @@ async def api_info():
         },
         "endpoints": {
             "chat": {
-                "POST /chat": "Main chat endpoint with full memory functionality",
+                "POST /chat": "Main chat endpoint with full memory functionality (send an Idempotency-Key header to make retries safe, X-Latency-Budget-Ms to bound latency)",
+                "POST /chat/stream": "Same turn as POST /chat, streamed as server-sent events (token, done, error)",
+                "WS /chat/ws/{user_id}": "Chat session over a WebSocket; each {\"message\": ...} streams token/done/error messages",
                 "POST /chat/simple": "Lightweight chat without database persistence",
-                "GET /chat/history/{user_id}": "Get conversation history",
+                "GET /chat/history/{user_id}": "Get conversation history (?limit=N for the newest page, &before_id= for older pages, ?since=history_version for new messages; supports If-None-Match)",
                 "DELETE /chat/history/{user_id}": "Clear conversation history"
             },
+            "admin": {
+                "GET /admin/history/export?user_id=&since=&until=": "Stream chat history as NDJSON (all users or a filter)",
+                "POST /admin/history/import": "Bulk insert chat history from an NDJSON body",
+                "POST /admin/purge": "Start a background job deleting users' history and memories",
+                "GET /admin/purge/{job_id}": "Purge job status and throughput"
+            },
             "memory": {
                 "GET /memories/test/{user_id}?query=text": "Test what memories would be retrieved",
                 "GET /memories/stats/{user_id}": "Get memory statistics for a user",
@@ -176,8 +1502,10 @@ async def api_info():
             },
             "system": {
                 "GET /": "Root endpoint",
-                "GET /health": "Health check",
-                "GET /info": "This endpoint - API information"
+                "GET /health": "Liveness check",
+                "GET /ready": "Readiness check (database and memory index)",
+                "GET /info": "This endpoint - API information",
+                "GET /agent/tiers": "Turns, latency, tokens and estimated cost per model tier"
             }
         },
         "examples": {
@@ -208,7 +1536,13 @@ async def api_info():
     }
 
 @app.post("/chat", response_model=ChatResponse)
-async def chat_endpoint(request: ChatRequest, db: Session = Depends(get_db)):
+async def chat_endpoint(
+    request: ChatRequest,
+    http_response: Response,
+    db: Session = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=255),
+    latency_budget_ms: Optional[int] = Header(None, alias="X-Latency-Budget-Ms", ge=1, le=600000)
+):
     """
     Process a chat message with autonomous memory functionality
     
@@ -218,85 +1552,289 @@ async def chat_endpoint(request: ChatRequest, db: Session = Depends(get_db)):
     3. Generate a response using retrieved context if relevant
     4. Store the response in memory for future reference
     5. Return metadata about memory usage
+
+    Clients that retry should send an Idempotency-Key header: retries with the
+    same key wait for the in-flight turn, or get its stored response, instead
+    of running the agent and the memory writes again.
+
+    X-Latency-Budget-Ms (default LATENCY_BUDGET_MS) sets a deadline for the
+    turn: memory lookups that would not fit are skipped and memory writes are
+    finished in the background; skipped_stages and deferred_stages say which.
     """
+    budget = LatencyBudget.from_request(latency_budget_ms)
     try:
-        # Load conversation history from database
-        conversation_history = load_conversation_history(request.user_id, db)
-        
-        # Save user message to database
-        save_message(request.user_id, "User", request.message, db)
-        
-        # Process through memory-enabled agent
-        response = await process_query_with_memory(
-            user_id=request.user_id,
-            message=request.message,
-            conversation_history=conversation_history
-        )
-        
-        # Check if any memories exist for this user (for metadata)
-        memories = memory_service.retrieve_memories(request.user_id, request.message, top_k=3)
-        memory_count = len(memories)
-        would_retrieve = memory_count > 0
-        
-        # Save assistant response to database
-        save_message(request.user_id, "Assistant", response, db)
-        
-        # Get updated conversation history
-        updated_history = load_conversation_history(request.user_id, db)
-        
-        return ChatResponse(
-            user_id=request.user_id,
-            message=request.message,
-            response=response,
-            conversation_history=updated_history,
-            memory_retrieved=would_retrieve,
-            memory_count=memory_count
-        )
-        
+        if idempotency_key:
+            return await run_idempotent_chat_turn(request, idempotency_key, db, http_response, budget)
+        return await run_chat_turn(request, db, http_response, budget)
+
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error in chat_endpoint: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/chat/stream")
+async def chat_stream_endpoint(
+    request: ChatRequest,
+    db: Session = Depends(get_db),
+    latency_budget_ms: Optional[int] = Header(None, alias="X-Latency-Budget-Ms", ge=1, le=600000)
+):
+    """
+    Process a chat message like POST /chat, streaming the response as
+    server-sent events: `token` events with text as it is generated, then
+    `done` with the full response, or `error` if the turn failed
+    """
+    return StreamingResponse(
+        stream_chat_turn(request, db, LatencyBudget.from_request(latency_budget_ms)),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.websocket("/chat/ws/{user_id:path}")
+async def chat_websocket(websocket: WebSocket, user_id: str, db: Session = Depends(get_db)):
+    """
+    Long-lived chat session. The server first sends a `session` message
+    with the recent history; then each client message
+    {"message": ..., "latency_budget_ms": ...} runs one turn, streamed back
+    as `token` messages and a final `done` (or `error`), like /chat/stream.
+
+    The session keeps the recent-turn window between turns, so a turn only
+    checks the history version instead of reading the history. Turns are
+    written through to the database as they complete. Sessions close after
+    WS_IDLE_TIMEOUT_SECONDS idle, or earlier when the process is over its
+    session memory cap.
+    """
+    await websocket.accept()
+    session = ChatSession(user_id, websocket)
+    session.load(db)
+    chat_sessions.add(session)
+    try:
+        await websocket.send_json({
+            "type": "session",
+            "user_id": user_id,
+            "history_version": session.history_version,
+            "recent": list(session.recent),
+        })
+        while True:
+            try:
+                text = await asyncio.wait_for(websocket.receive_text(), timeout=WS_IDLE_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                await websocket.close(code=1000, reason="idle timeout")
+                return
+            try:
+                payload = ChatSocketMessage.model_validate_json(text)
+                request = ChatRequest(user_id=user_id, message=payload.message)
+            except ValidationError as e:
+                await websocket.send_json({"type": "error", "detail": e.errors(include_url=False, include_context=False)})
+                continue
+
+            session.busy = True
+            lease = None
+            try:
+                # Take the user's lease before checking the window, so a turn
+                # on another worker cannot land between the check and this turn
+                lease = await acquire_user_lease(user_id, db)
+                session.sync(db)
+                async for event, data in chat_turn_events(
+                    request, db, LatencyBudget.from_request(payload.latency_budget_ms), list(session.recent), "chat-ws", lease
+                ):
+                    if event == "done":
+                        session.record_turn(request.message, data["response"], data["history_version"])
+                    await websocket.send_json(dict(data, type=event))
+            except HTTPException as e:
+                await websocket.send_json({"type": "error", "detail": e.detail})
+            finally:
+                if lease is not None:
+                    lease.release()
+                session.busy = False
+                session.last_active = time.monotonic()
+            chat_sessions.enforce_cap()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        chat_sessions.remove(session)
 
-@app.get("/chat/history/{user_id}")
-async def get_chat_history(user_id: str, db: Session = Depends(get_db)):
+@app.get("/chat/history/{user_id:path}", response_model=HistoryResponse)
+async def get_chat_history(
+    user_id: str,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=500, description="Page size; omit for the full history"),
+    before_id: Optional[int] = Query(None, description="Cursor from next_before_id to fetch older messages"),
+    since: Optional[int] = Query(None, ge=0, description="history_version (or next_since_id) to fetch only newer messages"),
+    if_none_match: Optional[str] = Header(None, alias="If-None-Match"),
+    db: Session = Depends(get_db)
+):
     """
     Get conversation history for a specific user
+
+    With `limit`, returns the newest page (or the page before `before_id`)
+    and a `next_before_id` cursor while older messages remain. With `since`,
+    returns only messages added after that history_version, oldest first
+    (`limit` at a time, continuing from `next_since_id`).
+
+    Responses carry an ETag from the chat's revision and the normalized
+    query (so each page has its own tag); a request whose If-None-Match
+    matches gets 304 without the history being read.
     """
+    if since is not None and before_id is not None:
+        raise HTTPException(status_code=400, detail="Use either since or before_id, not both")
     try:
-        conversation_history = load_conversation_history(user_id, db)
+        revision = chat_revision(user_id, db)
+        etag = (f'W/"rev={revision};limit={limit or ""};before={before_id or ""};'
+                f'since={"" if since is None else since}"')
+        if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+        has_more, next_before_id, next_since_id = False, None, None
+        if since is not None:
+            rows, has_more = load_history_since(user_id, db, since, limit)
+            next_since_id = rows[-1].id if has_more else None
+            conversation_history = [(row.speaker, row.message) for row in rows]
+        elif limit is None:
+            conversation_history = load_conversation_history(user_id, db)
+        else:
+            rows, has_more = load_history_page(user_id, db, limit, before_id)
+            conversation_history = [(row.speaker, row.message) for row in rows]
+            next_before_id = rows[0].id if has_more and rows else None
         
-        return {
-            "user_id": user_id,
-            "conversation_history": conversation_history,
-            "message_count": len(conversation_history)
-        }
+        newest, _ = history_version(user_id, db)
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "no-cache"
+        return HistoryResponse(
+            user_id=user_id,
+            conversation_history=conversation_history,
+            message_count=len(conversation_history),
+            has_more=has_more,
+            next_before_id=next_before_id,
+            next_since_id=next_since_id,
+            history_version=newest
+        )
         
     except Exception as e:
         print(f"Error retrieving chat history: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.delete("/chat/history/{user_id}")
+@app.delete("/chat/history/{user_id:path}")
 async def clear_chat_history(user_id: str, db: Session = Depends(get_db)):
     """
     Clear conversation history for a specific user from database
     Note: This does not clear memories from Pinecone vector database
     """
+    # Under the user's lease, so no turn is between its history read and its
+    # reply save while the history goes away
+    lease = await acquire_user_lease(user_id, db)
     try:
         # Delete messages from database
+        lease.fence(db)
         db.query(ChatMessage).filter(ChatMessage.chat_id == user_id).delete()
+        bump_revision(user_id, db)
         db.commit()
         
         return {
             "user_id": user_id,
             "message": "Chat history cleared from database",
-            "note": "Memories in vector database are preserved"
+            "note": "Memories in vector database are preserved; POST /admin/purge removes both"
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error clearing chat history: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        lease.release()
+
+@app.get("/agent/tiers")
+async def get_tier_stats():
+    """
+    How turns were routed across model tiers (and canned replies), with
+    latency percentiles, token usage and estimated cost per tier, for tuning
+    the routing thresholds
+    """
+    return tier_stats.snapshot()
+
+@app.get("/memories/test/{user_id:path}")
+async def test_memories(
+    user_id: str,
+    query: str = Query(..., min_length=1, description="Text to match memories against"),
+    top_k: int = Query(5, ge=1, le=100, description="Candidates to return")
+):
+    """
+    Show which memories a query would retrieve: the ranked candidates with
+    their scores and whether they clear the retrieval threshold. Nothing is
+    stored and the retrieval statistics are not updated.
+    """
+    try:
+        candidates = await asyncio.to_thread(memory_service.search_memories, user_id, query, top_k)
+    except Exception as e:
+        print(f"Error testing memories: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    return {
+        "user_id": user_id,
+        "query": query,
+        "threshold": MEMORY_SCORE_THRESHOLD,
+        "candidates": candidates,
+        "would_retrieve": sum(1 for candidate in candidates if candidate["above_threshold"])
+    }
+
+@app.get("/memories/stats/{user_id:path}")
+async def get_memory_stats(user_id: str):
+    """
+    Memory statistics for a user, kept in the chat database by every store
+    (live or backfill) and retrieval on any worker, so reading them needs no
+    index scan. Timestamps are Unix seconds.
+    """
+    return {"user_id": user_id, **await asyncio.to_thread(memory_service.stats.snapshot, user_id)}
+
+@app.post("/memories/store")
+async def store_memory(request: MemoryStoreRequest):
+    """Manually store a memory for testing; it is not added to the chat history"""
+    stored = await asyncio.to_thread(memory_service.store_message, request.user_id, request.message, request.message_type)
+    if not stored:
+        raise HTTPException(status_code=503, detail="Memory could not be stored")
+    return {"user_id": request.user_id, "message_type": request.message_type, "stored": True}
+
+@app.get("/admin/history/export", dependencies=[Depends(require_admin)])
+async def export_history(
+    user_id: Optional[str] = None,
+    since: Optional[datetime] = Query(None, description="Only messages created at or after this time"),
+    until: Optional[datetime] = Query(None, description="Only messages created before this time"),
+    db: Session = Depends(get_db)
+):
+    """
+    Stream chat history as NDJSON, one message per line in id order, for
+    all users or one user and/or a time range
+    """
+    return StreamingResponse(
+        iter_history_ndjson(db, user_id, since, until),
+        media_type="application/x-ndjson"
+    )
+
+@app.post("/admin/history/import", dependencies=[Depends(require_admin)])
+async def import_history(request: Request, db: Session = Depends(get_db)):
+    """
+    Bulk insert chat history from an NDJSON request body in the export
+    format. The body is read as a stream and inserted in batches.
+    """
+    return await import_history_ndjson(request, db)
+
+@app.post("/admin/purge", status_code=202, dependencies=[Depends(require_admin)])
+async def start_purge(request: PurgeRequest, db: Session = Depends(get_db)):
+    """
+    Start a background job that deletes the users' SQL history and all of
+    their vectors in the memory index. Poll GET /admin/purge/{job_id}.
+    """
+    job = start_purge_job(request.user_ids, db)
+    return describe_purge_job(job)
+
+@app.get("/admin/purge/{job_id}", dependencies=[Depends(require_admin)])
+async def get_purge_status(job_id: str, db: Session = Depends(get_db)):
+    """Progress of a purge job; any worker can answer since jobs are stored in the database"""
+    job = db.query(PurgeJob).filter(PurgeJob.id == job_id).one_or_none()
+    if job is None:
+        raise HTTPException(status_code=404, detail="Purge job not found")
+    return describe_purge_job(job)
 
 
 # -----------------------------------
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Backfill Pinecone memories from the SQL chat history.
+
+Reads chat_messages in id order, CHUNK rows at a time, embeds them in large
+batches (several requests in flight, optionally rate limited) and upserts
+the vectors in bulk. Vectors are keyed by the chat_messages row id, like the
+ones written by MemoryService.store_message for a turn, so re-running over
+the same rows, or over rows already stored live, overwrites instead of
+duplicating.
+
+Progress (last row id, messages, tokens) is checkpointed to a JSON file
+after every chunk; a crashed or interrupted run resumes from there.
+
+Usage:
+    python backfill.py --dry-run                         # rows and cost estimate only
+    python backfill.py --concurrency 8 --max-requests-per-second 20
+    python backfill.py --user-id alice --checkpoint alice.json
+    python backfill.py --restart                         # ignore an existing checkpoint
+"""
+
+import argparse
+import calendar
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import List, Optional, Tuple
+
+from sqlalchemy import func
+
+from api import ChatMessage, SessionLocal, init_db
+from my_agent import EMBEDDING_MODEL, MemoryService, get_embeddings, memory_service
+
+# USD per million input tokens of EMBEDDING_MODEL
+DEFAULT_PRICE_PER_MILLION = 0.02
+# Rough tokens per character, for --dry-run estimates
+TOKENS_PER_CHAR = 0.25
+
+
+class RateLimiter:
+    """Spaces calls at least 1/per_second apart across threads; 0 disables it."""
+
+    def __init__(self, per_second: float):
+        self.interval = 1.0 / per_second if per_second > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        time.sleep(max(0.0, slot - now))
+
+
+def with_retries(func, attempts: int, *args, **kwargs):
+    """Call func, retrying failures with exponential backoff (1s, 2s, 4s... capped at 30s)."""
+    for attempt in range(attempts):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt == attempts - 1:
+                raise
+            print(f"  retry {attempt + 1}/{attempts - 1} after error: {e}", file=sys.stderr)
+            time.sleep(min(30, 2 ** attempt))
+
+
+@dataclass
+class Checkpoint:
+    user_id: Optional[str] = None
+    last_id: int = 0
+    messages: int = 0
+    tokens: int = 0
+    elapsed_s: float = 0.0
+
+    @classmethod
+    def load(cls, path: str) -> Optional["Checkpoint"]:
+        if not os.path.exists(path):
+            return None
+        with open(path) as handle:
+            return cls(**json.load(handle))
+
+    def save(self, path: str) -> None:
+        """Write atomically so a crash never leaves a truncated checkpoint."""
+        temporary = f"{path}.tmp"
+        with open(temporary, "w") as handle:
+            json.dump(asdict(self), handle)
+        os.replace(temporary, path)
+
+
+def _message_type(speaker: str) -> str:
+    return "user" if speaker == "User" else "assistant"
+
+
+def _timestamp(row: ChatMessage) -> str:
+    # created_at is naive UTC (datetime.utcnow)
+    return str(calendar.timegm(row.created_at.utctimetuple())) if row.created_at else "0"
+
+
+class Backfill:
+    def __init__(self, args, checkpoint: Checkpoint):
+        self.args = args
+        self.checkpoint = checkpoint
+        self.embed_limiter = RateLimiter(args.max_requests_per_second)
+        self.pool = ThreadPoolExecutor(max_workers=args.concurrency)
+
+    def _query(self, db):
+        query = db.query(ChatMessage).filter(ChatMessage.id > self.checkpoint.last_id)
+        if self.args.user_id:
+            query = query.filter(ChatMessage.chat_id == self.args.user_id)
+        return query
+
+    def fetch_chunk(self) -> List[ChatMessage]:
+        db = SessionLocal()
+        try:
+            return self._query(db).order_by(ChatMessage.id).limit(self.args.chunk_size).all()
+        finally:
+            db.close()
+
+    def remaining(self) -> Tuple[int, int]:
+        """(rows, characters) still to backfill"""
+        db = SessionLocal()
+        try:
+            rows, characters = self._query(db).with_entities(
+                func.count(ChatMessage.id), func.coalesce(func.sum(func.length(ChatMessage.message)), 0)
+            ).one()
+            return rows, int(characters)
+        finally:
+            db.close()
+
+    def _embed(self, texts: List[str]) -> Tuple[List[List[float]], int]:
+        self.embed_limiter.wait()
+        return with_retries(get_embeddings, self.args.retries, texts)
+
+    def _upsert(self, records: List[dict]) -> None:
+        with_retries(memory_service.index.upsert, self.args.retries, vectors=records)
+        memory_service.stats.record_stores(records)
+
+    def process_chunk(self, rows: List[ChatMessage]) -> int:
+        """Embed and upsert one chunk; returns the tokens billed."""
+        rows = [row for row in rows if row.message and row.message.strip()]
+        if not rows:
+            return 0
+        size = self.args.embed_batch
+        batches = [rows[i:i + size] for i in range(0, len(rows), size)]
+        results = list(self.pool.map(self._embed, [[row.message for row in batch] for batch in batches]))
+
+        records = [
+            MemoryService.memory_record(row.chat_id, row.message, _message_type(row.speaker), _timestamp(row), embedding, row.id)
+            for batch, (embeddings, _) in zip(batches, results)
+            for row, embedding in zip(batch, embeddings)
+        ]
+        size = self.args.upsert_batch
+        list(self.pool.map(self._upsert, [records[i:i + size] for i in range(0, len(records), size)]))
+        return sum(tokens for _, tokens in results)
+
+    def cost(self, tokens: int) -> float:
+        return tokens / 1e6 * self.args.price_per_million
+
+    def run(self) -> None:
+        started = time.perf_counter()
+        previous_elapsed = self.checkpoint.elapsed_s
+        session_messages = 0
+        while True:
+            rows = self.fetch_chunk()
+            if not rows:
+                break
+            tokens = self.process_chunk(rows)
+
+            self.checkpoint.last_id = rows[-1].id
+            self.checkpoint.messages += len(rows)
+            self.checkpoint.tokens += tokens
+            self.checkpoint.elapsed_s = previous_elapsed + time.perf_counter() - started
+            self.checkpoint.save(self.args.checkpoint)
+
+            session_messages += len(rows)
+            rate = session_messages / (time.perf_counter() - started)
+            print(f"through id {self.checkpoint.last_id}: {self.checkpoint.messages} messages, "
+                  f"{rate:.0f} messages/s, {self.checkpoint.tokens} tokens, ${self.cost(self.checkpoint.tokens):.4f}")
+        self.pool.shutdown()
+
+        elapsed = time.perf_counter() - started
+        print(f"Done: {session_messages} messages this run in {elapsed:.1f}s "
+              f"({session_messages / elapsed if elapsed else 0:.0f} messages/s); total {self.checkpoint.messages} messages, "
+              f"{self.checkpoint.tokens} tokens, ${self.cost(self.checkpoint.tokens):.4f} with {EMBEDDING_MODEL}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill Pinecone memories from the SQL chat history")
+    parser.add_argument("--checkpoint", default="backfill_checkpoint.json", help="Progress file for resuming")
+    parser.add_argument("--restart", action="store_true", help="Ignore an existing checkpoint")
+    parser.add_argument("--user-id", default=None, help="Only backfill this user")
+    parser.add_argument("--chunk-size", type=int, default=2000, help="Rows read from SQL per checkpoint")
+    parser.add_argument("--embed-batch", type=int, default=500, help="Texts per embeddings request (max 2048)")
+    parser.add_argument("--upsert-batch", type=int, default=200, help="Vectors per Pinecone upsert")
+    parser.add_argument("--concurrency", type=int, default=4, help="Embedding/upsert requests in flight")
+    parser.add_argument("--max-requests-per-second", type=float, default=0, help="Embedding request rate limit (0 = none)")
+    parser.add_argument("--retries", type=int, default=5, help="Attempts per request")
+    parser.add_argument("--price-per-million", type=float, default=DEFAULT_PRICE_PER_MILLION,
+                        help="USD per million embedding tokens")
+    parser.add_argument("--dry-run", action="store_true", help="Only report remaining rows and estimated cost")
+    args = parser.parse_args()
+
+    checkpoint = None if args.restart else Checkpoint.load(args.checkpoint)
+    if checkpoint is not None and checkpoint.user_id != args.user_id:
+        print(f"{args.checkpoint} was written for user_id={checkpoint.user_id!r}; use --restart or another --checkpoint")
+        sys.exit(1)
+    if checkpoint is not None:
+        print(f"Resuming after id {checkpoint.last_id} ({checkpoint.messages} messages done)")
+    checkpoint = checkpoint or Checkpoint(user_id=args.user_id)
+
+    # The memory stats tables may not exist yet when the API never ran against this database
+    init_db()
+    backfill = Backfill(args, checkpoint)
+    rows, characters = backfill.remaining()
+    estimated_tokens = int(characters * TOKENS_PER_CHAR)
+    print(f"{rows} messages to backfill, about {estimated_tokens} tokens (~${backfill.cost(estimated_tokens):.4f})")
+    if args.dry_run or not rows:
+        return
+    backfill.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Shared pieces for the offline benchmarks: start the API against the local
+stand-ins, record per-stage latencies and compare reports to a baseline.
+"""
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from typing import Dict, List, Optional
+
+from standins import StandInConfig, StandInServer
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def parse_server_timing(header: Optional[str]) -> Dict[str, float]:
+    """Parse "name;dur=12.3, other;dur=4" into {"name": 12.3, "other": 4.0}."""
+    timings = {}
+    for entry in (header or "").split(","):
+        name, _, params = entry.strip().partition(";")
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "dur" and name:
+                timings[name] = float(value)
+    return timings
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an unsorted list."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+class LatencyRecorder:
+    """Collects latency samples per stage plus request outcomes."""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+        self.ok = 0
+        self.failed = 0
+        self.started = time.perf_counter()
+        self.finished: Optional[float] = None
+
+    def record(self, stage: str, ms: float) -> None:
+        self.samples.setdefault(stage, []).append(ms)
+
+    def record_request(self, ok: bool, end_to_end_ms: float, server_timing: Optional[str] = None) -> None:
+        if ok:
+            self.ok += 1
+        else:
+            self.failed += 1
+        self.record("end_to_end", end_to_end_ms)
+        for stage, ms in parse_server_timing(server_timing).items():
+            self.record(stage, ms)
+
+    def stop(self) -> None:
+        self.finished = time.perf_counter()
+
+    def report(self) -> dict:
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        stages = {
+            stage: {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 50), 1),
+                "p95_ms": round(percentile(values, 95), 1),
+                "p99_ms": round(percentile(values, 99), 1),
+            }
+            for stage, values in sorted(self.samples.items())
+        }
+        return {
+            "requests": self.ok + self.failed,
+            "errors": self.failed,
+            "duration_s": round(elapsed, 2),
+            "throughput_rps": round((self.ok + self.failed) / elapsed, 2) if elapsed else 0.0,
+            "stages": stages,
+        }
+
+
+def format_report(report: dict) -> str:
+    lines = [
+        f"requests={report['requests']} errors={report['errors']} "
+        f"duration={report['duration_s']}s throughput={report['throughput_rps']} req/s",
+        f"{'stage':<26}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}",
+    ]
+    for stage, stats in report["stages"].items():
+        lines.append(f"{stage:<26}{stats['count']:>8}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+    return "\n".join(lines)
+
+
+def compare_to_baseline(report: dict, baseline: dict, tolerance: float, min_delta_ms: float = 5.0) -> List[str]:
+    """
+    Return human-readable regressions: p95 above, or throughput below,
+    baseline by more than tolerance. p95 changes smaller than min_delta_ms
+    are noise on millisecond-scale stages and are ignored.
+    """
+    regressions = []
+    for stage, stats in report["stages"].items():
+        reference = baseline.get("stages", {}).get(stage)
+        if (reference and reference["p95_ms"] > 0
+                and stats["p95_ms"] > reference["p95_ms"] * (1 + tolerance)
+                and stats["p95_ms"] - reference["p95_ms"] >= min_delta_ms):
+            regressions.append(f"{stage} p95 {stats['p95_ms']}ms > baseline {reference['p95_ms']}ms")
+    if baseline.get("throughput_rps") and report["throughput_rps"] < baseline["throughput_rps"] * (1 - tolerance):
+        regressions.append(f"throughput {report['throughput_rps']} < baseline {baseline['throughput_rps']} req/s")
+    return regressions
+
+
+def load_json(path: str) -> Optional[dict]:
+    if not os.path.exists(path):
+        return None
+    with open(path) as handle:
+        return json.load(handle)
+
+
+def save_json(path: str, data: dict) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as handle:
+        json.dump(data, handle, indent=2)
+        handle.write("\n")
+
+
+class OfflineStack:
+    """
+    Starts the stand-ins in-process and the API as a uvicorn subprocess wired
+    to them, with a throwaway SQLite database. Use as a context manager.
+    """
+
+    def __init__(self, config: Optional[StandInConfig] = None, workers: int = 1,
+                 database_url: Optional[str] = None, extra_env: Optional[Dict[str, str]] = None):
+        self.standins = StandInServer(config)
+        self.workers = workers
+        self.port = free_port()
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        self._tempdir = tempfile.TemporaryDirectory(prefix="chat-bench-")
+        self.database_url = database_url or f"sqlite:///{os.path.join(self._tempdir.name, 'chat_history.db')}"
+        self.extra_env = extra_env or {}
+        self._process: Optional[subprocess.Popen] = None
+
+    def _env(self) -> Dict[str, str]:
+        env = dict(os.environ)
+        env.update({
+            "OPENAI_API_KEY": "offline",
+            "PINECONE_API_KEY": "offline",
+            "OPENAI_BASE_URL": f"{self.standins.url}/v1",
+            "PINECONE_INDEX_HOST": self.standins.url,
+            "OPENAI_API_MODE": "chat_completions",
+            "OPENAI_AGENTS_DISABLE_TRACING": "1",
+            "DATABASE_URL": self.database_url,
+        })
+        env.update(self.extra_env)
+        return env
+
+    def __enter__(self) -> "OfflineStack":
+        self.standins.start()
+        # Server logs go to a file: a pipe nobody drains would eventually block the server
+        self.log_path = os.path.join(self._tempdir.name, "api.log")
+        self._log = open(self.log_path, "w")
+        self._process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "api:app", "--host", "127.0.0.1", "--port", str(self.port),
+             "--workers", str(self.workers), "--log-level", "warning"],
+            cwd=BACKEND_DIR, env=self._env(), stdout=subprocess.DEVNULL, stderr=self._log
+        )
+        self._wait_ready(timeout=60)
+        return self
+
+    def _wait_ready(self, timeout: float) -> None:
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            if self._process.poll() is not None:
+                with open(self.log_path) as log:
+                    raise RuntimeError(f"API exited during startup:\n{log.read()[-2000:]}")
+            try:
+                with urllib.request.urlopen(f"{self.base_url}/ready", timeout=1) as response:
+                    if response.status == 200:
+                        return
+            except (urllib.error.URLError, ConnectionError, OSError):
+                pass
+            time.sleep(0.1)
+        raise RuntimeError(f"API not ready after {timeout:.0f}s")
+
+    def __exit__(self, *exc) -> None:
+        if self._process is not None:
+            self._process.terminate()
+            try:
+                self._process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+            self._log.close()
+        self.standins.stop()
+        self._tempdir.cleanup()
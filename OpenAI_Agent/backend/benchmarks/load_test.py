@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Offline load test for POST /chat.
+
+Starts the API against local OpenAI/Pinecone stand-ins (no network, no
+keys), drives it with simulated users holding multi-turn conversations,
+and reports throughput plus p50/p95/p99 per stage (end-to-end from the
+client, the rest from the Server-Timing header).
+
+The report can be saved as a baseline; later runs are compared against it
+and exit non-zero when p95 or throughput regress beyond the tolerance.
+
+Usage:
+    python benchmarks/load_test.py --users 20 --turns 5
+    python benchmarks/load_test.py --save-baseline
+    python benchmarks/load_test.py --workers 2 --save-baseline
+    python benchmarks/load_test.py --chat-latency 800:0.6:0.02 --tolerance 0.25
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+import httpx
+
+from harness import (
+    RESULTS_DIR, LatencyRecorder, OfflineStack, compare_to_baseline,
+    format_report, load_json, save_json,
+)
+from standins import LatencyProfile, StandInConfig
+
+BASELINE_FILE = os.path.join(RESULTS_DIR, "load_baseline.json")
+
+
+def baseline_file(workers: int) -> str:
+    """Each worker count has its own baseline; one worker keeps the original file"""
+    if workers == 1:
+        return BASELINE_FILE
+    return os.path.join(RESULTS_DIR, f"load_baseline_workers{workers}.json")
+
+FACTS = [
+    "My favorite food is {food}.", "I just got back from {place}.", "I work as a {job}.",
+    "I have a dog named {pet}.", "I'm learning {hobby} this year.",
+]
+QUESTIONS = [
+    "What's my favorite food?", "Do you remember where I traveled?", "What do I do for work?",
+    "Can you recall my dog's name?", "What did we discuss about {hobby}?",
+]
+SMALL_TALK = [
+    "Thanks!", "How's it going?", "Can you explain how vaccines work?",
+    "Give me three ideas for a weekend trip near {place}.", "Write a haiku about {food}.",
+]
+FILLERS = {
+    "food": ["sushi", "lasagna", "tacos", "pho"], "place": ["Lisbon", "Kyoto", "Denver", "Oslo"],
+    "job": ["nurse", "data engineer", "teacher"], "pet": ["Biscuit", "Luna", "Rex"],
+    "hobby": ["guitar", "rock climbing", "Spanish"],
+}
+
+
+def synthetic_message(rng: random.Random, turn: int) -> str:
+    """Facts early in a conversation, a mix of recall questions and small talk later."""
+    pool = FACTS if turn < 2 else rng.choice([FACTS, QUESTIONS, QUESTIONS, SMALL_TALK])
+    template = rng.choice(pool)
+    return template.format(**{key: rng.choice(values) for key, values in FILLERS.items()})
+
+
+async def send_turn(client: httpx.AsyncClient, user_id: str, message: str, recorder: LatencyRecorder) -> None:
+    start = time.perf_counter()
+    try:
+        response = await client.post("/chat", json={"user_id": user_id, "message": message})
+        ok = response.status_code == 200
+        server_timing = response.headers.get("server-timing")
+    except httpx.HTTPError:
+        ok, server_timing = False, None
+    recorder.record_request(ok, (time.perf_counter() - start) * 1000, server_timing)
+
+
+async def simulate_user(client, user_id: str, turns: int, think_ms: float, start_delay: float,
+                        rng: random.Random, recorder: LatencyRecorder) -> None:
+    await asyncio.sleep(start_delay)
+    for turn in range(turns):
+        await send_turn(client, user_id, synthetic_message(rng, turn), recorder)
+        # Exponential think time between a reply and the user's next message
+        await asyncio.sleep(rng.expovariate(1000 / think_ms) if think_ms > 0 else 0)
+
+
+async def run_load(base_url: str, users: int, turns: int, think_ms: float, ramp_s: float, seed: int) -> LatencyRecorder:
+    recorder = LatencyRecorder()
+    limits = httpx.Limits(max_connections=users, max_keepalive_connections=users)
+    async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as client:
+        await asyncio.gather(*[
+            simulate_user(client, f"load-user-{index}", turns, think_ms, ramp_s * index / max(users, 1),
+                          random.Random(seed + index), recorder)
+            for index in range(users)
+        ])
+    recorder.stop()
+    return recorder
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test for /chat")
+    parser.add_argument("--users", type=int, default=20, help="Concurrent simulated users")
+    parser.add_argument("--turns", type=int, default=5, help="Messages per user")
+    parser.add_argument("--think-ms", type=float, default=500, help="Mean think time between turns")
+    parser.add_argument("--ramp-s", type=float, default=2.0, help="Spread user start times over this many seconds")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--embed-latency", default="40:0.3:0", help="median_ms:sigma:error_rate")
+    parser.add_argument("--chat-latency", default="600:0.5:0", help="median_ms:sigma:error_rate")
+    parser.add_argument("--upsert-latency", default="30:0.3:0", help="median_ms:sigma:error_rate")
+    parser.add_argument("--query-latency", default="25:0.3:0", help="median_ms:sigma:error_rate")
+    parser.add_argument("--baseline", help="Baseline report to compare against (default: per worker count)")
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression")
+    args = parser.parse_args()
+    args.baseline = args.baseline or baseline_file(args.workers)
+
+    config = StandInConfig(
+        embeddings=LatencyProfile.parse(args.embed_latency),
+        chat=LatencyProfile.parse(args.chat_latency),
+        upsert=LatencyProfile.parse(args.upsert_latency),
+        query=LatencyProfile.parse(args.query_latency),
+        seed=args.seed,
+    )
+
+    with OfflineStack(config, workers=args.workers) as stack:
+        recorder = asyncio.run(run_load(stack.base_url, args.users, args.turns, args.think_ms, args.ramp_s, args.seed))
+        upstream = stack.standins.snapshot()
+
+    report = recorder.report()
+    report["upstream"] = upstream
+    report["config"] = {key: value for key, value in vars(args).items() if key not in ("baseline", "save_baseline")}
+    print(format_report(report))
+    print(f"upstream calls={upstream['calls']} errors={upstream['errors']}")
+
+    if args.save_baseline:
+        save_json(args.baseline, report)
+        print(f"Saved baseline to {args.baseline}")
+        return
+
+    baseline = load_json(args.baseline)
+    if baseline is None:
+        print("No baseline found; run with --save-baseline to create one")
+        return
+    if baseline.get("config") != report["config"]:
+        print("Warning: baseline was recorded with a different configuration")
+    regressions = compare_to_baseline(report, baseline, args.tolerance)
+    if regressions:
+        print("Regressions against baseline:")
+        for regression in regressions:
+            print(f"  - {regression}")
+        sys.exit(1)
+    print("No regressions against baseline")
+
+
+if __name__ == "__main__":
+    main()
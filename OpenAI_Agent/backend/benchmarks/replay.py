@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Replay recorded conversations from a chat_history.db against the API.
+
+Reads ChatMessage rows (table chat_messages), rebuilds every user's turn
+order and the gaps between their messages, and re-sends the User messages
+to /chat on the original schedule divided by --speed. Assistant rows are
+not sent; the API generates fresh replies. A user's next message is sent
+no earlier than its scheduled time and never before the previous reply
+arrived, as a real client would.
+
+The API runs against the local OpenAI/Pinecone stand-ins (see
+standins.py). The report has per-stage latency percentiles plus how the
+vector store grew over the replay, and can be saved and compared across
+builds.
+
+Usage:
+    python benchmarks/replay.py /path/to/chat_history.db --speed 60
+    python benchmarks/replay.py prod.db --speed 60 --save results/replay_main.json
+    python benchmarks/replay.py prod.db --speed 60 --compare results/replay_main.json
+"""
+
+import argparse
+import asyncio
+import sqlite3
+import sys
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import httpx
+
+from harness import LatencyRecorder, OfflineStack, compare_to_baseline, format_report, load_json, save_json
+from standins import StandInServer
+
+
+@dataclass
+class RecordedConversation:
+    user_id: str
+    # (seconds since the first message in the whole recording, message text)
+    turns: List[tuple] = field(default_factory=list)
+
+
+def _parse_timestamp(value) -> Optional[datetime]:
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+
+
+def load_conversations(db_path: str, max_gap_s: Optional[float] = None,
+                       limit_users: Optional[int] = None) -> List[RecordedConversation]:
+    """
+    Read User rows ordered by time and turn them into per-user schedules.
+    Gaps longer than max_gap_s (idle users, overnight breaks) are clamped so
+    replays stay short without changing the burst structure.
+    """
+    connection = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        rows = connection.execute(
+            "SELECT chat_id, message, created_at FROM chat_messages "
+            "WHERE speaker = 'User' ORDER BY created_at, id"
+        ).fetchall()
+    finally:
+        connection.close()
+
+    parsed = [(chat_id, message, _parse_timestamp(created_at)) for chat_id, message, created_at in rows]
+    parsed = [row for row in parsed if row[2] is not None]
+    if not parsed:
+        return []
+    origin = parsed[0][2]
+
+    conversations: Dict[str, RecordedConversation] = {}
+    last_seen: Dict[str, float] = {}
+    shift: Dict[str, float] = {}
+    for chat_id, message, created_at in parsed:
+        if chat_id not in conversations:
+            if limit_users is not None and len(conversations) >= limit_users:
+                continue
+            conversations[chat_id] = RecordedConversation(chat_id)
+            shift[chat_id] = 0.0
+        offset = (created_at - origin).total_seconds() - shift[chat_id]
+        previous = last_seen.get(chat_id)
+        if previous is not None and max_gap_s is not None and offset - previous > max_gap_s:
+            shift[chat_id] += offset - previous - max_gap_s
+            offset = previous + max_gap_s
+        last_seen[chat_id] = offset
+        conversations[chat_id].turns.append((offset, message))
+    return list(conversations.values())
+
+
+def describe_workload(conversations: List[RecordedConversation]) -> dict:
+    """Summarize turn counts and message lengths of the recording."""
+    turn_counts = sorted(len(conversation.turns) for conversation in conversations)
+    lengths = sorted(len(message) for conversation in conversations for _, message in conversation.turns)
+    span = max((conversation.turns[-1][0] for conversation in conversations), default=0.0)
+    return {
+        "users": len(conversations),
+        "messages": len(lengths),
+        "recorded_span_s": round(span, 1),
+        "turns_per_user_median": turn_counts[len(turn_counts) // 2] if turn_counts else 0,
+        "turns_per_user_max": turn_counts[-1] if turn_counts else 0,
+        "message_chars_median": lengths[len(lengths) // 2] if lengths else 0,
+        "message_chars_max": lengths[-1] if lengths else 0,
+    }
+
+
+async def replay_conversation(client: httpx.AsyncClient, conversation: RecordedConversation, speed: float,
+                              started: float, recorder: LatencyRecorder) -> None:
+    for offset, message in conversation.turns:
+        delay = started + offset / speed - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        request_start = time.perf_counter()
+        try:
+            response = await client.post("/chat", json={"user_id": conversation.user_id, "message": message})
+            ok, server_timing = response.status_code == 200, response.headers.get("server-timing")
+        except httpx.HTTPError:
+            ok, server_timing = False, None
+        recorder.record_request(ok, (time.perf_counter() - request_start) * 1000, server_timing)
+
+
+async def sample_store_growth(standins: StandInServer, started: float, interval_s: float,
+                              samples: List[dict], stop: asyncio.Event) -> None:
+    while True:
+        snapshot = standins.snapshot()
+        samples.append({
+            "t_s": round(time.perf_counter() - started, 2),
+            "vectors": snapshot["vectors"],
+            "store_bytes": snapshot["store_bytes"],
+        })
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval_s)
+            return
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_replay(stack: OfflineStack, conversations: List[RecordedConversation], speed: float,
+                     concurrency: int, sample_interval_s: float) -> dict:
+    recorder = LatencyRecorder()
+    growth: List[dict] = []
+    stop = asyncio.Event()
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=stack.base_url, timeout=120, limits=limits) as client:
+        started = time.perf_counter()
+        sampler = asyncio.create_task(sample_store_growth(stack.standins, started, sample_interval_s, growth, stop))
+        await asyncio.gather(*[
+            replay_conversation(client, conversation, speed, started, recorder) for conversation in conversations
+        ])
+        stop.set()
+        await sampler
+    recorder.stop()
+
+    report = recorder.report()
+    final = stack.standins.snapshot()
+    messages = max(report["requests"], 1)
+    report["memory_store"] = {
+        "vectors": final["vectors"],
+        "store_bytes": final["store_bytes"],
+        "vectors_per_message": round(final["vectors"] / messages, 2),
+        "bytes_per_message": round(final["store_bytes"] / messages, 1),
+        "growth": growth,
+    }
+    report["upstream_calls"] = final["calls"]
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded chat traffic against the API")
+    parser.add_argument("database", help="Path to a chat_history.db SQLite file")
+    parser.add_argument("--speed", type=float, default=60.0, help="Replay speed multiplier (60 = one hour per minute)")
+    parser.add_argument("--max-gap-s", type=float, default=3600.0, help="Clamp idle gaps within a conversation")
+    parser.add_argument("--limit-users", type=int, default=None, help="Replay only the first N users")
+    parser.add_argument("--concurrency", type=int, default=100, help="Maximum open connections to the API")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument("--sample-interval-s", type=float, default=1.0, help="Memory-store sampling interval")
+    parser.add_argument("--save", default=None, help="Write the report to this JSON file")
+    parser.add_argument("--compare", default=None, help="Compare against a previously saved report")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression")
+    args = parser.parse_args()
+
+    conversations = load_conversations(args.database, args.max_gap_s, args.limit_users)
+    if not conversations:
+        print(f"No User messages found in {args.database}")
+        sys.exit(1)
+    workload = describe_workload(conversations)
+    print(f"Replaying {workload['messages']} messages from {workload['users']} users "
+          f"(recorded span {workload['recorded_span_s']}s, speed x{args.speed})")
+
+    with OfflineStack(workers=args.workers) as stack:
+        report = asyncio.run(run_replay(stack, conversations, args.speed, args.concurrency, args.sample_interval_s))
+    report["workload"] = workload
+    report["speed"] = args.speed
+
+    print(format_report(report))
+    store = report["memory_store"]
+    print(f"memory store: vectors={store['vectors']} bytes={store['store_bytes']} "
+          f"({store['vectors_per_message']} vectors, {store['bytes_per_message']} bytes per message)")
+
+    if args.save:
+        save_json(args.save, report)
+        print(f"Saved report to {args.save}")
+
+    if args.compare:
+        reference = load_json(args.compare)
+        if reference is None:
+            print(f"No report at {args.compare}")
+            sys.exit(1)
+        regressions = compare_to_baseline(report, reference, args.tolerance)
+        reference_bytes = reference.get("memory_store", {}).get("bytes_per_message")
+        if reference_bytes and store["bytes_per_message"] > reference_bytes * (1 + args.tolerance):
+            regressions.append(f"memory store {store['bytes_per_message']} bytes/message > {reference_bytes}")
+        if regressions:
+            print("Regressions against reference:")
+            for regression in regressions:
+                print(f"  - {regression}")
+            sys.exit(1)
+        print("No regressions against reference")
+
+
+if __name__ == "__main__":
+    main()
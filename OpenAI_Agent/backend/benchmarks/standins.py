@@ -0,0 +1,385 @@
+"""
+Local stand-ins for the OpenAI and Pinecone HTTP APIs used by the backend.
+
+One threaded HTTP server answers:
+- POST /v1/embeddings            deterministic bag-of-words embeddings
+- POST /v1/chat/completions      canned replies (streamed when stream=true); calls retrieve_relevant_memories
+                                 when the message contains a memory trigger
+- POST /vectors/upsert, /query, /vectors/delete, /describe_index_stats; GET /vectors/list
+                                 an in-memory Pinecone index
+
+Every route sleeps for a latency drawn from a configurable log-normal
+distribution and fails with a configurable probability, so the backend can
+be load tested offline with production-like upstream behaviour.
+
+Point the backend at it with OPENAI_BASE_URL=<url>/v1 and
+PINECONE_INDEX_HOST=<url>.
+"""
+
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+EMBEDDING_DIM = 1536
+MEMORY_TRIGGERS = ("remember", "recall", "mentioned", "discussed", "my favorite", "what do i", "what's my", "we talked")
+
+
+@dataclass
+class LatencyProfile:
+    """Log-normal latency (median and spread) plus an error probability for one route."""
+    median_ms: float = 0.0
+    sigma: float = 0.3
+    error_rate: float = 0.0
+
+    def sample_seconds(self, rng: random.Random) -> float:
+        if self.median_ms <= 0:
+            return 0.0
+        return self.median_ms * math.exp(rng.gauss(0.0, self.sigma)) / 1000
+
+    @classmethod
+    def parse(cls, spec: str) -> "LatencyProfile":
+        """Parse "median_ms[:sigma[:error_rate]]", e.g. "400:0.5:0.01"."""
+        parts = [float(part) for part in spec.split(":")]
+        return cls(*parts)
+
+
+@dataclass
+class StandInConfig:
+    embeddings: LatencyProfile = field(default_factory=lambda: LatencyProfile(40))
+    chat: LatencyProfile = field(default_factory=lambda: LatencyProfile(600, 0.5))
+    upsert: LatencyProfile = field(default_factory=lambda: LatencyProfile(30))
+    query: LatencyProfile = field(default_factory=lambda: LatencyProfile(25))
+    seed: int = 7
+
+
+def embed_text(text: str) -> List[float]:
+    """Hash words into a fixed-size unit vector so overlapping texts score as similar."""
+    vector = [0.0] * EMBEDDING_DIM
+    for word in re.findall(r"[a-z0-9']+", text.lower()):
+        digest = hashlib.blake2b(word.encode(), digest_size=8).digest()
+        slot = int.from_bytes(digest[:4], "little") % EMBEDDING_DIM
+        vector[slot] += 1.0 if digest[4] & 1 else -1.0
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+
+def _matches_filter(metadata: dict, flt: Optional[dict]) -> bool:
+    if not flt:
+        return True
+    for key, condition in flt.items():
+        if isinstance(condition, dict):
+            if "$eq" in condition and metadata.get(key) != condition["$eq"]:
+                return False
+            if "$in" in condition and metadata.get(key) not in condition["$in"]:
+                return False
+        elif metadata.get(key) != condition:
+            return False
+    return True
+
+
+class VectorStore:
+    """Minimal thread-safe Pinecone index: namespaces of id -> (values, metadata)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._namespaces: Dict[str, Dict[str, Tuple[List[float], dict]]] = {}
+
+    def upsert(self, vectors: List[dict], namespace: str = "") -> int:
+        with self._lock:
+            space = self._namespaces.setdefault(namespace, {})
+            for vector in vectors:
+                space[vector["id"]] = (vector.get("values", []), vector.get("metadata") or {})
+        return len(vectors)
+
+    def query(self, vector: List[float], top_k: int, flt: Optional[dict] = None,
+              include_metadata: bool = False, namespace: str = "") -> List[dict]:
+        with self._lock:
+            candidates = [
+                (vector_id, values, metadata)
+                for vector_id, (values, metadata) in self._namespaces.get(namespace, {}).items()
+                if _matches_filter(metadata, flt)
+            ]
+        query_norm = math.sqrt(sum(value * value for value in vector))
+        scored = []
+        for vector_id, values, metadata in candidates:
+            norm = query_norm * math.sqrt(sum(value * value for value in values))
+            score = sum(a * b for a, b in zip(vector, values)) / norm if norm else 0.0
+            match = {"id": vector_id, "score": score, "values": []}
+            if include_metadata:
+                match["metadata"] = metadata
+            scored.append(match)
+        scored.sort(key=lambda match: match["score"], reverse=True)
+        return scored[:top_k]
+
+    def delete(self, ids: Optional[List[str]] = None, delete_all: bool = False,
+               flt: Optional[dict] = None, namespace: str = "") -> None:
+        with self._lock:
+            space = self._namespaces.get(namespace, {})
+            if delete_all and not flt:
+                self._namespaces.pop(namespace, None)
+                return
+            doomed = set(ids or [])
+            if flt:
+                doomed.update(vector_id for vector_id, (_, metadata) in space.items() if _matches_filter(metadata, flt))
+            for vector_id in doomed:
+                space.pop(vector_id, None)
+
+    def list_ids(self, prefix: str = "", limit: int = 100, token: Optional[str] = None,
+                 namespace: str = "") -> Tuple[List[str], Optional[str]]:
+        """One page of ids with the prefix, in id order; the token is the last id returned."""
+        with self._lock:
+            ids = sorted(
+                vector_id for vector_id in self._namespaces.get(namespace, {})
+                if vector_id.startswith(prefix) and (token is None or vector_id > token)
+            )
+        page = ids[:limit]
+        return page, page[-1] if len(ids) > limit else None
+
+    def stats(self) -> dict:
+        with self._lock:
+            namespaces = {name: {"vectorCount": len(space)} for name, space in self._namespaces.items()}
+        return {
+            "namespaces": namespaces,
+            "dimension": EMBEDDING_DIM,
+            "indexFullness": 0.0,
+            "totalVectorCount": sum(space["vectorCount"] for space in namespaces.values()),
+        }
+
+    def total_bytes(self) -> int:
+        """Approximate stored size: 4 bytes per float plus JSON-encoded metadata."""
+        with self._lock:
+            return sum(
+                len(values) * 4 + len(json.dumps(metadata))
+                for space in self._namespaces.values()
+                for values, metadata in space.values()
+            )
+
+
+def _chat_reply(body: dict) -> dict:
+    """Build a chat.completion; request the memory tool once when a trigger phrase appears."""
+    messages = body.get("messages", [])
+    last_user = next((m for m in reversed(messages) if m.get("role") == "user"), {})
+    content = last_user.get("content") or ""
+    if isinstance(content, list):
+        content = " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+    already_called = any(m.get("role") == "tool" for m in messages)
+    tool_names = [tool.get("function", {}).get("name") for tool in body.get("tools", []) or []]
+
+    message = {"role": "assistant", "content": None}
+    finish_reason = "stop"
+    lowered = content.lower()
+    if not already_called and "retrieve_relevant_memories" in tool_names and any(t in lowered for t in MEMORY_TRIGGERS):
+        user_match = re.search(r"User ID: (\S+)", content)
+        current = content.split("Current message:")[-1].strip()
+        arguments = {"query": current, "user_id": user_match.group(1) if user_match else "", "top_k": 5}
+        message["tool_calls"] = [{
+            "id": f"call_{hashlib.md5(content.encode()).hexdigest()[:12]}",
+            "type": "function",
+            "function": {"name": "retrieve_relevant_memories", "arguments": json.dumps(arguments)},
+        }]
+        finish_reason = "tool_calls"
+    else:
+        current = content.split("Current message:")[-1].strip()
+        message["content"] = f"Stand-in reply to: {current[:200]}"
+
+    prompt_tokens = sum(len(str(m.get("content") or "")) for m in messages) // 4
+    completion_tokens = len(message["content"] or "") // 4 + 10
+    return {
+        "id": f"chatcmpl-{random.getrandbits(48):x}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "stand-in"),
+        "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+def _chat_chunks(reply: dict) -> List[dict]:
+    """Split a chat.completion into the chat.completion.chunk sequence a stream=true call returns."""
+    choice = reply["choices"][0]
+    message = choice["message"]
+    base = {"id": reply["id"], "object": "chat.completion.chunk", "created": reply["created"], "model": reply["model"]}
+    chunks = [dict(base, choices=[{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])]
+    for piece in re.findall(r"\S+\s*", message["content"] or ""):
+        chunks.append(dict(base, choices=[{"index": 0, "delta": {"content": piece}, "finish_reason": None}]))
+    for position, call in enumerate(message.get("tool_calls") or []):
+        chunks.append(dict(base, choices=[{"index": 0, "delta": {"tool_calls": [dict(call, index=position)]},
+                                           "finish_reason": None}]))
+    chunks.append(dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": choice["finish_reason"]}]))
+    chunks.append(dict(base, choices=[], usage=reply["usage"]))
+    return chunks
+
+
+class StandInServer:
+    """Runs the stand-in HTTP server on a background thread."""
+
+    ROUTES = {
+        "/v1/embeddings": "embeddings",
+        "/embeddings": "embeddings",
+        "/v1/chat/completions": "chat",
+        "/chat/completions": "chat",
+        "/vectors/upsert": "upsert",
+        "/query": "query",
+        "/vectors/delete": "delete",
+        "/describe_index_stats": "stats",
+        "/vectors/list": "list",
+    }
+
+    def __init__(self, config: Optional[StandInConfig] = None, host: str = "127.0.0.1", port: int = 0):
+        self.config = config or StandInConfig()
+        self.store = VectorStore()
+        self.calls: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self._rng = random.Random(self.config.seed)
+        self._rng_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "StandInServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="standins", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "StandInServer":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def snapshot(self) -> dict:
+        """Call/error counters and memory-store size."""
+        with self._stats_lock:
+            calls, errors = dict(self.calls), dict(self.errors)
+        stats = self.store.stats()
+        return {
+            "calls": calls,
+            "errors": errors,
+            "vectors": stats["totalVectorCount"],
+            "store_bytes": self.store.total_bytes(),
+        }
+
+    def _profile(self, route: str) -> LatencyProfile:
+        return getattr(self.config, route, None) or LatencyProfile()
+
+    def _delay_and_fail(self, route: str) -> bool:
+        """Sleep for the route's latency; returns True when this call should fail."""
+        profile = self._profile(route)
+        with self._rng_lock:
+            delay = profile.sample_seconds(self._rng)
+            fail = self._rng.random() < profile.error_rate
+        with self._stats_lock:
+            self.calls[route] = self.calls.get(route, 0) + 1
+            if fail:
+                self.errors[route] = self.errors.get(route, 0) + 1
+        time.sleep(delay)
+        return fail
+
+    def handle(self, route: str, body: dict) -> Tuple[int, dict]:
+        if self._delay_and_fail(route):
+            return 503, {"error": {"message": f"stand-in injected failure on {route}", "type": "server_error"}}
+
+        if route == "embeddings":
+            inputs = body.get("input", [])
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            data = [{"object": "embedding", "index": i, "embedding": embed_text(text)} for i, text in enumerate(inputs)]
+            tokens = sum(len(text) for text in inputs) // 4
+            return 200, {"object": "list", "data": data, "model": body.get("model", ""),
+                         "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+        if route == "chat":
+            return 200, _chat_reply(body)
+        if route == "upsert":
+            count = self.store.upsert(body.get("vectors", []), body.get("namespace", ""))
+            return 200, {"upsertedCount": count}
+        if route == "query":
+            matches = self.store.query(
+                body.get("vector", []), int(body.get("topK", 10)), body.get("filter"),
+                bool(body.get("includeMetadata")), body.get("namespace", "")
+            )
+            return 200, {"matches": matches, "namespace": body.get("namespace", "")}
+        if route == "list":
+            ids, token = self.store.list_ids(
+                body.get("prefix", ""), int(body.get("limit", 100)), body.get("paginationToken"), body.get("namespace", "")
+            )
+            return 200, {"vectors": [{"id": vector_id} for vector_id in ids], "pagination": {"next": token} if token else None,
+                         "namespace": body.get("namespace", ""), "usage": {"readUnits": 1}}
+        if route == "delete":
+            self.store.delete(body.get("ids"), bool(body.get("deleteAll")), body.get("filter"), body.get("namespace", ""))
+            return 200, {}
+        return 200, self.store.stats()
+
+    def _handler_class(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _respond(self, status: int, payload: dict) -> None:
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _respond_stream(self, chunks: List[dict]) -> None:
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for chunk in chunks + ["[DONE]"]:
+                    data = f"data: {chunk if isinstance(chunk, str) else json.dumps(chunk)}\n\n".encode()
+                    self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or b"{}")
+                route = standin.ROUTES.get(self.path.split("?")[0])
+                if route is None:
+                    self._respond(404, {"error": {"message": f"no stand-in for {self.path}"}})
+                    return
+                status, payload = standin.handle(route, body)
+                if route == "chat" and body.get("stream") and status == 200:
+                    self._respond_stream(_chat_chunks(payload))
+                else:
+                    self._respond(status, payload)
+
+            def do_GET(self):
+                path, _, query = self.path.partition("?")
+                if path == "/describe_index_stats":
+                    self._respond(*standin.handle("stats", {}))
+                elif path == "/vectors/list":
+                    self._respond(*standin.handle("list", dict(parse_qsl(query))))
+                elif self.path == "/_stats":
+                    self._respond(200, standin.snapshot())
+                else:
+                    self._respond(404, {"error": {"message": f"no stand-in for {self.path}"}})
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Cold start benchmark for the Memory Chatbot API.
+
+Measures, in fresh interpreter processes:
+- how long `import api` takes (and which modules dominate it)
+- how long a uvicorn worker takes to answer /health (liveness)
+- how long until /ready reports ready (database + memory index)
+
+Each run is appended to results/startup.jsonl tagged with a release label
+so cold start can be compared release over release.
+
+Usage:
+    python benchmarks/startup_benchmark.py --release 1.0.0
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", "startup.jsonl")
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def measure_import(runs: int) -> dict:
+    """Time `import api` in fresh processes and report the slowest imports of the last run."""
+    durations = []
+    importtime_log = ""
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import api"],
+            cwd=BACKEND_DIR, capture_output=True, text=True
+        )
+        durations.append((time.perf_counter() - start) * 1000)
+        if result.returncode != 0:
+            raise RuntimeError(f"import api failed:\n{result.stderr[-2000:]}")
+        importtime_log = result.stderr
+
+    # -X importtime lines: "import time: self [us] | cumulative | imported package"
+    # Nested imports are indented two spaces per level in the last column;
+    # keep the first three levels (api, its imports, and theirs)
+    top_level = []
+    for line in importtime_log.splitlines():
+        parts = line.replace("import time:", "").split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            name = parts[2][1:]
+            if len(name) - len(name.lstrip()) <= 4:
+                top_level.append((int(parts[1]), name.strip()))
+    top_level = sorted(top_level, reverse=True)[:10]
+
+    return {
+        "import_ms_median": round(statistics.median(durations), 1),
+        "import_ms_max": round(max(durations), 1),
+        "slowest_imports_ms": {name: round(us / 1000, 1) for us, name in top_level},
+    }
+
+
+def _wait_for(url: str, deadline: float, expect_status: int = 200):
+    """Poll url until it returns expect_status; returns the elapsed wall time or None."""
+    while time.perf_counter() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == expect_status:
+                    return time.perf_counter()
+        except (urllib.error.URLError, ConnectionError, OSError):
+            pass
+        time.sleep(0.02)
+    return None
+
+
+def measure_server(timeout: float) -> dict:
+    """Start uvicorn and time first successful /health and /ready responses."""
+    port = _free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        deadline = start + timeout
+        healthy_at = _wait_for(f"{base_url}/health", deadline)
+        ready_at = _wait_for(f"{base_url}/ready", deadline) if healthy_at else None
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+    return {
+        "time_to_health_ms": round((healthy_at - start) * 1000, 1) if healthy_at else None,
+        "time_to_ready_ms": round((ready_at - start) * 1000, 1) if ready_at else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure API cold start")
+    parser.add_argument("--release", default=None, help="Release label to record (default: git describe)")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh-process import runs")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Seconds to wait for /health and /ready")
+    parser.add_argument("--no-save", action="store_true", help="Print results without appending to the results file")
+    args = parser.parse_args()
+
+    result = {
+        "release": args.release or _git_revision(),
+        "timestamp": datetime.now().isoformat(),
+        "python": sys.version.split()[0],
+    }
+    result.update(measure_import(args.runs))
+    result.update(measure_server(args.timeout))
+
+    print(json.dumps(result, indent=2))
+
+    if not args.no_save:
+        os.makedirs(os.path.dirname(RESULTS_FILE), exist_ok=True)
+        with open(RESULTS_FILE, "a") as results:
+            results.write(json.dumps(result) + "\n")
+        print(f"Appended to {RESULTS_FILE}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Bulk export and import of chat history between deployments.
+
+Talks to the /admin/history endpoints of a running API and streams NDJSON
+in both directions, so memory use stays constant however large the
+history is. Use "-" for stdout/stdin to pipe one deployment into another.
+
+Usage:
+    python history_cli.py export --url https://old.example.com --out history.ndjson
+    python history_cli.py export --url http://localhost:8000 --user-id alice --since 2024-01-01
+    python history_cli.py import --url http://localhost:8000 history.ndjson
+    python history_cli.py export --url $OLD --out - | python history_cli.py import --url $NEW -
+
+Set ADMIN_TOKEN (or pass --token) when the API requires X-Admin-Token.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import requests
+
+CHUNK_SIZE = 1 << 16
+
+
+def _headers(token):
+    return {"X-Admin-Token": token} if token else {}
+
+
+def export_history(url, out, token=None, user_id=None, since=None, until=None):
+    """Stream the export to a binary file object; returns (lines, bytes)."""
+    params = {key: value for key, value in {"user_id": user_id, "since": since, "until": until}.items() if value}
+    lines = size = 0
+    with requests.get(f"{url.rstrip('/')}/admin/history/export", params=params, headers=_headers(token),
+                      stream=True, timeout=(10, 300)) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            out.write(chunk)
+            lines += chunk.count(b"\n")
+            size += len(chunk)
+    out.flush()
+    return lines, size
+
+
+def import_history(url, source, token=None):
+    """Stream a binary file object of NDJSON as the request body; returns the API's summary."""
+    def body():
+        while True:
+            chunk = source.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    headers = dict(_headers(token), **{"Content-Type": "application/x-ndjson"})
+    response = requests.post(f"{url.rstrip('/')}/admin/history/import", data=body(), headers=headers,
+                             timeout=(10, 3600))
+    if response.status_code >= 400:
+        raise SystemExit(f"Import failed ({response.status_code}): {response.text}")
+    return response.json()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk export/import chat history as NDJSON")
+    parser.add_argument("--token", default=os.getenv("ADMIN_TOKEN"), help="X-Admin-Token (default: $ADMIN_TOKEN)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="Download history as NDJSON")
+    export_parser.add_argument("--url", required=True, help="Base URL of the API")
+    export_parser.add_argument("--out", default="-", help="Output file, '-' for stdout")
+    export_parser.add_argument("--user-id", default=None, help="Only this user")
+    export_parser.add_argument("--since", default=None, help="Only messages at or after this ISO time")
+    export_parser.add_argument("--until", default=None, help="Only messages before this ISO time")
+
+    import_parser = commands.add_parser("import", help="Upload NDJSON history")
+    import_parser.add_argument("--url", required=True, help="Base URL of the API")
+    import_parser.add_argument("source", help="NDJSON file, '-' for stdin")
+
+    args = parser.parse_args()
+    start = time.perf_counter()
+
+    if args.command == "export":
+        out = sys.stdout.buffer if args.out == "-" else open(args.out, "wb")
+        try:
+            lines, size = export_history(args.url, out, args.token, args.user_id, args.since, args.until)
+        finally:
+            if out is not sys.stdout.buffer:
+                out.close()
+        elapsed = time.perf_counter() - start
+        print(f"Exported {lines} messages ({size / 1e6:.1f} MB) in {elapsed:.1f}s "
+              f"({lines / elapsed if elapsed else 0:.0f} messages/s)", file=sys.stderr)
+    else:
+        source = sys.stdin.buffer if args.source == "-" else open(args.source, "rb")
+        try:
+            summary = import_history(args.url, source, args.token)
+        finally:
+            if source is not sys.stdin.buffer:
+                source.close()
+        elapsed = time.perf_counter() - start
+        imported = summary["imported"]
+        print(f"Imported {imported} messages in {summary['batches']} batches in {elapsed:.1f}s "
+              f"({imported / elapsed if elapsed else 0:.0f} messages/s)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Per-request latency budgets.
+
+A LatencyBudget is created for each chat turn (from the X-Latency-Budget-Ms
+header or LATENCY_BUDGET_MS) and passed down to the memory stages. Optional
+stages ask it whether they still fit: memory retrieval is skipped and memory
+writes are deferred to the background when the remaining time is shorter
+than their recent latency. The stages that were skipped or deferred are
+reported back in the response.
+"""
+
+import os
+import math
+import time
+import threading
+from typing import Dict, List, Optional
+
+# Default budget for a chat turn in milliseconds; 0 means no budget
+LATENCY_BUDGET_MS = int(os.getenv("LATENCY_BUDGET_MS", "0"))
+# Time kept for the model to write its answer after a memory lookup
+LATENCY_BUDGET_RESERVE_MS = int(os.getenv("LATENCY_BUDGET_RESERVE_MS", "1500"))
+# Weight of the newest sample in the per-stage latency estimates
+STAGE_ESTIMATE_WEIGHT = 0.2
+# Starting estimates in seconds, before any samples
+DEFAULT_STAGE_ESTIMATES = {"retrieve": 0.4, "store": 0.4}
+
+
+class StageEstimates:
+    """Exponentially weighted moving average of each optional stage's latency."""
+
+    def __init__(self, defaults: Dict[str, float] = DEFAULT_STAGE_ESTIMATES, weight: float = STAGE_ESTIMATE_WEIGHT):
+        self.weight = weight
+        self._estimates = dict(defaults)
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            previous = self._estimates.get(stage, seconds)
+            self._estimates[stage] = previous + self.weight * (seconds - previous)
+
+    def get(self, stage: str) -> float:
+        with self._lock:
+            return self._estimates.get(stage, 0.0)
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return {stage: round(seconds * 1000, 1) for stage, seconds in self._estimates.items()}
+
+
+stage_estimates = StageEstimates()
+
+
+class LatencyBudget:
+    """
+    Deadline for one request. Stages call allows() before optional work and
+    record what they dropped with skip() or defer(); both lists end up in the
+    response. An unbounded budget (no deadline) allows everything.
+    """
+
+    def __init__(self, milliseconds: Optional[int] = None):
+        self.deadline = time.monotonic() + milliseconds / 1000 if milliseconds else None
+        self.skipped: List[str] = []
+        self.deferred: List[str] = []
+
+    @classmethod
+    def from_request(cls, header_ms: Optional[int]) -> "LatencyBudget":
+        return cls(header_ms or LATENCY_BUDGET_MS or None)
+
+    @property
+    def bounded(self) -> bool:
+        return self.deadline is not None
+
+    def remaining(self) -> float:
+        """Seconds left (infinite when unbounded, never negative)."""
+        if self.deadline is None:
+            return math.inf
+        return max(0.0, self.deadline - time.monotonic())
+
+    def allows(self, stage: str, reserve: float = 0.0) -> bool:
+        """Whether `stage`, at its recent latency, still fits with `reserve` seconds to spare."""
+        return self.remaining() - reserve >= stage_estimates.get(stage)
+
+    def timeout(self, reserve: float = 0.0) -> Optional[float]:
+        """Timeout for a network call that must leave `reserve` seconds; None when unbounded."""
+        if self.deadline is None:
+            return None
+        return max(0.05, self.remaining() - reserve)
+
+    def skip(self, stage: str) -> None:
+        if stage not in self.skipped:
+            self.skipped.append(stage)
+
+    def defer(self, stage: str) -> None:
+        if stage not in self.deferred:
+            self.deferred.append(stage)
@@ -0,0 +1,167 @@
+"""
+Latency-tiered model routing for the memory agent.
+
+Each turn is classified locally (no network call) into a model tier from its
+length, intent keywords and whether it is likely to need memory retrieval.
+Trivial acknowledgements can be answered with a canned reply without running
+the agent at all. Latency, tokens and estimated cost are tracked per tier so
+the thresholds can be tuned from GET /agent/tiers.
+"""
+
+import os
+import re
+import threading
+from collections import Counter, deque
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+DEFAULT_MODEL = os.getenv("MODEL_CHOICE", "gpt-4o-mini")
+# Model per tier; all default to MODEL_CHOICE, e.g. MODEL_TIER_FAST=gpt-4.1-nano MODEL_TIER_DEEP=gpt-4o
+TIER_MODELS = {
+    "fast": os.getenv("MODEL_TIER_FAST", DEFAULT_MODEL),
+    "standard": os.getenv("MODEL_TIER_STANDARD", DEFAULT_MODEL),
+    "deep": os.getenv("MODEL_TIER_DEEP", DEFAULT_MODEL),
+}
+# Messages up to this many words without other signals go to the fast tier
+FAST_MAX_WORDS = int(os.getenv("FAST_MAX_WORDS", "12"))
+# Messages of at least this many words go to the deep tier
+DEEP_MIN_WORDS = int(os.getenv("DEEP_MIN_WORDS", "60"))
+# Answer trivial acknowledgements without running the agent
+CANNED_REPLIES = os.getenv("CANNED_REPLIES", "true").lower() in ("1", "true", "yes")
+# Recent latencies kept per tier for percentiles
+LATENCY_WINDOW = 1000
+
+# USD per million (input, output) tokens, for cost estimates
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4.1": (2.00, 8.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1-nano": (0.10, 0.40),
+}
+
+# Whole-message acknowledgements and their canned replies, checked in order
+CANNED = [
+    (re.compile(r"(thanks|thank you|thx|ty|cheers)( (so|very) much| a lot)?", re.IGNORECASE), "You're welcome! Let me know if there's anything else."),
+    (re.compile(r"(bye|goodbye|see you|see ya|good night)", re.IGNORECASE), "Goodbye! Talk to you soon."),
+    (re.compile(r"(ok|okay|k|cool|great|nice|got it|sounds good|perfect|awesome)", re.IGNORECASE), "Great! Let me know if there's anything else."),
+]
+_ACK_TRAILER = re.compile(r"[\s!.?:)]*$")
+
+# Same triggers as the agent's instructions for calling retrieve_relevant_memories
+MEMORY_TRIGGERS = re.compile(
+    r"\b(remember|recall|mentioned|discussed|we talked|last time|my favou?rite|what do i|what did i|"
+    r"what's my|what is my|tell me about me)\b",
+    re.IGNORECASE,
+)
+# Requests that need reasoning rather than a quick answer
+COMPLEX_INTENT = re.compile(
+    r"\b(explain|compare|analy[sz]e|step[- ]by[- ]step|pros and cons|trade-?offs?|plan|design|debug|"
+    r"summari[sz]e|why|how (do|does|can|should|would))\b",
+    re.IGNORECASE,
+)
+
+
+@dataclass
+class TurnPlan:
+    tier: str  # "canned", "fast", "standard" or "deep"
+    reason: str
+    canned_reply: Optional[str] = None
+
+
+def classify_turn(message: str) -> TurnPlan:
+    """Pick the tier for a message from local signals only."""
+    text = _ACK_TRAILER.sub("", message.strip())
+    if CANNED_REPLIES:
+        for pattern, reply in CANNED:
+            if pattern.fullmatch(text):
+                return TurnPlan("canned", "acknowledgement", reply)
+
+    words = len(message.split())
+    needs_memory = bool(MEMORY_TRIGGERS.search(message))
+    complex_intent = bool(COMPLEX_INTENT.search(message))
+    if words >= DEEP_MIN_WORDS:
+        return TurnPlan("deep", "long")
+    if message.count("?") >= 2:
+        return TurnPlan("deep", "multi_question")
+    if needs_memory and complex_intent:
+        return TurnPlan("deep", "memory_reasoning")
+    if needs_memory:
+        return TurnPlan("standard", "memory")
+    if complex_intent:
+        return TurnPlan("standard", "intent")
+    if words <= FAST_MAX_WORDS:
+        return TurnPlan("fast", "short")
+    return TurnPlan("standard", "default")
+
+
+def _percentile(values, fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class TierStats:
+    """Turns, latency and token usage per tier, plus how often each routing reason fired."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._turns: Counter = Counter()
+        self._reasons: Counter = Counter()
+        self._latency_sum: Counter = Counter()
+        self._latencies: Dict[str, deque] = {}
+        self._input_tokens: Counter = Counter()
+        self._output_tokens: Counter = Counter()
+
+    def record(self, plan: TurnPlan, seconds: float, usage=None) -> None:
+        """Record one turn; usage is the agent run's Usage (None for canned replies)."""
+        with self._lock:
+            self._turns[plan.tier] += 1
+            self._reasons[f"{plan.tier}_{plan.reason}"] += 1
+            self._latency_sum[plan.tier] += seconds
+            self._latencies.setdefault(plan.tier, deque(maxlen=LATENCY_WINDOW)).append(seconds)
+            if usage is not None:
+                self._input_tokens[plan.tier] += usage.input_tokens
+                self._output_tokens[plan.tier] += usage.output_tokens
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            total = sum(self._turns.values())
+            tiers = {}
+            for tier, turns in self._turns.items():
+                model = TIER_MODELS.get(tier)
+                latencies = list(self._latencies[tier])
+                input_tokens, output_tokens = self._input_tokens[tier], self._output_tokens[tier]
+                if tier == "canned":
+                    cost = 0.0
+                elif model in MODEL_PRICES:
+                    input_price, output_price = MODEL_PRICES[model]
+                    cost = (input_tokens * input_price + output_tokens * output_price) / 1e6
+                else:
+                    cost = None
+                tiers[tier] = {
+                    "model": model,
+                    "turns": turns,
+                    "share": round(turns / total, 4),
+                    "avg_latency_ms": round(self._latency_sum[tier] / turns * 1000, 1),
+                    "p50_latency_ms": round(_percentile(latencies, 0.5) * 1000, 1),
+                    "p95_latency_ms": round(_percentile(latencies, 0.95) * 1000, 1),
+                    "input_tokens": input_tokens,
+                    "output_tokens": output_tokens,
+                    "estimated_cost_usd": round(cost, 6) if cost is not None else None,
+                    "cost_per_turn_usd": round(cost / turns, 8) if cost is not None else None,
+                }
+            return {
+                "turns": total,
+                "tiers": tiers,
+                "reasons": dict(self._reasons),
+                "thresholds": {
+                    "fast_max_words": FAST_MAX_WORDS,
+                    "deep_min_words": DEEP_MIN_WORDS,
+                    "canned_replies": CANNED_REPLIES,
+                },
+            }
+
+
+tier_stats = TierStats()
@@ -1,14 +1,24 @@
 import os
+import re
+import math
 import time
 import uuid
+import threading
 import hashlib
-from typing import List, Optional, Tuple
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
 from pydantic import BaseModel, Field
-from agents import Agent, Runner, function_tool, ModelSettings
+from agents import Agent, Runner, RunContextWrapper, function_tool, ModelSettings, set_default_openai_api
 from dotenv import load_dotenv
 from openai import OpenAI
+from openai.types.responses import ResponseTextDeltaEvent
 from pinecone import Pinecone,ServerlessSpec
 import logging
+from model_router import TIER_MODELS, classify_turn, tier_stats
+from latency_budget import LATENCY_BUDGET_RESERVE_MS, LatencyBudget, stage_estimates
 
 load_dotenv()
 
@@ -20,21 +30,67 @@ logger = logging.getLogger(__name__)
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 MEMORY_INDEX_NAME = os.getenv("MEMORY_INDEX_NAME", "chatbot-memory")
+# Optional data-plane host; when set the index is opened directly without control-plane calls
+PINECONE_INDEX_HOST = os.getenv("PINECONE_INDEX_HOST")
+MEMORY_INDEX_READY_TIMEOUT = float(os.getenv("MEMORY_INDEX_READY_TIMEOUT", "60"))
+# Cached retrieval results expire after this long; bounds staleness from writes on other workers
+RETRIEVAL_CACHE_TTL_SECONDS = float(os.getenv("RETRIEVAL_CACHE_TTL_SECONDS", "60"))
+# Approximate memory the retrieval cache may use before evicting least recently used entries
+RETRIEVAL_CACHE_MAX_BYTES = int(os.getenv("RETRIEVAL_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+# Threads writing memories that were deferred to stay within a request's latency budget
+MEMORY_DEFERRED_WRITERS = int(os.getenv("MEMORY_DEFERRED_WRITERS", "4"))
+# User ids up to this long (and ASCII) are used verbatim in memory vector ids;
+# Pinecone ids are ASCII and at most 512 bytes
+MEMORY_ID_MAX_USER_CHARS = 400
+# How long deleting a user's memories waits for their in-flight writes
+MEMORY_WRITE_DRAIN_SECONDS = float(os.getenv("MEMORY_WRITE_DRAIN_SECONDS", "30"))
 
-if not OPENAI_API_KEY or not PINECONE_API_KEY:
-    raise ValueError("Missing required API keys. Please set OPENAI_API_KEY and PINECONE_API_KEY environment variables in your deployment platform")
+# Clients are created on first use so importing this module never touches the network
+_openai_client: Optional[OpenAI] = None
+_pinecone_client: Optional[Pinecone] = None
+_client_lock = threading.Lock()
 
-# Initialize clients
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
-pc = Pinecone(api_key=PINECONE_API_KEY)
+def _require_api_keys():
+    if not OPENAI_API_KEY or not PINECONE_API_KEY:
+        raise ValueError("Missing required API keys. Please set OPENAI_API_KEY and PINECONE_API_KEY environment variables in your deployment platform")
+
+def get_openai_client() -> OpenAI:
+    """Return the shared OpenAI client, creating it on first use"""
+    global _openai_client
+    if _openai_client is None:
+        with _client_lock:
+            if _openai_client is None:
+                _require_api_keys()
+                _openai_client = OpenAI(api_key=OPENAI_API_KEY)
+    return _openai_client
+
+def get_pinecone_client() -> Pinecone:
+    """Return the shared Pinecone client, creating it on first use"""
+    global _pinecone_client
+    if _pinecone_client is None:
+        with _client_lock:
+            if _pinecone_client is None:
+                _require_api_keys()
+                _pinecone_client = Pinecone(api_key=PINECONE_API_KEY)
+    return _pinecone_client
 
 # Model configuration
 MODEL = os.getenv('MODEL_CHOICE', 'gpt-4o-mini')
 
+# "chat_completions" for gateways (and the benchmark stand-ins) that only speak Chat Completions
+OPENAI_API_MODE = os.getenv("OPENAI_API_MODE")
+if OPENAI_API_MODE:
+    set_default_openai_api(OPENAI_API_MODE)
+
 # --- Initialize Pinecone for memory storage ---
 def initialize_memory_index():
     """Initialize Pinecone index for storing conversation memories"""
     print(f"Initializing Pinecone memory index: {MEMORY_INDEX_NAME}")
+    pc = get_pinecone_client()
+
+    if PINECONE_INDEX_HOST:
+        print(f"Using Pinecone index host: {PINECONE_INDEX_HOST}")
+        return pc.Index(host=PINECONE_INDEX_HOST)
     
     # Check if index exists, create if not
     existing_indexes = pc.list_indexes().names()
@@ -73,8 +129,11 @@ def initialize_memory_index():
                     spec={"serverless": {"cloud": "aws", "region": "us-east-1"}}
                 )
         
-    # Wait for index to be ready
+    # Wait for index to be ready, but never longer than the configured timeout
+    deadline = time.monotonic() + MEMORY_INDEX_READY_TIMEOUT
     while not pc.describe_index(MEMORY_INDEX_NAME).status.get('ready', False):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Pinecone index {MEMORY_INDEX_NAME} not ready after {MEMORY_INDEX_READY_TIMEOUT:.0f}s")
         print("Waiting for Pinecone index to be ready...")
         time.sleep(1)
         
@@ -82,21 +141,231 @@ def initialize_memory_index():
     print("Pinecone memory index is ready")
     return index
 
-memory_index = initialize_memory_index()
-
 # --- Memory Functions ---
-def get_embedding(text: str) -> List[float]:
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+def get_embedding(text: str, timeout: Optional[float] = None) -> List[float]:
     """Generate embedding for text using OpenAI"""
     try:
-        response = openai_client.embeddings.create(
+        response = get_openai_client().embeddings.create(
             input=text,
-            model="text-embedding-3-small"
+            model=EMBEDDING_MODEL,
+            **({"timeout": timeout} if timeout is not None else {})
         )
         return response.data[0].embedding
     except Exception as e:
         logger.error(f"Error generating embedding: {str(e)}")
         return []
 
+def get_embeddings(texts: List[str]) -> Tuple[List[List[float]], int]:
+    """
+    Embed many texts in one request. Returns the embeddings in input order
+    and the tokens billed; errors are raised so batch callers can retry.
+    """
+    response = get_openai_client().embeddings.create(input=texts, model=EMBEDDING_MODEL)
+    embeddings = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+    return embeddings, response.usage.total_tokens if response.usage else 0
+
+# Matches scoring at or below this are not returned as memories
+MEMORY_SCORE_THRESHOLD = 0.5
+
+@dataclass
+class UserMemoryStats:
+    counts: Dict[str, int] = field(default_factory=dict)  # memories stored per message_type
+    first_timestamp: Optional[int] = None
+    last_timestamp: Optional[int] = None
+    bytes: int = 0
+    retrievals: int = 0
+    retrieval_hits: int = 0  # retrievals that returned at least one memory
+    cache_hits: int = 0  # retrievals served from the retrieval cache
+    score_sum: float = 0.0
+    scores: int = 0
+
+    def summary(self) -> dict:
+        return {
+            "memory_count": sum(self.counts.values()),
+            "by_type": dict(self.counts),
+            "first_timestamp": self.first_timestamp,
+            "last_timestamp": self.last_timestamp,
+            "bytes": self.bytes,
+            "retrievals": self.retrievals,
+            "retrieval_hit_rate": round(self.retrieval_hits / self.retrievals, 4) if self.retrievals else 0.0,
+            "retrieval_cache_hit_rate": round(self.cache_hits / self.retrievals, 4) if self.retrievals else 0.0,
+            "average_retrieval_score": round(self.score_sum / self.scores, 4) if self.scores else None
+        }
+
+class MemoryStats:
+    """
+    Per-user memory aggregates, updated by every store and retrieval so
+    reading them never scans the index. This in-process version only covers
+    the current process; the API replaces it with one kept in the chat
+    database (api.DatabaseMemoryStats), shared by all workers and backfill.py.
+    """
+
+    def __init__(self):
+        self._users: Dict[str, UserMemoryStats] = {}
+        self._lock = threading.Lock()
+
+    def record_stores(self, records: List[dict]) -> None:
+        """Count stored vectors (as built by MemoryService.memory_record)"""
+        with self._lock:
+            for record in records:
+                metadata = record["metadata"]
+                stats = self._users.setdefault(metadata["user_id"], UserMemoryStats())
+                message_type, timestamp = metadata["message_type"], int(metadata["timestamp"])
+                stats.counts[message_type] = stats.counts.get(message_type, 0) + 1
+                stats.first_timestamp = timestamp if stats.first_timestamp is None else min(stats.first_timestamp, timestamp)
+                stats.last_timestamp = timestamp if stats.last_timestamp is None else max(stats.last_timestamp, timestamp)
+                stats.bytes += len(metadata["message"].encode())
+
+    def record_retrieval(self, user_id: str, scores: List[float], hits: int, cached: bool = False) -> None:
+        with self._lock:
+            stats = self._users.setdefault(user_id, UserMemoryStats())
+            stats.retrievals += 1
+            stats.retrieval_hits += 1 if hits else 0
+            stats.cache_hits += 1 if cached else 0
+            stats.score_sum += sum(scores)
+            stats.scores += len(scores)
+
+    def forget(self, user_id: str) -> None:
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def snapshot(self, user_id: str) -> dict:
+        with self._lock:
+            return (self._users.get(user_id) or UserMemoryStats()).summary()
+
+def _candidate(vector_id: str, score: float, metadata: dict) -> dict:
+    """A ranked memory as returned by search_memories"""
+    return {
+        "id": vector_id,
+        "score": score,
+        "message": metadata.get("message", ""),
+        "message_type": metadata.get("message_type", "unknown"),
+        "timestamp": metadata.get("timestamp", ""),
+        "above_threshold": score > MEMORY_SCORE_THRESHOLD and bool(metadata.get("message"))
+    }
+
+@dataclass
+class CachedRetrieval:
+    embedding: array  # query embedding, float32
+    norm: float
+    top_k: int
+    candidates: List[dict]
+    expires_at: float
+    size: int
+
+class RetrievalCache:
+    """
+    Per-user LRU cache of ranked retrieval results, keyed by user, normalized
+    query text and top_k, with a TTL and an approximate byte budget.
+
+    Writes go through it: every memory stored for a user is scored against
+    the query embedding of each of that user's cached entries (cosine, like
+    the index) and merged into their ranking, so a chat turn storing the
+    user's message does not throw away their cache. Searches that raced a
+    write for the same user are not cached.
+    """
+
+    # Users are hashed onto this many write counters (bounded memory; collisions only skip caching)
+    GENERATION_STRIPES = 4096
+
+    def __init__(self, ttl: float = RETRIEVAL_CACHE_TTL_SECONDS, max_bytes: int = RETRIEVAL_CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Tuple[str, str, int], CachedRetrieval]" = OrderedDict()
+        self._by_user: Dict[str, Set[Tuple[str, str, int]]] = {}
+        self._generations = [0] * self.GENERATION_STRIPES
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(user_id: str, query: str, top_k: int) -> Tuple[str, str, int]:
+        return user_id, " ".join(query.lower().split()), top_k
+
+    @staticmethod
+    def _size(embedding: array, candidates: List[dict]) -> int:
+        return 200 + embedding.itemsize * len(embedding) + sum(300 + len(candidate["message"]) for candidate in candidates)
+
+    def _stripe(self, user_id: str) -> int:
+        return hash(user_id) % self.GENERATION_STRIPES
+
+    def generation(self, user_id: str) -> int:
+        """Write counter for the user; pass it to put() to detect writes during a search"""
+        with self._lock:
+            return self._generations[self._stripe(user_id)]
+
+    def get(self, user_id: str, query: str, top_k: int) -> Optional[List[dict]]:
+        key = self._key(user_id, query, top_k)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at <= time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return [dict(candidate) for candidate in entry.candidates]
+
+    def put(self, user_id: str, query: str, top_k: int, embedding: List[float], candidates: List[dict],
+            generation: int) -> None:
+        vector = array("f", embedding)
+        entry = CachedRetrieval(
+            embedding=vector,
+            norm=math.sqrt(sum(value * value for value in vector)),
+            top_k=top_k,
+            candidates=[dict(candidate) for candidate in candidates],
+            expires_at=time.monotonic() + self.ttl,
+            size=self._size(vector, candidates)
+        )
+        if entry.size > self.max_bytes:
+            return
+        key = self._key(user_id, query, top_k)
+        with self._lock:
+            if self._generations[self._stripe(user_id)] != generation:
+                return
+            self._remove(key)
+            self._entries[key] = entry
+            self._by_user.setdefault(user_id, set()).add(key)
+            self._bytes += entry.size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def add_memory(self, user_id: str, record: dict) -> None:
+        """Merge a newly stored memory record into the user's cached rankings"""
+        values = record["values"]
+        norm = math.sqrt(sum(value * value for value in values))
+        with self._lock:
+            self._generations[self._stripe(user_id)] += 1
+            for key in list(self._by_user.get(user_id, ())):
+                entry = self._entries[key]
+                denominator = entry.norm * norm
+                score = sum(a * b for a, b in zip(entry.embedding, values)) / denominator if denominator else 0.0
+                candidates = [candidate for candidate in entry.candidates if candidate["id"] != record["id"]]
+                candidates.append(_candidate(record["id"], score, record["metadata"]))
+                candidates.sort(key=lambda candidate: candidate["score"], reverse=True)
+                entry.candidates = candidates[:entry.top_k]
+                size = self._size(entry.embedding, entry.candidates)
+                self._bytes += size - entry.size
+                entry.size = size
+
+    def invalidate(self, user_id: str) -> None:
+        with self._lock:
+            self._generations[self._stripe(user_id)] += 1
+            for key in list(self._by_user.get(user_id, ())):
+                self._remove(key)
+
+    def _remove(self, key: Tuple[str, str, int]) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= entry.size
+        keys = self._by_user.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_user[key[0]]
+
 # Legacy function - now delegates to MemoryService
 def store_message_in_memory(user_id: str, message: str, message_type: str = "user") -> None:
     """Store a message in Pinecone memory with metadata (legacy function)"""
@@ -106,39 +375,166 @@ class MemoryService:
     """Service for managing memory storage and retrieval using Pinecone"""
     
     def __init__(self):
-        self.index = memory_index
+        self._index = None
+        self._index_lock = threading.Lock()
+        self.stats = MemoryStats()
+        self.retrieval_cache = RetrievalCache()
+        self._deferred_writes = ThreadPoolExecutor(max_workers=MEMORY_DEFERRED_WRITERS, thread_name_prefix="memory-write")
+        # In-flight writes per user, so a delete can wait for them to land first
+        self._pending_writes: Counter = Counter()
+        self._writes_done = threading.Condition()
+
+    @property
+    def index(self):
+        """Pinecone index, initialized on first access"""
+        if self._index is None:
+            with self._index_lock:
+                if self._index is None:
+                    self._index = initialize_memory_index()
+        return self._index
+
+    def is_ready(self) -> bool:
+        """Whether the Pinecone index has been initialized"""
+        return self._index is not None
+
+    def warm_up(self) -> bool:
+        """Initialize the index ahead of the first request; returns readiness"""
+        try:
+            self.index
+        except Exception as e:
+            logger.error(f"Memory index warm-up failed: {str(e)}")
+        return self.is_ready()
+
+    @staticmethod
+    def memory_id_prefix(user_id: str) -> str:
+        """
+        The start of every vector id of a user, so their vectors can be
+        listed by prefix. ASCII ids up to MEMORY_ID_MAX_USER_CHARS are used
+        as they are; others become "~" and a hash of the id.
+        """
+        if user_id.isascii() and len(user_id) <= MEMORY_ID_MAX_USER_CHARS:
+            return f"{user_id}_"
+        return f"~{hashlib.sha256(user_id.encode()).hexdigest()[:32]}_"
+
+    @staticmethod
+    def memory_record(user_id: str, message: str, message_type: str, timestamp: str, embedding: List[float],
+                      message_id: Optional[int] = None) -> dict:
+        """
+        The Pinecone vector for a message. Messages saved in chat_messages are
+        keyed by their row id, so the live write and any backfill of the same
+        row produce the same id; other messages (manual stores) by timestamp.
+        The text hash suffix is kept in both forms, and the id starts with
+        memory_id_prefix(user_id).
+        """
+        key = f"m{message_id}" if message_id is not None else timestamp
+        metadata = {
+            "user_id": user_id,
+            "message": message,
+            "message_type": message_type,
+            "timestamp": timestamp
+        }
+        if message_id is not None:
+            metadata["message_id"] = message_id
+        return {
+            "id": f"{MemoryService.memory_id_prefix(user_id)}{message_type}_{key}_{hashlib.md5(message.encode()).hexdigest()[:8]}",
+            "values": embedding,
+            "metadata": metadata
+        }
         
-    def store_message(self, user_id: str, message: str, message_type: str = "user"):
-        """Store a message in Pinecone memory with metadata"""
+    def store_message(self, user_id: str, message: str, message_type: str = "user",
+                      budget: Optional[LatencyBudget] = None, message_id: Optional[int] = None) -> bool:
+        """
+        Store a message in Pinecone memory with metadata; returns whether it
+        was stored. Pass the chat_messages row id when there is one so the
+        vector id is stable (see memory_record). When the request's budget
+        cannot fit the write it is queued for a background writer instead
+        (and counts as stored).
+        """
+        if budget is not None and not budget.allows("store"):
+            budget.defer(f"store_{message_type}_memory")
+            self._begin_write(user_id)
+            self._deferred_writes.submit(self._deferred_store, user_id, message, message_type, message_id)
+            return True
+        self._begin_write(user_id)
         try:
-            # Create unique ID for this message
-            timestamp = str(int(time.time()))
-            message_id = f"{user_id}_{message_type}_{timestamp}_{hashlib.md5(message.encode()).hexdigest()[:8]}"
+            start = time.perf_counter()
+            timestamp = int(time.time())
             
             # Generate embedding
             embedding = get_embedding(message)
             if not embedding:
                 logger.warning("Failed to generate embedding for message")
-                return
+                return False
                 
             # Store in Pinecone with better metadata structure
-            self.index.upsert(
-                vectors=[{
-                    "id": message_id,
-                    "values": embedding,
-                    "metadata": {
-                        "user_id": user_id,
-                        "message": message,
-                        "message_type": message_type,
-                        "timestamp": timestamp
-                    }
-                }]
-            )
+            record = self.memory_record(user_id, message, message_type, str(timestamp), embedding, message_id)
+            self.index.upsert(vectors=[record])
+            self.retrieval_cache.add_memory(user_id, record)
+            stage_estimates.observe("store", time.perf_counter() - start)
+            self.stats.record_stores([record])
             logger.info(f"Stored {message_type} message in memory for user {user_id}")
+            return True
             
         except Exception as e:
             logger.error(f"Error storing message in memory: {str(e)}")
+            return False
+        finally:
+            self._end_write(user_id)
+
+    def _deferred_store(self, user_id: str, message: str, message_type: str, message_id: Optional[int]) -> None:
+        try:
+            self.store_message(user_id, message, message_type, None, message_id)
+        finally:
+            self._end_write(user_id)
+
+    def _begin_write(self, user_id: str) -> None:
+        with self._writes_done:
+            self._pending_writes[user_id] += 1
+
+    def _end_write(self, user_id: str) -> None:
+        with self._writes_done:
+            self._pending_writes[user_id] -= 1
+            if self._pending_writes[user_id] <= 0:
+                del self._pending_writes[user_id]
+                self._writes_done.notify_all()
+
+    def wait_for_writes(self, user_id: str, timeout: float = MEMORY_WRITE_DRAIN_SECONDS) -> bool:
+        """Wait for this process's in-flight writes of a user, queued ones included; returns whether they all finished"""
+        with self._writes_done:
+            return self._writes_done.wait_for(lambda: user_id not in self._pending_writes, timeout)
     
+    def delete_user_memories(self, user_id: str, batch_size: int = 1000) -> int:
+        """
+        Delete every vector stored for a user; returns how many were deleted.
+        Ids are found by listing memory_id_prefix(user_id), which works on
+        serverless indexes for any user id, skipping other users whose ids
+        share the prefix, and deleted batch_size at a time. The user's in-flight writes in this process are waited for first so
+        they cannot add a vector back after the delete.
+        """
+        if not self.wait_for_writes(user_id):
+            logger.warning(f"Memory writes of user {user_id!r} still running after {MEMORY_WRITE_DRAIN_SECONDS:.0f}s; deleting anyway")
+        self.stats.forget(user_id)
+        self.retrieval_cache.invalidate(user_id)
+        prefix = self.memory_id_prefix(user_id)
+        own_id = re.compile(rf"{re.escape(prefix)}[a-z]+_m?\d+_[0-9a-f]{{8}}")
+        pending: List[str] = []
+        deleted = 0
+        token = None
+        while True:
+            page = self.index.list_paginated(prefix=prefix, limit=100, pagination_token=token)
+            pending.extend(vector.id for vector in page.vectors if own_id.fullmatch(vector.id))
+            while len(pending) >= batch_size:
+                self.index.delete(ids=pending[:batch_size])
+                deleted += batch_size
+                pending = pending[batch_size:]
+            token = page.pagination.next if page.pagination else None
+            if not token:
+                break
+        if pending:
+            self.index.delete(ids=pending)
+            deleted += len(pending)
+        return deleted
+
     def get_all_user_memories(self, user_id: str, limit: int = 50) -> List[dict]:
         """Get all memories for a user for debugging purposes"""
         try:
@@ -169,55 +565,96 @@ class MemoryService:
             logger.error(f"Error getting all user memories: {str(e)}")
             return []
     
-    def retrieve_memories(self, user_id: str, query: str, top_k: int = 5) -> List[str]:
-        """Retrieve relevant memories for a user based on query"""
-        try:
-            # Generate embedding for the query
-            query_embedding = get_embedding(query)
-            if not query_embedding:
-                logger.warning("Failed to generate embedding for query")
+    def _query_index(self, user_id: str, embedding: List[float], top_k: int,
+                     timeout: Optional[float] = None) -> List[dict]:
+        results = self.index.query(
+            vector=embedding,
+            top_k=top_k,
+            filter={"user_id": user_id},
+            include_metadata=True,
+            timeout=timeout
+        )
+        return [
+            _candidate(match.id, match.score, match.metadata if hasattr(match, 'metadata') and match.metadata else {})
+            for match in results.matches
+        ]
+
+    def _search(self, user_id: str, query: str, top_k: int, budget: Optional[LatencyBudget],
+                reserve: float) -> Tuple[List[float], List[dict]]:
+        """(query embedding, ranked candidates) fresh from the index"""
+        query_embedding = get_embedding(query, timeout=budget.timeout(reserve) if budget else None)
+        if not query_embedding:
+            raise RuntimeError("Failed to generate embedding for query")
+        return query_embedding, self._query_index(user_id, query_embedding, top_k, budget.timeout(reserve) if budget else None)
+
+    def warm_retrieval_cache(self, user_queries: Dict[str, List[str]], top_k: int = 5) -> int:
+        """
+        Preload the retrieval cache with each user's queries (embedded in
+        batches); returns how many results were cached. Errors are raised.
+        """
+        pairs = [(user_id, query) for user_id, queries in user_queries.items() for query in queries]
+        for offset in range(0, len(pairs), 2048):
+            batch = pairs[offset:offset + 2048]
+            embeddings, _ = get_embeddings([query for _, query in batch])
+            for (user_id, query), embedding in zip(batch, embeddings):
+                generation = self.retrieval_cache.generation(user_id)
+                candidates = self._query_index(user_id, embedding, top_k)
+                self.retrieval_cache.put(user_id, query, top_k, embedding, candidates, generation)
+        return len(pairs)
+
+    def search_memories(self, user_id: str, query: str, top_k: int = 5, budget: Optional[LatencyBudget] = None,
+                        reserve: float = 0.0) -> List[dict]:
+        """
+        Rank a user's memories against a query without recording anything.
+        Returns every match, best first, with its score and whether it clears
+        MEMORY_SCORE_THRESHOLD. Always queries the index (no cache). With a
+        budget, each call times out so that `reserve` seconds remain. Errors
+        are raised.
+        """
+        return self._search(user_id, query, top_k, budget, reserve)[1]
+
+    def retrieve_memories(self, user_id: str, query: str, top_k: int = 5, budget: Optional[LatencyBudget] = None,
+                          reserve: float = 0.0, stage: str = "memory_retrieval", record: bool = True) -> List[str]:
+        """
+        Retrieve relevant memories for a user based on query, from the
+        retrieval cache when the same user recently ran the same query. With
+        a budget, an uncached lookup is skipped (recorded as `stage`) when it
+        would not leave `reserve` seconds, and abandoned when it runs past that.
+        Internal lookups pass record=False to stay out of the retrieval stats.
+        """
+        candidates = self.retrieval_cache.get(user_id, query, top_k)
+        cached = candidates is not None
+        if not cached:
+            if budget is not None and not budget.allows("retrieve", reserve):
+                budget.skip(stage)
                 return []
-                
-            # Search for relevant memories
-            results = self.index.query(
-                vector=query_embedding,
-                top_k=top_k,
-                filter={"user_id": user_id},
-                include_metadata=True
-            )
-            
-            logger.info(f"Found {len(results.matches)} potential matches for user {user_id}")
-            
-            # Process results with more lenient threshold
-            memories = []
-            for i, match in enumerate(results.matches):
-                logger.info(f"Match {i+1}: Score={match.score:.3f}")
-                
-                # Lower threshold to 0.5 for better recall, and include score info
-                if match.score > 0.5:  
-                    if hasattr(match, 'metadata') and match.metadata:
-                        message = match.metadata.get("message", "")
-                        message_type = match.metadata.get("message_type", "unknown")
-                        timestamp = match.metadata.get("timestamp", "")
-                        
-                        if message:
-                            # Add metadata for debugging
-                            memory_info = f"{message} [Type: {message_type}, Score: {match.score:.3f}]"
-                            memories.append(message)  # Just the message for now
-                            logger.info(f"Added memory: {message[:50]}... (Score: {match.score:.3f})")
-            
-            logger.info(f"Retrieved {len(memories)} memories above threshold")
-            return memories
-            
-        except Exception as e:
-            logger.error(f"Error retrieving memories: {str(e)}")
-            return []
+            start = time.perf_counter()
+            try:
+                generation = self.retrieval_cache.generation(user_id)
+                embedding, candidates = self._search(user_id, query, top_k, budget, reserve)
+                stage_estimates.observe("retrieve", time.perf_counter() - start)
+                self.retrieval_cache.put(user_id, query, top_k, embedding, candidates, generation)
+            except Exception as e:
+                logger.error(f"Error retrieving memories: {str(e)}")
+                if budget is not None and budget.bounded:
+                    stage_estimates.observe("retrieve", time.perf_counter() - start)
+                    budget.skip(stage)
+                return []
+        logger.info(f"Found {len(candidates)} potential matches for user {user_id}{' (cached)' if cached else ''}")
+        
+        # Lower threshold to 0.5 for better recall
+        memories = [candidate["message"] for candidate in candidates if candidate["above_threshold"]]
+        if record:
+            self.stats.record_retrieval(user_id, [candidate["score"] for candidate in candidates], len(memories), cached)
+        
+        logger.info(f"Retrieved {len(memories)} memories above threshold")
+        return memories
 
 # Initialize memory service
 memory_service = MemoryService()
 
 @function_tool
-def retrieve_relevant_memories(query: str, user_id: str, top_k: int = 5) -> str:
+def retrieve_relevant_memories(ctx: RunContextWrapper[Optional[LatencyBudget]], query: str, user_id: str, top_k: int = 5) -> str:
     """
     Retrieve relevant past memories for the user based on the current query.
     Use this when the user asks about past conversations or when context from previous interactions would be helpful.
@@ -231,9 +668,12 @@ def retrieve_relevant_memories(query: str, user_id: str, top_k: int = 5) -> str:
         A formatted string containing relevant past memories
     """
     try:
-        memories = memory_service.retrieve_memories(user_id, query, top_k)
+        budget = ctx.context
+        memories = memory_service.retrieve_memories(user_id, query, top_k, budget, reserve=LATENCY_BUDGET_RESERVE_MS / 1000)
         
         if not memories:
+            if budget is not None and "memory_retrieval" in budget.skipped:
+                return "Memory lookup was skipped to answer in time. Answer from the conversation so far."
             return "No relevant past conversations found."
             
         # Format memories for better context
@@ -276,8 +716,28 @@ memory_chatbot = Agent(
     model_settings=ModelSettings(temperature=0.3),
 )
 
+# The same agent on each tier's model
+tier_agents = {tier: memory_chatbot.clone(model=model) for tier, model in TIER_MODELS.items()}
+
+# Most recent history messages included in the agent's input
+AGENT_HISTORY_MESSAGES = 5
+
+def build_agent_input(user_id: str, message: str, conversation_history: List[Tuple[str, str]] = None) -> str:
+    """Format the user ID, recent history and current message as the agent's input"""
+    full_query = f"User ID: {user_id}\n"
+    
+    # Add recent conversation history if available
+    if conversation_history:
+        recent_context = "\n".join([f"{speaker}: {msg}" for speaker, msg in conversation_history[-AGENT_HISTORY_MESSAGES:]])
+        full_query += f"Recent conversation:\n{recent_context}\n\n"
+    
+    # Add current message
+    full_query += f"Current message: {message}"
+    return full_query
+
 # --- Main processing function ---
-async def process_query_with_memory(user_id: str, message: str, conversation_history: List[Tuple[str, str]] = None) -> str:
+async def process_query_with_memory(user_id: str, message: str, conversation_history: List[Tuple[str, str]] = None,
+                                    store_in_memory: bool = True, budget: Optional[LatencyBudget] = None) -> str:
     """
     Process a user query with autonomous memory storage and retrieval
     
@@ -285,31 +745,37 @@ async def process_query_with_memory(user_id: str, message: str, conversation_his
         user_id: Unique identifier for the user
         message: The user's message
         conversation_history: Optional conversation history for context
+        store_in_memory: Store the user message and the response in Pinecone.
+            Callers that schedule the memory writes themselves pass False.
+        budget: Optional latency budget; memory retrieval is skipped and
+            memory writes deferred when they would not fit in it.
         
     Returns:
         The assistant's response
     """
     try:
         # Store the user's message in memory
-        memory_service.store_message(user_id, message, "user")
-        
-        # Build context for the agent
-        full_query = f"User ID: {user_id}\n"
-        
-        # Add recent conversation history if available
-        if conversation_history:
-            recent_context = "\n".join([f"{speaker}: {msg}" for speaker, msg in conversation_history[-5:]])
-            full_query += f"Recent conversation:\n{recent_context}\n\n"
-        
-        # Add current message
-        full_query += f"Current message: {message}"
+        if store_in_memory:
+            memory_service.store_message(user_id, message, "user", budget)
         
-        # Process through the memory-enabled agent
-        result = await Runner.run(memory_chatbot, full_query)
-        response = result.final_output if hasattr(result, 'final_output') else str(result)
+        # Pick the model tier, or answer trivial acknowledgements directly
+        plan = classify_turn(message)
+        if plan.canned_reply is not None:
+            tier_stats.record(plan, 0.0)
+            response = plan.canned_reply
+        else:
+            # Build context for the agent
+            full_query = build_agent_input(user_id, message, conversation_history)
+            
+            # Process through the memory-enabled agent on the chosen tier
+            start = time.perf_counter()
+            result = await Runner.run(tier_agents[plan.tier], full_query, context=budget)
+            tier_stats.record(plan, time.perf_counter() - start, result.context_wrapper.usage)
+            response = result.final_output if hasattr(result, 'final_output') else str(result)
         
         # Store the assistant's response in memory
-        memory_service.store_message(user_id, response, "assistant")
+        if store_in_memory:
+            memory_service.store_message(user_id, response, "assistant", budget)
         
         return response
         
@@ -318,3 +784,24 @@ async def process_query_with_memory(user_id: str, message: str, conversation_his
         return "I apologize, but I'm having trouble processing your request right now. Please try again."
 
 
+async def stream_query_with_memory(user_id: str, message: str, conversation_history: List[Tuple[str, str]] = None,
+                                   budget: Optional[LatencyBudget] = None) -> AsyncIterator[str]:
+    """
+    Run the memory agent and yield the response text as it is generated.
+    Memory writes are left to the caller, which has the full response once
+    the iterator is exhausted. Errors are raised, not swallowed, so the
+    caller can tell its client the turn failed.
+    """
+    plan = classify_turn(message)
+    if plan.canned_reply is not None:
+        tier_stats.record(plan, 0.0)
+        yield plan.canned_reply
+        return
+
+    start = time.perf_counter()
+    result = Runner.run_streamed(tier_agents[plan.tier], build_agent_input(user_id, message, conversation_history),
+                                 context=budget)
+    async for event in result.stream_events():
+        if event.type == "raw_response_event" and isinstance(event.data, ResponseTextDeltaEvent) and event.data.delta:
+            yield event.data.delta
+    tier_stats.record(plan, time.perf_counter() - start, result.context_wrapper.usage)
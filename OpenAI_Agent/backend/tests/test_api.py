@@ -4,18 +4,30 @@ Simple and clean tests for core functionality
 """
 
 import pytest
+import asyncio
+import httpx
 import tempfile
+import threading
+import time
 import os
-from unittest.mock import patch
+from types import SimpleNamespace
+from urllib.parse import quote
+from unittest.mock import MagicMock, patch
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import sessionmaker
 
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+import api
+import backfill
 from api import app, get_db, ChatMessage, Base, load_conversation_history, save_message
+from my_agent import MemoryStats, RetrievalCache
+from model_router import TierStats, classify_turn
+from latency_budget import LatencyBudget
 
 # Test database setup
 @pytest.fixture
@@ -63,12 +75,61 @@ def test_empty_conversation_history(test_db):
     assert history == []
 
 # API Tests
+def test_init_db_concurrent_workers():
+    """Test workers creating the schema at once all start, and a table created concurrently elsewhere counts as created"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        fresh_engine = create_engine(f"sqlite:///{os.path.join(temp_dir, 'fresh.db')}", connect_args={"check_same_thread": False})
+        errors = []
+        def start_worker():
+            try:
+                api.init_db()
+            except Exception as e:
+                errors.append(e)
+        
+        with patch('api.engine', fresh_engine), patch('api.SCHEMA_LOCK_PATH', os.path.join(temp_dir, "schema.lock")):
+            workers = [threading.Thread(target=start_worker) for _ in range(4)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            
+            race = OperationalError("CREATE TABLE chat_messages", {}, Exception("table chat_messages already exists"))
+            with patch.object(Base.metadata, 'create_all', side_effect=[race, None]) as mock_create_all:
+                api.init_db()
+        
+        assert errors == []
+        assert mock_create_all.call_count == 2
+        assert set(Base.metadata.tables) <= set(inspect(fresh_engine).get_table_names())
+        fresh_engine.dispose()
+
 def test_health_endpoint(client):
     """Test health check"""
     response = client.get("/health")
     assert response.status_code == 200
     assert response.json()["status"] == "healthy"
 
+@patch('api.memory_service.is_ready')
+def test_ready_endpoint(mock_ready, client):
+    """Test readiness reflects the memory index state"""
+    mock_ready.return_value = False
+    response = client.get("/ready")
+    assert response.status_code == 503
+    assert response.json()["database"] is True
+    assert response.json()["memory_index"] is False
+    
+    mock_ready.return_value = True
+    response = client.get("/ready")
+    assert response.status_code == 200
+    assert response.json()["status"] == "ready"
+
+@patch('api.WARM_UP_RETRY_SECONDS', 0.01)
+@patch('api.memory_service.warm_up')
+def test_warm_up_retries_until_index_is_ready(mock_warm_up):
+    """Test a failed warm-up at boot is retried instead of leaving the instance unready"""
+    mock_warm_up.side_effect = [False, False, True]
+    asyncio.run(api.warm_up())
+    assert mock_warm_up.call_count == 3
+
 def test_info_endpoint(client):
     """Test API info"""
     response = client.get("/info")
@@ -76,8 +137,9 @@ def test_info_endpoint(client):
     assert "Memory Chatbot API" in response.json()["name"]
 
 @patch('api.process_query_with_memory')
+@patch('api.memory_service.store_message')
 @patch('api.memory_service.retrieve_memories')
-def test_chat_endpoint(mock_retrieve, mock_process, client):
+def test_chat_endpoint(mock_retrieve, mock_store, mock_process, client):
     """Test chat endpoint"""
     mock_process.return_value = "Hello! How can I help you?"
     mock_retrieve.return_value = []
@@ -92,6 +154,370 @@ def test_chat_endpoint(mock_retrieve, mock_process, client):
     assert data["user_id"] == "test-user"
     assert data["message"] == "Hello"
     assert "response" in data
+    assert "agent;dur=" in response.headers["server-timing"]
+
+@patch('api.process_query_with_memory')
+@patch('api.memory_service.store_message')
+@patch('api.memory_service.retrieve_memories')
+def test_chat_endpoint_history_and_memory_writes(mock_retrieve, mock_store, mock_process, client, test_db):
+    """Test the turn returns only the new messages and writes both messages to memory once"""
+    mock_process.return_value = "Nice to meet you"
+    mock_retrieve.return_value = ["Hi"]
+    save_message("test-user", "User", "Earlier", test_db)
+    save_message("test-user", "Assistant", "Reply", test_db)
+    
+    response = client.post("/chat", json={
+        "user_id": "test-user",
+        "message": "Hi"
+    })
+    
+    assert response.status_code == 200
+    data = response.json()
+    assert data["new_messages"] == [["User", "Hi"], ["Assistant", "Nice to meet you"]]
+    assert "conversation_history" not in data
+    assert data["history_version"] == test_db.query(ChatMessage).filter(ChatMessage.chat_id == "test-user").count()
+    assert data["memory_count"] == 1
+    # The memory count lookup stays out of the retrieval stats
+    assert mock_retrieve.call_args.args[-1] is False
+    assert mock_process.call_args.kwargs["conversation_history"] == [("User", "Earlier"), ("Assistant", "Reply")]
+    assert mock_process.call_args.kwargs["store_in_memory"] is False
+    stored = sorted(call.args[2] for call in mock_store.call_args_list)
+    assert stored == ["assistant", "user"]
+    assert len(load_conversation_history("test-user", test_db)) == 4
+
+@patch('api.process_query_with_memory')
+@patch('api.memory_service.store_message')
+@patch('api.memory_service.retrieve_memories')
+def test_chat_failed_stages(mock_retrieve, mock_store, mock_process, client, test_db):
+    """Test a failed memory lookup only degrades a persisted turn, and a failed turn cancels its stages"""
+    mock_process.return_value = "Answer"
+    mock_store.return_value = True
+    mock_retrieve.side_effect = RuntimeError("index down")
+
+    response = client.post("/chat", json={"user_id": "test-user", "message": "Hi"})
+    assert response.status_code == 200
+    assert response.json()["skipped_stages"] == ["memory_count"]
+    assert response.json()["memory_count"] == 0
+
+    mock_retrieve.reset_mock()
+    mock_store.side_effect = lambda *args: time.sleep(0.1) or True
+    mock_process.side_effect = RuntimeError("model down")
+    response = client.post("/chat", json={"user_id": "test-user", "message": "Again"})
+    assert response.status_code == 500
+    time.sleep(0.2)
+    mock_retrieve.assert_not_called()
+
+@patch('my_agent.Runner.run')
+@patch('api.memory_service.store_message')
+@patch('api.memory_service.retrieve_memories')
+def test_chat_canned_reply_and_tiers(mock_retrieve, mock_store, mock_run, client, test_db):
+    """Test acknowledgements skip the agent and turns are classified into tiers"""
+    mock_retrieve.return_value = []
+    with patch('my_agent.tier_stats', TierStats()) as stats, patch('api.tier_stats', stats):
+        response = client.post("/chat", json={"user_id": "test-user", "message": "Thanks!"})
+        tiers = client.get("/agent/tiers").json()
+    
+    assert response.status_code == 200
+    assert response.json()["response"].startswith("You're welcome")
+    mock_run.assert_not_called()
+    assert tiers["tiers"]["canned"]["turns"] == 1
+    
+    assert classify_turn("What's the capital of France").tier == "fast"
+    assert classify_turn("What is my favorite food?").tier == "standard"
+    assert classify_turn("Based on what we talked about, explain how I should plan my week").tier == "deep"
+    assert classify_turn("Thanks, but why is the sky blue?").tier == "standard"
+
+@patch('api.init_db')
+@patch('api.memory_service.warm_up')
+@patch('api.process_query_with_memory')
+@patch('api.memory_service.retrieve_memories')
+def test_chat_latency_budget_defers_slow_memory_stages(mock_retrieve, mock_process, mock_warm_up, mock_init_db, test_db):
+    """Test a short budget answers without waiting for slow memory writes and reports them"""
+    mock_process.return_value = "Quick answer"
+    mock_retrieve.return_value = []
+    release = threading.Event()
+    finished = []
+    def slow_store(*args):
+        release.wait(10)
+        finished.append(args[2])
+    
+    # One client for the whole test, so the request's event loop outlives the response
+    with patch('api.memory_service.store_message', side_effect=slow_store), TestClient(app) as client:
+        response = client.post("/chat", json={"user_id": "test-user", "message": "Hi"},
+                               headers={"X-Latency-Budget-Ms": "100"})
+        # The memory writes were still blocked when the response was sent
+        assert finished == []
+        release.set()
+    
+    assert response.status_code == 200
+    data = response.json()
+    assert data["response"] == "Quick answer"
+    assert set(data["deferred_stages"]) == {"store_user_memory", "store_assistant_memory"}
+    assert data["skipped_stages"] == ["memory_count"]
+    budget = mock_process.call_args.kwargs["budget"]
+    assert budget.bounded
+    assert budget.remaining() == 0.0
+
+def test_latency_budget_skips_retrieval_and_defers_writes():
+    """Test memory stages consult the budget before doing any network work"""
+    index = MagicMock()
+    budget = LatencyBudget(1)
+    time.sleep(0.01)
+    
+    with patch('api.memory_service._index', index), patch('my_agent.get_embedding', return_value=[0.1]) as mock_embedding, \
+            patch('api.memory_service.stats', MemoryStats()):
+        assert api.memory_service.retrieve_memories("test-user", "What's my name?", budget=budget) == []
+        assert api.memory_service.store_message("test-user", "My name is Sam", "user", budget) is True
+        api.memory_service._deferred_writes.submit(lambda: None).result()
+        time.sleep(0.05)
+    
+    assert budget.skipped == ["memory_retrieval"]
+    assert budget.deferred == ["store_user_memory"]
+    index.query.assert_not_called()
+    assert index.upsert.call_count == 1
+    assert mock_embedding.call_count == 1
+
+@patch('api.process_query_with_memory')
+@patch('api.memory_service.store_message')
+@patch('api.memory_service.retrieve_memories')
+def test_chat_idempotency_key_replays_response(mock_retrieve, mock_store, mock_process, client, test_db):
+    """Test a retry with the same Idempotency-Key returns the stored response without rerunning the turn"""
+    mock_process.return_value = "Only once"
+    mock_retrieve.return_value = []
+    body = {"user_id": "test-user", "message": "Hello"}
+    headers = {"Idempotency-Key": "retry-1"}
+    
+    first = client.post("/chat", json=body, headers=headers)
+    second = client.post("/chat", json=body, headers=headers)
+    
+    assert first.status_code == 200 and second.status_code == 200
+    assert second.json() == first.json()
+    assert second.headers["idempotent-replayed"] == "true"
+    assert mock_process.call_count == 1
+    assert mock_store.call_count == 2
+    assert len(load_conversation_history("test-user", test_db)) == 2
+    
+    conflict = client.post("/chat", json={"user_id": "test-user", "message": "Different"}, headers=headers)
+    assert conflict.status_code == 422
+
+@patch('api.memory_service.store_message')
+@patch('api.memory_service.retrieve_memories')
+def test_chat_idempotency_key_single_flight(mock_retrieve, mock_store, test_db):
+    """Test concurrent retries with the same key share one in-flight turn"""
+    mock_retrieve.return_value = []
+    calls = []
+    
+    async def slow_process(**kwargs):
+        calls.append(kwargs)
+        await asyncio.sleep(0.2)
+        return "Shared answer"
+    
+    async def send_concurrently():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as async_client:
+            return await asyncio.gather(*[
+                async_client.post("/chat", json={"user_id": "test-user", "message": "Hello"},
+                                  headers={"Idempotency-Key": "retry-2"})
+                for _ in range(3)
+            ])
+    
+    with patch('api.process_query_with_memory', side_effect=slow_process):
+        responses = asyncio.run(send_concurrently())
+    
+    assert [response.status_code for response in responses] == [200, 200, 200]
+    assert {response.json()["response"] for response in responses} == {"Shared answer"}
+    assert len(calls) == 1
+    assert len(load_conversation_history("test-user", test_db)) == 2
+
+@patch('api.IDEMPOTENCY_POLL_SECONDS', 0.01)
+@patch('api.process_query_with_memory')
+@patch('api.memory_service.store_message')
+@patch('api.memory_service.retrieve_memories')
+def test_chat_idempotency_key_kept_when_completion_fails(mock_retrieve, mock_store, mock_process, test_db):
+    """Test a turn saved before its response could be stored is not run again by a retry"""
+    mock_process.return_value = "Only once"
+    mock_retrieve.return_value = []
+    complete = api.complete_idempotency_key
+    attempts = []
+    
+    def flaky_complete(*args):
+        attempts.append(args)
+        if len(attempts) == 1:
+            raise RuntimeError("database busy")
+        complete(*args)
+    
+    async def send_and_retry():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as async_client:
+            request = {"json": {"user_id": "test-user", "message": "Hello"}, "headers": {"Idempotency-Key": "retry-3"}}
+            first = await async_client.post("/chat", **request)
+            # The failed completion neither releases the key nor fails the saved turn
+            assert first.status_code == 200
+            assert test_db.query(api.IdempotencyRecord).one().status == "pending"
+            return first, await async_client.post("/chat", **request)
+    
+    with patch('api.complete_idempotency_key', side_effect=flaky_complete):
+        first, retry = asyncio.run(send_and_retry())
+    
+    assert retry.status_code == 200
+    assert retry.headers["idempotent-replayed"] == "true"
+    assert retry.json() == first.json()
+    assert mock_process.call_count == 1
+    assert len(attempts) == 2
+    assert len(load_conversation_history("test-user", test_db)) == 2
+
+@patch('api.IDEMPOTENCY_POLL_SECONDS', 0.01)
+@patch('api.IDEMPOTENCY_WAIT_SECONDS', 0.1)
+@patch('api.process_query_with_memory')
+@patch('api.memory_service.store_message')
+@patch('api.memory_service.retrieve_memories')
+def test_chat_idempotency_key_takeover_follows_heartbeat(mock_retrieve, mock_store, mock_process, client, test_db):
+    """Test a pending key is taken over when its worker stopped renewing it, however old the key is"""
+    mock_process.return_value = "Taken over"
+    mock_retrieve.return_value = []
+    body = {"user_id": "test-user", "message": "Hello"}
+    headers = {"Idempotency-Key": "retry-4"}
+    long_ago = api.datetime.utcnow() - api.timedelta(hours=1)
+    test_db.add(api.IdempotencyRecord(user_id="test-user", key="retry-4", fingerprint=api._request_fingerprint(api.ChatRequest(**body)),
+                                      status="pending", created_at=long_ago, heartbeat_at=api.datetime.utcnow()))
+    test_db.commit()
+    
+    # A slow turn on another worker, still renewing its heartbeat
+    assert client.post("/chat", json=body, headers=headers).status_code == 409
+    mock_process.assert_not_called()
+    
+    # That worker is gone
+    test_db.query(api.IdempotencyRecord).update({"heartbeat_at": long_ago})
+    test_db.commit()
+    response = client.post("/chat", json=body, headers=headers)
+    assert response.status_code == 200
+    assert response.json()["response"] == "Taken over"
+    test_db.expire_all()
+    assert test_db.query(api.IdempotencyRecord).one().status == "completed"
+
+@patch('api.memory_service.store_message')
+@patch('api.memory_service.retrieve_memories')
+def test_same_user_turns_are_ordered(mock_retrieve, mock_store, test_db):
+    """Test concurrent turns of one user run in order while other users run in parallel"""
+    mock_retrieve.return_value = []
+    seen = {}
+    other_started = asyncio.Event()
+
+    async def slow_process(user_id, message, conversation_history, **kwargs):
+        seen[message] = [text for _, text in conversation_history]
+        if message == "Other":
+            other_started.set()
+        elif message == "First":
+            # user-b's turn has to start while user-a's first turn is still in here
+            await asyncio.wait_for(other_started.wait(), 5)
+        return f"Re: {message}"
+
+    async def send_concurrently():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as async_client:
+            return await asyncio.gather(*[
+                async_client.post("/chat", json={"user_id": user_id, "message": message})
+                for user_id, message in [("user-a", "First"), ("user-a", "Second"), ("user-b", "Other")]
+            ])
+
+    with patch('api.process_query_with_memory', side_effect=slow_process):
+        responses = asyncio.run(send_concurrently())
+
+    assert [response.status_code for response in responses] == [200, 200, 200]
+    assert list(seen) == ["First", "Other", "Second"]
+    assert seen["Second"] == ["First", "Re: First"]
+    assert seen["Other"] == []
+
+def test_user_lease_fences_stale_holder(test_db):
+    """Test a lease taken over after its TTL rejects the stale holder's writes"""
+    async def take_over():
+        stale = await api.acquire_user_lease("test-user", test_db)
+        stale._heartbeat.cancel()
+        test_db.query(api.UserLeaseRecord).update({"expires_at": api.datetime.utcnow() - api.timedelta(seconds=1)})
+        test_db.commit()
+        # Another worker: its own process-local lock
+        fresh = api.UserLease("test-user", asyncio.Lock())
+        await fresh.acquire(test_db)
+        assert fresh.token == stale.token + 1
+
+        with pytest.raises(api.HTTPException) as excinfo:
+            save_message("test-user", "User", "Stale write", test_db, stale)
+        assert excinfo.value.status_code == 409
+        save_message("test-user", "User", "Fresh write", test_db, fresh)
+        fresh.release()
+        stale.release()
+
+    asyncio.run(take_over())
+    assert load_conversation_history("test-user", test_db) == [("User", "Fresh write")]
+    assert test_db.query(api.UserLeaseRecord).one().holder is None
+
+def test_user_lease_release_survives_database_error(test_db):
+    """Test a failed lease row update still frees the worker's local lock"""
+    async def release_during_outage():
+        lease = await api.acquire_user_lease("test-user", test_db)
+        with patch('api.Session', side_effect=RuntimeError("database down")):
+            lease.release()
+        assert not lease._lock.locked()
+        assert lease.token is None
+        
+        # The row is left to expire; once it has, the user's next turn gets it
+        test_db.query(api.UserLeaseRecord).update({"expires_at": api.datetime.utcnow() - api.timedelta(seconds=1)})
+        test_db.commit()
+        following = await asyncio.wait_for(api.acquire_user_lease("test-user", test_db), 5)
+        following.release()
+
+    asyncio.run(release_during_outage())
+
+@patch('api.memory_service.store_message')
+def test_chat_stream_endpoint(mock_store, client, test_db):
+    """Test /chat/stream sends tokens, then done, and persists the full response"""
+    async def fake_stream(user_id, message, conversation_history, budget=None):
+        for chunk in ["Hel", "lo ", "there"]:
+            yield chunk
+    
+    with patch('api.stream_query_with_memory', side_effect=fake_stream):
+        with client.stream("POST", "/chat/stream", json={"user_id": "test-user", "message": "Hi"}) as response:
+            assert response.status_code == 200
+            assert response.headers["content-type"].startswith("text/event-stream")
+            events = [line[len("event: "):] for line in response.iter_lines() if line.startswith("event: ")]
+    
+    assert events == ["token", "token", "token", "done"]
+    assert load_conversation_history("test-user", test_db) == [("User", "Hi"), ("Assistant", "Hello there")]
+    assert sorted(call.args[2] for call in mock_store.call_args_list) == ["assistant", "user"]
+
+@patch('api.memory_service.store_message')
+def test_chat_websocket_session(mock_store, client, test_db):
+    """Test the WebSocket session streams turns, writes them through and keeps the recent window"""
+    seen_histories = []
+    async def fake_stream(user_id, message, conversation_history, budget=None):
+        seen_histories.append(list(conversation_history))
+        for chunk in ["Re: ", message]:
+            yield chunk
+
+    save_message("test-user", "User", "Earlier", test_db)
+    with patch('api.stream_query_with_memory', side_effect=fake_stream):
+        with client.websocket_connect("/chat/ws/test-user") as ws:
+            session = ws.receive_json()
+            assert session["type"] == "session"
+            assert session["recent"] == [["User", "Earlier"]]
+
+            ws.send_json({"message": "Hi"})
+            messages = [ws.receive_json() for _ in range(3)]
+            assert [m["type"] for m in messages] == ["token", "token", "done"]
+            assert messages[-1]["response"] == "Re: Hi"
+
+            # A write from elsewhere is picked up before the next turn
+            save_message("test-user", "User", "From another tab", test_db)
+            ws.send_json({"message": "Again"})
+            assert [ws.receive_json()["type"] for _ in range(3)] == ["token", "token", "done"]
+
+            ws.send_json({"message": ""})
+            assert ws.receive_json()["type"] == "error"
+
+    assert seen_histories[0] == [("User", "Earlier")]
+    assert seen_histories[1] == [("User", "Earlier"), ("User", "Hi"), ("Assistant", "Re: Hi"), ("User", "From another tab")]
+    assert [m for _, m in load_conversation_history("test-user", test_db)][-2:] == ["Again", "Re: Again"]
+    assert api.chat_sessions.snapshot()["sessions"] == 0
 
 def test_get_chat_history(client, test_db):
     """Test getting chat history"""
@@ -104,6 +530,280 @@ def test_get_chat_history(client, test_db):
     assert data["user_id"] == "test-user"
     assert len(data["conversation_history"]) == 1
 
+def test_get_chat_history_encoded_user_id(client, test_db):
+    """Test user ids with path and query characters round-trip when percent-encoded"""
+    user_id = "team/a b?x#1"
+    save_message(user_id, "User", "Hello", test_db)
+    
+    response = client.get(f"/chat/history/{quote(user_id, safe='')}")
+    
+    assert response.status_code == 200
+    assert response.json()["user_id"] == user_id
+    assert response.json()["conversation_history"] == [["User", "Hello"]]
+
+def test_get_chat_history_pages(client, test_db):
+    """Test paging through history newest first with the before_id cursor"""
+    for i in range(5):
+        save_message("test-user", "User", f"Message {i}", test_db)
+    
+    newest = client.get("/chat/history/test-user?limit=2").json()
+    assert [message for _, message in newest["conversation_history"]] == ["Message 3", "Message 4"]
+    assert newest["has_more"] is True
+    
+    older = client.get(f"/chat/history/test-user?limit=2&before_id={newest['next_before_id']}").json()
+    assert [message for _, message in older["conversation_history"]] == ["Message 1", "Message 2"]
+    
+    oldest = client.get(f"/chat/history/test-user?limit=2&before_id={older['next_before_id']}").json()
+    assert [message for _, message in oldest["conversation_history"]] == ["Message 0"]
+    assert oldest["has_more"] is False
+    assert oldest["next_before_id"] is None
+
+def test_get_chat_history_since_and_etag(client, test_db):
+    """Test since= returns only newer messages and If-None-Match avoids resending unchanged history"""
+    for i in range(3):
+        save_message("test-user", "User", f"Message {i}", test_db)
+    
+    first = client.get("/chat/history/test-user")
+    etag = first.headers["etag"]
+    version = first.json()["history_version"]
+    assert client.get("/chat/history/test-user", headers={"If-None-Match": etag}).status_code == 304
+    
+    save_message("test-user", "Assistant", "Reply", test_db)
+    save_message("test-user", "User", "Again", test_db)
+    assert client.get("/chat/history/test-user", headers={"If-None-Match": etag}).status_code == 200
+    
+    newer = client.get(f"/chat/history/test-user?since={version}&limit=1").json()
+    assert newer["conversation_history"] == [["Assistant", "Reply"]]
+    assert newer["has_more"] is True
+    rest = client.get(f"/chat/history/test-user?since={newer['next_since_id']}&limit=1").json()
+    assert rest["conversation_history"] == [["User", "Again"]]
+    assert rest["has_more"] is False
+    assert rest["history_version"] == newer["history_version"]
+    
+    assert client.get("/chat/history/test-user?since=1&before_id=2").status_code == 400
+
+def test_history_etag_per_page_and_across_deletes(client, test_db):
+    """Test different pages never share an ETag and tags do not repeat after the history is cleared"""
+    for i in range(4):
+        save_message("test-user", "User", f"Message {i}", test_db)
+    
+    newest = client.get("/chat/history/test-user?limit=2")
+    etag = newest.headers["etag"]
+    older = client.get(f"/chat/history/test-user?limit=2&before_id={newest.json()['next_before_id']}",
+                       headers={"If-None-Match": etag})
+    assert older.status_code == 200
+    assert older.headers["etag"] != etag
+    assert client.get("/chat/history/test-user?limit=2", headers={"If-None-Match": etag}).status_code == 304
+    
+    # Same number of messages after a clear, possibly with reused ids
+    assert client.delete("/chat/history/test-user").status_code == 200
+    for i in range(4):
+        save_message("test-user", "User", f"New {i}", test_db)
+    again = client.get("/chat/history/test-user?limit=2", headers={"If-None-Match": etag})
+    assert again.status_code == 200
+    assert [message for _, message in again.json()["conversation_history"]] == ["New 2", "New 3"]
+
+def test_history_export_and_import(client, test_db):
+    """Test NDJSON export can be filtered and imported back"""
+    save_message("user-a", "User", "Hello", test_db)
+    save_message("user-a", "Assistant", "Hi there", test_db)
+    save_message("user-b", "User", "Other user", test_db)
+    
+    export = client.get("/admin/history/export?user_id=user-a")
+    assert export.status_code == 200
+    assert export.headers["content-type"].startswith("application/x-ndjson")
+    lines = export.text.splitlines()
+    assert len(lines) == 2
+    
+    client.delete("/chat/history/user-a")
+    response = client.post("/admin/history/import", content=export.text)
+    assert response.status_code == 200
+    assert response.json()["imported"] == 2
+    assert load_conversation_history("user-a", test_db) == [("User", "Hello"), ("Assistant", "Hi there")]
+    
+    invalid = client.post("/admin/history/import", content=lines[0] + "\n{not json}\n")
+    assert invalid.status_code == 400
+    assert "line 2" in invalid.json()["detail"]
+
+@patch('api.init_db')
+@patch('api.memory_service.warm_up')
+@patch('api.memory_service.delete_user_memories')
+def test_purge_users(mock_delete_memories, mock_warm_up, mock_init_db, test_db):
+    """Test a purge job removes history and memories and reports progress"""
+    mock_delete_memories.side_effect = lambda user_id, batch_size: (_ for _ in ()).throw(RuntimeError("index down")) if user_id == "user-c" else 3
+    for i in range(5):
+        save_message("user-a", "User", f"Message {i}", test_db)
+    save_message("user-b", "User", "Hello", test_db)
+    save_message("user-keep", "User", "Keep me", test_db)
+    
+    with patch('api.SessionLocal', sessionmaker(bind=test_db.get_bind())), patch('api.PURGE_BATCH_SIZE', 2):
+        with TestClient(app) as client:
+            response = client.post("/admin/purge", json={"user_ids": ["user-a", "user-b", "user-c"]})
+            assert response.status_code == 202
+            job_id = response.json()["job_id"]
+            
+            for _ in range(100):
+                status = client.get(f"/admin/purge/{job_id}").json()
+                if status["status"] == "completed":
+                    break
+                time.sleep(0.05)
+            
+            assert client.get("/admin/purge/unknown").status_code == 404
+    
+    assert status["status"] == "completed"
+    assert status["users_done"] == 3
+    assert status["users_failed"] == 1
+    assert status["rows_deleted"] == 6
+    assert status["vectors_deleted"] == 6
+    assert "index down" in status["errors"]["user-c"]
+    assert load_conversation_history("user-a", test_db) == []
+    assert load_conversation_history("user-keep", test_db) == [("User", "Keep me")]
+    # Each user was purged under their lease, released afterwards
+    leases = test_db.query(api.UserLeaseRecord).all()
+    assert sorted(lease.user_id for lease in leases) == ["user-a", "user-b", "user-c"]
+    assert all(lease.holder is None for lease in leases)
+
+def test_delete_user_memories_waits_for_deferred_writes():
+    """Test a memory delete lets the user's deferred write land first, so it is deleted too"""
+    index = MagicMock()
+    index.list_paginated.side_effect = lambda **kwargs: SimpleNamespace(
+        vectors=[SimpleNamespace(id=call.kwargs["vectors"][0]["id"]) for call in index.upsert.call_args_list],
+        pagination=None)
+    embedding_ready = threading.Event()
+    budget = LatencyBudget(1)
+    time.sleep(0.01)
+    
+    with patch('api.memory_service._index', index), patch('api.memory_service.stats', MemoryStats()), \
+            patch('my_agent.get_embedding', side_effect=lambda text: embedding_ready.wait(10) and [0.1]):
+        assert api.memory_service.store_message("purge-user", "My name is Sam", "user", budget, 7) is True
+        deleter = threading.Thread(target=lambda: deleted.append(api.memory_service.delete_user_memories("purge-user")))
+        deleted = []
+        deleter.start()
+        deleter.join(0.1)
+        assert deleter.is_alive()
+        index.delete.assert_not_called()
+        
+        embedding_ready.set()
+        deleter.join(5)
+    
+    assert deleted == [1]
+    index.delete.assert_called_once_with(ids=[index.upsert.call_args.kwargs["vectors"][0]["id"]])
+
+@patch('my_agent.get_embedding', return_value=[0.1, 0.2])
+def test_delete_user_memories_lists_any_user_id(mock_embedding):
+    """Test non-ASCII and very long user ids get ASCII vector ids, so their memories are deleted by prefix listing"""
+    index = MagicMock()
+    index.list_paginated.side_effect = lambda prefix, **kwargs: SimpleNamespace(vectors=[
+        SimpleNamespace(id=call.kwargs["vectors"][0]["id"]) for call in index.upsert.call_args_list
+        if call.kwargs["vectors"][0]["id"].startswith(prefix)
+    ], pagination=None)
+    users = ["zoë", "用户", "u" * 600, "plain-user"]
+    
+    with patch('api.memory_service._index', index), patch('api.memory_service.retrieval_cache', RetrievalCache()), \
+            patch('api.memory_service.stats', MemoryStats()):
+        for position, user_id in enumerate(users):
+            assert api.memory_service.store_message(user_id, "I like tea", "user", None, position)
+        ids = [call.kwargs["vectors"][0]["id"] for call in index.upsert.call_args_list]
+        assert all(vector_id.isascii() and len(vector_id) <= 512 for vector_id in ids)
+        assert ids[-1].startswith("plain-user_user_m3_")
+        
+        assert [api.memory_service.delete_user_memories(user_id) for user_id in users] == [1, 1, 1, 1]
+    
+    assert sorted(vector_id for call in index.delete.call_args_list for vector_id in call.kwargs["ids"]) == sorted(ids)
+    assert all("filter" not in call.kwargs for call in index.delete.call_args_list)
+
+@patch('my_agent.get_embedding', return_value=[0.1, 0.2])
+def test_memory_store_test_and_stats(mock_embedding, client):
+    """Test stats follow stores and retrievals while /memories/test records nothing"""
+    match = SimpleNamespace(id="m1", score=0.8, metadata={"message": "I love tea", "message_type": "user", "timestamp": "100"})
+    weak = SimpleNamespace(id="m2", score=0.2, metadata={"message": "Hello", "message_type": "user", "timestamp": "90"})
+    index = MagicMock()
+    index.query.return_value = SimpleNamespace(matches=[match, weak])
+    
+    with patch('api.memory_service._index', index), patch('api.memory_service.stats', MemoryStats()):
+        assert client.post("/memories/store", json={"user_id": "stats-user", "message": "I love tea"}).status_code == 200
+        assert client.post("/memories/store", json={"user_id": "stats-user", "message": "Noted!", "message_type": "assistant"}).status_code == 200
+        
+        tested = client.get("/memories/test/stats-user?query=tea").json()
+        assert [c["id"] for c in tested["candidates"]] == ["m1", "m2"]
+        assert tested["would_retrieve"] == 1
+        assert client.get("/memories/stats/stats-user").json()["retrievals"] == 0
+        
+        api.memory_service.retrieve_memories("stats-user", "tea")
+        stats = client.get("/memories/stats/stats-user").json()
+    
+    assert index.upsert.call_count == 2
+    assert stats["memory_count"] == 2
+    assert stats["by_type"] == {"user": 1, "assistant": 1}
+    assert stats["bytes"] == len("I love tea") + len("Noted!")
+    assert stats["first_timestamp"] <= stats["last_timestamp"]
+    assert stats["retrievals"] == 1
+    assert stats["retrieval_hit_rate"] == 1.0
+    assert stats["average_retrieval_score"] == 0.5
+
+@patch('my_agent.get_embedding', return_value=[1.0, 0.0])
+def test_retrieval_cache_hits_and_write_through(mock_embedding):
+    """Test repeated queries skip the index and stored messages update cached rankings"""
+    old = SimpleNamespace(id="old", score=0.6, metadata={"message": "I like tea", "message_type": "user", "timestamp": "1"})
+    index = MagicMock()
+    index.query.return_value = SimpleNamespace(matches=[old])
+    index.list_paginated.return_value = SimpleNamespace(vectors=[], pagination=None)
+    
+    with patch('api.memory_service._index', index), patch('api.memory_service.retrieval_cache', RetrievalCache()), \
+            patch('api.memory_service.stats', MemoryStats()):
+        service = api.memory_service
+        assert service.retrieve_memories("cache-user", "What do I like?") == ["I like tea"]
+        assert service.retrieve_memories("cache-user", "  what do i LIKE? ") == ["I like tea"]
+        assert index.query.call_count == 1
+        
+        service.store_message("cache-user", "I love coffee", "user")
+        assert service.retrieve_memories("cache-user", "What do I like?") == ["I love coffee", "I like tea"]
+        assert index.query.call_count == 1
+        assert service.stats.snapshot("cache-user")["retrieval_cache_hit_rate"] == round(2 / 3, 4)
+        
+        service.delete_user_memories("cache-user")
+        service.retrieve_memories("cache-user", "What do I like?")
+        assert index.query.call_count == 2
+
+def test_database_memory_stats(test_db):
+    """Test stats persisted in the chat database count each vector once and are shared across instances"""
+    factory = sessionmaker(bind=test_db.get_bind())
+    record = lambda vector_id, message_type, timestamp: api.memory_service.memory_record(
+        "stats-user", "I love tea", message_type, str(timestamp), [1.0], vector_id)
+    records = [record(1, "user", 100), record(2, "assistant", 160)]
+    
+    api.DatabaseMemoryStats(factory).record_stores(records)
+    # Another worker, or a backfill re-run over the same rows
+    api.DatabaseMemoryStats(factory).record_stores(records + [record(3, "user", 200)])
+    api.DatabaseMemoryStats(factory).record_retrieval("stats-user", [0.9, 0.2], hits=1)
+    api.DatabaseMemoryStats(factory).record_retrieval("stats-user", [], hits=0, cached=True)
+    
+    stats = api.DatabaseMemoryStats(factory).snapshot("stats-user")
+    assert stats["memory_count"] == 3
+    assert stats["by_type"] == {"user": 2, "assistant": 1}
+    assert (stats["first_timestamp"], stats["last_timestamp"]) == (100, 200)
+    assert stats["bytes"] == 3 * len("I love tea")
+    assert stats["retrievals"] == 2
+    assert stats["retrieval_hit_rate"] == 0.5
+    assert stats["retrieval_cache_hit_rate"] == 0.5
+    assert stats["average_retrieval_score"] == 0.55
+    
+    api.DatabaseMemoryStats(factory).forget("stats-user")
+    assert api.DatabaseMemoryStats(factory).snapshot("stats-user")["memory_count"] == 0
+
+@patch('my_agent.get_embedding', return_value=[1.0, 0.0])
+def test_memory_ids_are_stable_per_message_row(mock_embedding):
+    """Test live writes and backfill key a saved message by its row id, whenever they run"""
+    index = MagicMock()
+    with patch('api.memory_service._index', index), patch('api.memory_service.retrieval_cache', RetrievalCache()), \
+            patch('api.memory_service.stats', MemoryStats()), patch('my_agent.time.time', return_value=1000):
+        api.memory_service.store_message("id-user", "I love coffee", "user", None, 42)
+    
+    live_id = index.upsert.call_args.kwargs["vectors"][0]["id"]
+    backfill_id = api.memory_service.memory_record("id-user", "I love coffee", "user", "1999", [1.0, 0.0], 42)["id"]
+    assert live_id == backfill_id
+    assert live_id.startswith("id-user_user_m42_")
+
 def test_clear_chat_history(client, test_db):
     """Test clearing chat history"""
     save_message("test-user", "User", "Hello", test_db)
@@ -116,6 +816,38 @@ def test_clear_chat_history(client, test_db):
     history = load_conversation_history("test-user", test_db)
     assert len(history) == 0
 
+@patch('api.memory_service.store_message')
+@patch('api.memory_service.retrieve_memories')
+def test_clear_chat_history_waits_for_running_turn(mock_retrieve, mock_store, test_db):
+    """Test a clear during a turn waits for the turn, so its reply does not land in the cleared history"""
+    mock_retrieve.return_value = []
+    save_message("test-user", "User", "Earlier", test_db)
+    in_turn = asyncio.Event()
+    finish_turn = asyncio.Event()
+
+    async def slow_process(user_id, message, conversation_history, **kwargs):
+        in_turn.set()
+        await asyncio.wait_for(finish_turn.wait(), 5)
+        return "Reply"
+
+    async def clear_during_turn():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as async_client:
+            turn = asyncio.create_task(async_client.post("/chat", json={"user_id": "test-user", "message": "Hi"}))
+            await asyncio.wait_for(in_turn.wait(), 5)
+            clear = asyncio.create_task(async_client.delete("/chat/history/test-user"))
+            await asyncio.sleep(0.05)
+            assert not clear.done()
+            finish_turn.set()
+            return await turn, await clear
+
+    with patch('api.process_query_with_memory', side_effect=slow_process):
+        turn_response, clear_response = asyncio.run(clear_during_turn())
+
+    assert turn_response.status_code == 200
+    assert clear_response.status_code == 200
+    assert load_conversation_history("test-user", test_db) == []
+
 def test_invalid_chat_request(client):
     """Test invalid request"""
     response = client.post("/chat", json={
@@ -123,4 +855,92 @@ def test_invalid_chat_request(client):
         "message": "Hello"
     })
     
-    assert response.status_code == 422 
\ No newline at end of file
+    assert response.status_code == 422 
+
+# Backfill Tests
+def _backfill_args(checkpoint_path, **overrides):
+    args = dict(checkpoint=checkpoint_path, user_id=None, chunk_size=2, embed_batch=1, upsert_batch=2, concurrency=2,
+                max_requests_per_second=0, retries=1, price_per_million=backfill.DEFAULT_PRICE_PER_MILLION)
+    args.update(overrides)
+    return SimpleNamespace(**args)
+
+def test_backfill_chunks_checkpoints_and_resumes(test_db):
+    """Test the backfill works in chunks, checkpoints each one and resumes after a crash"""
+    for i in range(5):
+        save_message("backfill-user", "User", f"Message {i}", test_db)
+    row_ids = [row.id for row in test_db.query(ChatMessage).order_by(ChatMessage.id)]
+    index = MagicMock()
+    failing = {"Message 3"}
+    
+    def embed(texts):
+        if failing & set(texts):
+            raise RuntimeError("embeddings down")
+        return [[0.1, 0.2] for _ in texts], len(texts)
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "checkpoint.json")
+        with patch('backfill.SessionLocal', sessionmaker(bind=test_db.get_bind())), patch('backfill.get_embeddings', side_effect=embed), \
+                patch('api.memory_service._index', index), patch('api.memory_service.stats', MemoryStats()):
+            with pytest.raises(RuntimeError):
+                backfill.Backfill(_backfill_args(path), backfill.Checkpoint()).run()
+            # The first chunk (2 rows) made it into the checkpoint, the failed one did not
+            checkpoint = backfill.Checkpoint.load(path)
+            assert (checkpoint.last_id, checkpoint.messages, checkpoint.tokens) == (row_ids[1], 2, 2)
+            assert os.listdir(temp_dir) == ["checkpoint.json"]
+            
+            failing.clear()
+            resumed = backfill.Backfill(_backfill_args(path), checkpoint)
+            assert resumed.remaining()[0] == 3
+            resumed.run()
+        
+        checkpoint = backfill.Checkpoint.load(path)
+        assert (checkpoint.last_id, checkpoint.messages, checkpoint.tokens) == (row_ids[-1], 5, 5)
+    
+    upserted = [record["id"] for call in index.upsert.call_args_list for record in call.kwargs["vectors"]]
+    assert all(len(call.kwargs["vectors"]) <= 2 for call in index.upsert.call_args_list)
+    # Rows 0 and 1 were upserted before the crash; the resumed run starts after them
+    assert sorted(upserted) == sorted(backfill.MemoryService.memory_record(
+        "backfill-user", f"Message {i}", "user", "0", [], row_id)["id"] for i, row_id in enumerate(row_ids))
+
+def test_backfill_checkpoint_save_is_atomic():
+    """Test a crash while saving keeps the previous checkpoint intact"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "checkpoint.json")
+        backfill.Checkpoint(last_id=10, messages=10).save(path)
+        with patch('backfill.os.replace', side_effect=OSError("disk full")):
+            with pytest.raises(OSError):
+                backfill.Checkpoint(last_id=20, messages=20).save(path)
+        assert backfill.Checkpoint.load(path).last_id == 10
+
+@patch('backfill.time.sleep')
+def test_backfill_retries_and_rate_limit(mock_sleep):
+    """Test with_retries backs off exponentially and RateLimiter spaces calls"""
+    flaky = MagicMock(side_effect=[RuntimeError("503"), RuntimeError("503"), "ok"])
+    assert backfill.with_retries(flaky, 3, "texts") == "ok"
+    flaky.assert_called_with("texts")
+    assert [call.args[0] for call in mock_sleep.call_args_list] == [1, 2]
+    
+    with pytest.raises(RuntimeError):
+        backfill.with_retries(MagicMock(side_effect=RuntimeError("down")), 2)
+    
+    mock_sleep.reset_mock()
+    with patch('backfill.time.monotonic', return_value=100.0):
+        limiter = backfill.RateLimiter(10)
+        for _ in range(3):
+            limiter.wait()
+    assert [round(call.args[0], 6) for call in mock_sleep.call_args_list] == [0.0, 0.1, 0.2]
+    
+    mock_sleep.reset_mock()
+    backfill.RateLimiter(0).wait()
+    mock_sleep.assert_not_called()
+
+def test_backfill_creates_schema_on_fresh_database():
+    """Test the backfill creates missing tables, so its stats writes work on a database the API never used"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        fresh_engine = create_engine(f"sqlite:///{os.path.join(temp_dir, 'fresh.db')}")
+        argv = ["backfill.py", "--dry-run", "--checkpoint", os.path.join(temp_dir, "checkpoint.json")]
+        with patch('api.engine', fresh_engine), patch('api.SCHEMA_LOCK_PATH', os.path.join(temp_dir, "schema.lock")), \
+                patch('backfill.SessionLocal', sessionmaker(bind=fresh_engine)), patch('sys.argv', argv):
+            backfill.main()
+        assert {"chat_messages", "memory_vectors", "memory_retrieval_stats"} <= set(inspect(fresh_engine).get_table_names())
+        fresh_engine.dispose()
@@ -1,19 +1,25 @@
 import streamlit as st
 import asyncio
-import uuid
-from typing import List, Tuple
-import time
-import sys
+import json
 import os
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-
-from my_agent import process_query_with_memory, memory_service
+import queue
+import threading
+from typing import Iterator, List, Optional
+from urllib.parse import quote
+import httpx
 import logging
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Backend API (OpenAI_Agent/backend); all agent and memory work happens there
+BACKEND_URL = os.getenv("BACKEND_URL", "http://localhost:8000")
+# Connections kept open to the backend, shared by every session of this Streamlit process
+BACKEND_MAX_CONNECTIONS = int(os.getenv("BACKEND_MAX_CONNECTIONS", "20"))
+# Messages fetched per history page, and shown at once in the chat window
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "20"))
+
 # Page configuration
 st.set_page_config(
     page_title="Memory-Enabled AI Chatbot",
@@ -68,51 +74,132 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+class BackendClient:
+    """
+    Async client for the backend, running on a long-lived event loop in a
+    daemon thread. Streamlit runs the script on a new thread for every
+    interaction. Coroutines are submitted to this loop with
+    run_coroutine_threadsafe, so one connection pool stays warm across
+    turns and sessions.
+    """
+
+    # Marks the end of a streamed response in the chunk queue
+    _END = object()
+
+    def __init__(self, base_url: str, max_connections: int):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="backend-client", daemon=True)
+        self._thread.start()
+        self.http = self.run(self._open(base_url, max_connections))
+
+    @staticmethod
+    async def _open(base_url: str, max_connections: int) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            base_url=base_url,
+            timeout=httpx.Timeout(120.0, connect=5.0),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+
+    def run(self, coroutine, timeout: float = None):
+        """Run a coroutine on the background loop and wait for its result"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    async def _get_history_page(self, user_id: str, limit: int, before_id: Optional[int]) -> dict:
+        params = {"limit": limit} if before_id is None else {"limit": limit, "before_id": before_id}
+        response = await self.http.get(f"/chat/history/{quote(user_id, safe='')}", params=params)
+        response.raise_for_status()
+        return response.json()
+
+    def get_history_page(self, user_id: str, limit: int, before_id: Optional[int] = None) -> dict:
+        """
+        One page of the backend's SQL history: the newest `limit` messages
+        (older than before_id when given) and the next_before_id cursor
+        """
+        return self.run(self._get_history_page(user_id, limit, before_id))
+
+    async def _stream_chat(self, user_id: str, message: str, chunks: queue.Queue) -> None:
+        event = None
+        try:
+            async with self.http.stream("POST", "/chat/stream", json={"user_id": user_id, "message": message}) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if line.startswith("event: "):
+                        event = line[len("event: "):]
+                    elif line.startswith("data: "):
+                        data = json.loads(line[len("data: "):])
+                        if event == "token":
+                            chunks.put(data["content"])
+                        elif event == "error":
+                            raise RuntimeError(data["detail"])
+        finally:
+            chunks.put(self._END)
+
+    def stream_chat(self, user_id: str, message: str) -> Iterator[str]:
+        """
+        Yield response text as the backend streams it. The request runs on
+        the background loop, so it still completes (and the backend persists
+        the turn) if the script is rerun before the stream ends.
+        """
+        chunks: queue.Queue = queue.Queue()
+        future = asyncio.run_coroutine_threadsafe(self._stream_chat(user_id, message, chunks), self.loop)
+        while True:
+            chunk = chunks.get()
+            if chunk is self._END:
+                break
+            yield chunk
+        # Re-raise a failure from the stream
+        future.result()
+
+@st.cache_resource
+def get_backend_client() -> BackendClient:
+    """Backend client and its event loop, created once per Streamlit process"""
+    return BackendClient(BACKEND_URL, BACKEND_MAX_CONNECTIONS)
+
 # Initialize session state
 def initialize_session_state():
     """Initialize session state variables"""
     if 'user_id' not in st.session_state:
         st.session_state.user_id = ""
     
-    if 'conversation_history' not in st.session_state:
-        st.session_state.conversation_history = []
-    
     if 'messages' not in st.session_state:
         st.session_state.messages = []
     
+    # Cursor for the next older history page (None once everything is loaded)
+    if 'history_cursor' not in st.session_state:
+        st.session_state.history_cursor = None
+    
+    # How many of the newest messages are shown; older ones stay behind "Show older messages"
+    if 'visible_count' not in st.session_state:
+        st.session_state.visible_count = HISTORY_PAGE_SIZE
+    
     if 'processing' not in st.session_state:
         st.session_state.processing = False
     
     if 'user_id_input' not in st.session_state:
         st.session_state.user_id_input = ""
 
+def make_message(role: str, content: str) -> dict:
+    """A chat message with its HTML rendered once, so reruns reuse it"""
+    return {"role": role, "content": content, "html": render_message(role, content)}
+
+def add_message(role: str, content: str):
+    """Append a new message to the session transcript"""
+    st.session_state.messages.append(make_message(role, content))
+
+def _page_messages(page: dict) -> List[dict]:
+    return [
+        make_message("user" if speaker == "User" else "assistant", message)
+        for speaker, message in page["conversation_history"]
+    ]
+
 def load_user_conversation(user_id: str):
-    """Load conversation history for a specific user ID"""
+    """Load the newest page of conversation history for a user ID from the backend"""
     try:
-        # Get past memories for this user
-        memories = memory_service.get_all_user_memories(user_id, limit=100)
+        page = get_backend_client().get_history_page(user_id, HISTORY_PAGE_SIZE)
         
-        # Clear current conversation
-        st.session_state.conversation_history = []
-        st.session_state.messages = []
-        
-        # Sort memories by timestamp if available
-        if memories:
-            memories.sort(key=lambda x: x.get('timestamp', '0'))
-            
-            # Reconstruct conversation from memories
-            for memory in memories:
-                message_type = memory.get('message_type', 'user')
-                message_content = memory.get('message', '')
-                
-                if message_content:
-                    st.session_state.messages.append({
-                        "role": message_type if message_type in ['user', 'assistant'] else 'user',
-                        "content": message_content
-                    })
-                    
-                    # Also add to conversation history for context
-                    st.session_state.conversation_history.append((message_type, message_content))
+        st.session_state.messages = _page_messages(page)
+        st.session_state.history_cursor = page["next_before_id"]
+        st.session_state.visible_count = HISTORY_PAGE_SIZE
         
         st.session_state.user_id = user_id
         st.success(f"Loaded conversation for User ID: {user_id}")
@@ -121,60 +208,45 @@ def load_user_conversation(user_id: str):
         logger.error(f"Error loading user conversation: {str(e)}")
         st.error(f"Error loading conversation: {str(e)}")
 
+def has_older_messages() -> bool:
+    return st.session_state.visible_count < len(st.session_state.messages) or st.session_state.history_cursor is not None
+
+def show_older_messages():
+    """Reveal one more page, fetching it from the backend if it is not loaded yet"""
+    hidden = len(st.session_state.messages) - st.session_state.visible_count
+    if hidden < HISTORY_PAGE_SIZE and st.session_state.history_cursor is not None:
+        try:
+            page = get_backend_client().get_history_page(
+                st.session_state.user_id, HISTORY_PAGE_SIZE, st.session_state.history_cursor
+            )
+            st.session_state.messages = _page_messages(page) + st.session_state.messages
+            st.session_state.history_cursor = page["next_before_id"]
+        except Exception as e:
+            logger.error(f"Error loading older messages: {str(e)}")
+            st.error(f"Error loading older messages: {str(e)}")
+            return
+    st.session_state.visible_count += HISTORY_PAGE_SIZE
+
 def clear_conversation():
     """Clear the current session messages but keep user ID"""
-    st.session_state.conversation_history = []
     st.session_state.messages = []
+    st.session_state.history_cursor = None
+    st.session_state.visible_count = HISTORY_PAGE_SIZE
     # Keep the user_id and user_id_input so user can reload conversation
     st.success("Current session cleared! Your conversation history is still saved - reload to see it again.")
 
-async def get_bot_response(user_input: str, user_id: str, conversation_history: List[Tuple[str, str]]) -> str:
-    """Get response from the memory-enabled chatbot"""
-    try:
-        response = await process_query_with_memory(user_id, user_input, conversation_history)
-        return response
-    except Exception as e:
-        logger.error(f"Error getting bot response: {str(e)}")
-        return f"Sorry, I encountered an error: {str(e)}"
-
-def retrieve_user_memories(user_id: str, query: str = "", top_k: int = 10) -> List[str]:
-    """Retrieve memories for the current user"""
-    try:
-        if not query:
-            query = "general conversation"
-        memories = memory_service.retrieve_memories(user_id, query, top_k)
-        logger.info(f"Retrieved {len(memories)} memories for query: {query}")
-        return memories
-    except Exception as e:
-        logger.error(f"Error retrieving memories: {str(e)}")
-        return []
+def stream_bot_response(user_input: str, user_id: str) -> Iterator[str]:
+    """
+    Send the message to the backend's /chat/stream and yield the response
+    text as it arrives. The backend loads the conversation history itself.
+    """
+    return get_backend_client().stream_chat(user_id, user_input)
 
-def get_all_user_memories(user_id: str) -> List[dict]:
-    """Get all memories for debugging"""
-    try:
-        memories = memory_service.get_all_user_memories(user_id, limit=50)
-        return memories
-    except Exception as e:
-        logger.error(f"Error getting all memories: {str(e)}")
-        return []
-
-def test_memory_storage(user_id: str) -> str:
-    """Test if memory storage is working"""
-    try:
-        test_message = f"Test message at {time.time()}"
-        memory_service.store_message(user_id, test_message, "test")
-        
-        # Try to retrieve it
-        time.sleep(1)  # Give it a moment
-        memories = memory_service.retrieve_memories(user_id, "test message", 5)
-        
-        if any("test message" in memory.lower() for memory in memories):
-            return "✅ Memory storage is working!"
-        else:
-            return "❌ Memory storage test failed - message not found in retrieval"
-            
-    except Exception as e:
-        return f"❌ Memory storage test failed: {str(e)}"
+def render_message(role: str, content: str) -> str:
+    """HTML block for one chat message"""
+    if role == "user":
+        return f'<div class="chat-message user-message"><strong>You:</strong> {content}</div>'
+    return f'<div class="chat-message assistant-message"><strong>Assistant:</strong> {content}</div>'
 
 def main():
     # Initialize session
@@ -232,17 +304,15 @@ def main():
     chat_container = st.container()
     
     with chat_container:
-        for message in st.session_state.messages:
-            if message["role"] == "user":
-                st.markdown(
-                    f'<div class="chat-message user-message"><strong>You:</strong> {message["content"]}</div>',
-                    unsafe_allow_html=True
-                )
-            else:
-                st.markdown(
-                    f'<div class="chat-message assistant-message"><strong>Assistant:</strong> {message["content"]}</div>',
-                    unsafe_allow_html=True
-                )
+        if has_older_messages() and st.button("⬆️ Show older messages"):
+            show_older_messages()
+            st.rerun()
+        
+        # Only the newest visible_count messages are drawn, as one pre-rendered
+        # block, so a rerun costs the same however long the history is
+        visible = st.session_state.messages[-st.session_state.visible_count:]
+        if visible:
+            st.markdown("".join(message["html"] for message in visible), unsafe_allow_html=True)
     
     # Chat input
     chat_disabled = st.session_state.processing or not st.session_state.user_id
@@ -252,46 +322,35 @@ def main():
     
     if user_input and not st.session_state.processing and st.session_state.user_id:
         # Add user message to session
-        st.session_state.messages.append({"role": "user", "content": user_input})
+        add_message("user", user_input)
         st.session_state.processing = True
         
         # Display user message immediately
-        st.markdown(
-            f'<div class="chat-message user-message"><strong>You:</strong> {user_input}</div>',
-            unsafe_allow_html=True
-        )
+        st.markdown(render_message("user", user_input), unsafe_allow_html=True)
         
-        # Show typing indicator
-        with st.spinner("Assistant is thinking..."):
-            # Get bot response
-            try:
-                logger.info(f"Processing message for user {st.session_state.user_id[:8]}: {user_input}")
-                
-                response = asyncio.run(get_bot_response(
-                    user_input, 
-                    st.session_state.user_id, 
-                    st.session_state.conversation_history
-                ))
-                
-                logger.info(f"Got response: {response[:100]}...")
-                
-                # Add to conversation history
-                st.session_state.conversation_history.append(("user", user_input))
-                st.session_state.conversation_history.append(("assistant", response))
-                
-                # Add assistant message to session
-                st.session_state.messages.append({"role": "assistant", "content": response})
-                
-                # Log memory storage attempt
-                logger.info("Messages should now be stored in memory")
-                
-            except Exception as e:
-                logger.error(f"Error in chat processing: {str(e)}", exc_info=True)
-                error_message = f"Sorry, I encountered an error: {str(e)}"
-                st.session_state.messages.append({"role": "assistant", "content": error_message})
+        # Render the response as it streams in
+        response_placeholder = st.empty()
+        response_placeholder.markdown(render_message("assistant", "_thinking..._"), unsafe_allow_html=True)
+        response = ""
+        try:
+            logger.info(f"Processing message for user {st.session_state.user_id[:8]}: {user_input}")
+            
+            for chunk in stream_bot_response(user_input, st.session_state.user_id):
+                response += chunk
+                response_placeholder.markdown(render_message("assistant", response + " ▌"), unsafe_allow_html=True)
+            
+            logger.info(f"Got response: {response[:100]}...")
             
-            finally:
-                st.session_state.processing = False
+            # Add assistant message to session
+            add_message("assistant", response)
+            
+        except Exception as e:
+            logger.error(f"Error in chat processing: {str(e)}", exc_info=True)
+            error_message = f"Sorry, I encountered an error: {str(e)}"
+            add_message("assistant", error_message)
+        
+        finally:
+            st.session_state.processing = False
         
         # Rerun to update the display
         st.rerun()